@@ -0,0 +1,306 @@
+import argparse
+import csv
+import json
+import logging
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+from argparse import Namespace
+from datetime import datetime, timezone
+
+import psycopg2
+
+from postgres_Latest import (
+    TOOL_VERSION,
+    load_parameters,
+    iter_grant_records,
+    compile_task,
+    iter_compile_grants,
+    main as run_main,
+)
+
+# Table grants generated at each scale
+DEFAULT_GRANT_SCALES = [1000, 100000, 1000000]
+
+# Roles and schemas generated at each scale
+DEFAULT_SCHEMA_SCALES = [10, 100, 1000, 10000]
+
+# Synthetic grants are spread over at most this many tables, so applying them does not need a table per grant
+BENCH_TABLES = 1000
+TABLES_PER_ROW = 10
+BENCH_SCHEMA = "bench"
+
+
+def generate_grant_csv(path, grants):
+    """
+    Write a permissions/tables/role CSV holding the given number of table grants.
+
+    Rows list TABLES_PER_ROW tables of the bench schema each; the table pool is shared by
+    grants / BENCH_TABLES roles. Returns (tables, roles) so the objects can be created.
+    """
+    table_count = min(grants, BENCH_TABLES)
+    role_count = max(grants // table_count, 1)
+    tables = [f"{BENCH_SCHEMA}.t{i}" for i in range(table_count)]
+    roles = [f"bench_grantee_{i}" for i in range(role_count)]
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["permissions", "tables", "role"])
+        written = 0
+        row = 0
+        while written < grants:
+            count = min(TABLES_PER_ROW, grants - written)
+            start = (row * TABLES_PER_ROW) % table_count
+            row_tables = [tables[(start + i) % table_count] for i in range(count)]
+            permission = "tables_to_receive_grant_select" if row % 2 else "tables_to_receive_grant_full"
+            writer.writerow([permission, ", ".join(row_tables), roles[(written // table_count) % role_count]])
+            written += count
+            row += 1
+    return tables, roles
+
+
+def generate_parameter_csv(path, scale, owner="postgres", prefix="bench"):
+    """ Write a key/value parameter file creating scale users, roles and schemas granted to the four role kinds. """
+    users = [f"{prefix}_user_{i}" for i in range(scale)]
+    schemas = [f"{prefix}_schema_{i}" for i in range(scale)]
+    params = [
+        ("user_owner", owner),
+        ("another_users", ",".join(users)),
+        ("role_list", ",".join(f"{prefix}_role_{i}" for i in range(scale))),
+        ("role_cr", f"{prefix}_cr"),
+        ("role_ro", f"{prefix}_ro"),
+        ("role_rw", f"{prefix}_rw"),
+        ("role_tr", f"{prefix}_tr"),
+        ("users_to_receive_role_ro", ",".join(users)),
+        ("users_to_receive_role_rw", ",".join(users[: max(scale // 10, 1)])),
+        ("schema_list", ",".join(schemas)),
+        ("schema_cr_list", ",".join(schemas[: max(scale // 10, 1)])),
+        ("schema_ro_list", ",".join(schemas)),
+        ("schema_rw_list", ",".join(schemas)),
+        ("schema_tr_list", ",".join(schemas[: max(scale // 10, 1)])),
+    ]
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["key", "value"])
+        writer.writerows(params)
+
+
+def find_pg_bin(pg_bin=None):
+    """ Locate the directory holding initdb and pg_ctl: --pg_bin, the PATH, or pg_config --bindir. """
+    if pg_bin:
+        return pg_bin
+    initdb = shutil.which("initdb")
+    if initdb:
+        return os.path.dirname(initdb)
+    pg_config = shutil.which("pg_config")
+    if pg_config:
+        return subprocess.run([pg_config, "--bindir"], check=True, capture_output=True, text=True).stdout.strip()
+    raise RuntimeError("initdb not found; pass --pg_bin or put the PostgreSQL binaries on the PATH.")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def start_local_cluster(pg_bin):
+    """
+    initdb a throwaway cluster in a temporary directory and start it on a free localhost port.
+
+    Returns (data directory, port). initdb refuses to run as root, so run benchmarks as a regular user.
+    """
+    data_dir = tempfile.mkdtemp(prefix="db_permissions_bench_")
+    port = free_port()
+    logging.info("Initialising a local cluster in %s", data_dir)
+    subprocess.run([os.path.join(pg_bin, "initdb"), "-D", data_dir, "-U", "postgres", "--auth=trust", "-E", "UTF8"],
+                   check=True, capture_output=True)
+    subprocess.run([os.path.join(pg_bin, "pg_ctl"), "-D", data_dir, "-w", "-l", os.path.join(data_dir, "server.log"),
+                    "-o", f"-p {port} -k {data_dir} -c listen_addresses=localhost", "start"],
+                   check=True, capture_output=True)
+    return data_dir, port
+
+
+def stop_local_cluster(pg_bin, data_dir):
+    subprocess.run([os.path.join(pg_bin, "pg_ctl"), "-D", data_dir, "-m", "fast", "stop"], capture_output=True)
+    shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def timed(function, repeat=1):
+    """ Run function repeat times and return (best seconds, last result). """
+    best, result = None, None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - started
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+def record(results, benchmark, scale, seconds, items, **extra):
+    entry = {"benchmark": benchmark, "scale": scale, "seconds": round(seconds, 6),
+             "items": items, "items_per_second": round(items / seconds, 1) if seconds else None}
+    entry.update(extra)
+    results.append(entry)
+    logging.warning("%-22s scale=%-8d %10.3fs %12s items/s %s", benchmark, scale, seconds,
+                    entry["items_per_second"], " ".join(f"{k}={v}" for k, v in extra.items()))
+
+
+def create_database(connection, dbname):
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP DATABASE IF EXISTS {dbname};")
+        cursor.execute(f"CREATE DATABASE {dbname};")
+
+
+def create_grant_objects(connection, tables, roles):
+    """ Create the bench schema, tables and grantee roles a grant CSV refers to, in two round trips. """
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            CREATE SCHEMA IF NOT EXISTS {BENCH_SCHEMA};
+            DO $$
+            BEGIN
+                FOR i IN 0..{len(tables) - 1} LOOP
+                    EXECUTE format('CREATE TABLE IF NOT EXISTS {BENCH_SCHEMA}.t%s (id int)', i);
+                END LOOP;
+            END $$;
+        """)
+        cursor.execute(f"""
+            DO $$
+            BEGIN
+                FOR i IN 0..{len(roles) - 1} LOOP
+                    IF NOT EXISTS (SELECT 1 FROM pg_roles WHERE rolname = 'bench_grantee_' || i) THEN
+                        EXECUTE format('CREATE ROLE bench_grantee_%s', i);
+                    END IF;
+                END LOOP;
+            END $$;
+        """)
+
+
+def run_args(args, dbname, parameter_file, task, backend):
+    """ Build the Namespace postgres_Latest.main expects for one end-to-end run. """
+    return Namespace(host=args.host, port=args.port, username=args.username, dbname=dbname,
+                     parameter_file=parameter_file, task=task, useDatadog="Disabled", backend=backend,
+                     workers=args.workers, batch_grants=False, plan=False)
+
+
+def benchmark_grants(args, work_dir, results, maintenance):
+    for scale in args.grant_scales:
+        path = os.path.join(work_dir, f"grants_{scale}.csv")
+        tables, roles = generate_grant_csv(path, scale)
+
+        seconds, count = timed(lambda: sum(1 for _ in iter_grant_records(path)), args.repeat)
+        record(results, "parse_grants", scale, seconds, count)
+        seconds, count = timed(lambda: sum(1 for _ in iter_compile_grants(iter_grant_records(path))), args.repeat)
+        record(results, "compile_grants", scale, seconds, count)
+
+        if maintenance is None or scale > args.execute_limit:
+            continue
+        for backend in args.backends:
+            dbname = f"bench_grants_{scale}_{backend}"
+            create_database(maintenance, dbname)
+            conn = psycopg2.connect(host=args.host, port=args.port, user=args.username, dbname=dbname)
+            conn.autocommit = True
+            try:
+                create_grant_objects(conn, tables, roles)
+            finally:
+                conn.close()
+            seconds, _ = timed(lambda: run_main(run_args(args, dbname, path, "execute_grants", backend)))
+            record(results, "apply_grants", scale, seconds, count, backend=backend)
+
+
+def benchmark_task(args, work_dir, results, maintenance):
+    for scale in args.schema_scales:
+        path = os.path.join(work_dir, f"parameters_{scale}.csv")
+        generate_parameter_csv(path, scale, owner=args.username)
+
+        seconds, parameters = timed(lambda: load_parameters(path), args.repeat)
+        record(results, "parse_parameters", scale, seconds, scale)
+        seconds, plan = timed(lambda: compile_task(parameters, "bench"), args.repeat)
+        record(results, "compile_task", scale, seconds, len(plan))
+
+        if maintenance is None or scale > args.execute_limit:
+            continue
+        for backend in args.backends:
+            # Roles are cluster-wide, so every backend gets its own to create
+            dbname = f"bench_task_{scale}_{backend}"
+            backend_path = os.path.join(work_dir, f"parameters_{scale}_{backend}.csv")
+            generate_parameter_csv(backend_path, scale, owner=args.username, prefix=dbname)
+            create_database(maintenance, dbname)
+            seconds, _ = timed(lambda: run_main(run_args(args, dbname, backend_path, "create_users", backend)))
+            record(results, "apply_task", scale, seconds, len(plan), backend=backend)
+
+
+def run_benchmarks(args):
+    """
+    Run every benchmark and return the JSON document written to --output.
+
+    Without --host, a local cluster is launched for the end-to-end runs and removed afterwards.
+    """
+    pg_bin = data_dir = None
+    if not args.no_execute and not args.host:
+        pg_bin = find_pg_bin(args.pg_bin)
+        data_dir, args.port = start_local_cluster(pg_bin)
+        args.host = "localhost"
+
+    work_dir = tempfile.mkdtemp(prefix="db_permissions_bench_csv_")
+    results = []
+    server_version = None
+    maintenance = None
+    try:
+        if not args.no_execute:
+            maintenance = psycopg2.connect(host=args.host, port=args.port, user=args.username, dbname="postgres")
+            maintenance.autocommit = True
+            server_version = maintenance.server_version
+        benchmark_grants(args, work_dir, results, maintenance)
+        benchmark_task(args, work_dir, results, maintenance)
+    finally:
+        if maintenance is not None:
+            maintenance.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if data_dir:
+            stop_local_cluster(pg_bin, data_dir)
+
+    return {
+        "tool_version": TOOL_VERSION,
+        "started": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "psycopg2": psycopg2.__version__,
+        "server_version": server_version,
+        "repeat": args.repeat,
+        "results": results,
+    }
+
+
+def scales(value):
+    return [int(scale) for scale in value.split(",") if scale.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark parsing, plan generation and execution of postgres_Latest.py")
+    parser.add_argument("--output", type=str, default="benchmark_results.json", help="JSON file the results are written to")
+    parser.add_argument("--grant_scales", type=scales, default=DEFAULT_GRANT_SCALES,
+                        help="Comma separated numbers of table grants to generate")
+    parser.add_argument("--schema_scales", type=scales, default=DEFAULT_SCHEMA_SCALES,
+                        help="Comma separated numbers of roles and schemas to generate")
+    parser.add_argument("--execute_limit", type=int, default=1000000,
+                        help="Largest scale applied end-to-end; larger scales are only parsed and compiled")
+    parser.add_argument("--backends", type=lambda value: value.split(","), default=["sync"],
+                        help="Comma separated execution backends to apply with")
+    parser.add_argument("--workers", type=int, default=1, help="--workers passed to the async backend")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions of parse and compile timings; the best is kept")
+    parser.add_argument("--no_execute", action="store_true", help="Only time parsing and plan generation")
+    parser.add_argument("--pg_bin", type=str, help="Directory with initdb and pg_ctl for the local cluster")
+    parser.add_argument("--host", type=str, help="Benchmark against this server instead of a local cluster")
+    parser.add_argument("-p", "--port", type=int, default=5432, help="Port of --host")
+    parser.add_argument("-U", "--username", type=str, default="postgres", help="PostgreSQL user")
+    args = parser.parse_args()
+
+    # Per-statement logging would dominate the timings
+    logging.getLogger().setLevel(logging.WARNING)
+    document = run_benchmarks(args)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(document, f, indent=2)
+    logging.warning("Wrote %d results to %s", len(document["results"]), args.output)
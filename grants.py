@@ -0,0 +1,104 @@
+import collections
+import logging
+
+# Privileges granted for each "tables_to_receive_grant_<kind>" permission type
+GRANT_PRIVILEGES = {
+    "full": "SELECT, INSERT, UPDATE, DELETE",
+    "select": "SELECT",
+    "select_usage": "SELECT, USAGE",
+}
+
+# Prefix of every permission type in a permissions/tables/role CSV file
+GRANT_PERMISSION_PREFIX = "tables_to_receive_grant_"
+
+# One statement of a compiled plan.
+#   index       position of the step in its plan
+#   statement   the SQL to execute
+#   category    what the statement does, e.g. "create_role", "grant_membership", "table_grant"
+#   obj         the object the statement acts on (role, schema, database or table)
+#   grantee     the role receiving the object or privilege, if any
+#   privileges  the comma separated privileges granted, if any
+#   depends_on  indexes of the earlier steps that must have run first
+#   guard       (kind, name) of an object whose existence makes the step unnecessary, or None
+#   source      the parameter key, or the CSV line (1-based record of an in-memory list) of the grant
+PlanStep = collections.namedtuple(
+    "PlanStep", ["index", "statement", "category", "obj", "grantee", "privileges", "depends_on", "guard", "source"]
+)
+
+
+class GrantRecord(tuple):
+    """ A (permission_type, table, role) record that remembers the CSV line it was read from. """
+
+    def __new__(cls, permission_type, table, role, line):
+        record = super().__new__(cls, (permission_type, table, role))
+        record.line = line
+        return record
+
+
+def split_tables(tables):
+    """
+    Return the distinct table names of a grant record.
+
+    Accepts the list of tables produced by load_parameters as well as the single
+    table string produced by iter_grant_records.
+    """
+    if isinstance(tables, str):
+        tables = [tables]
+    return {t.strip() for table_list in tables for t in table_list.split(",") if t.strip()}
+
+
+def table_grant_statement(privileges, table, role):
+    """ Build the statement granting privileges on a single table. """
+    return f"GRANT {privileges} ON {table} TO {role};"
+
+
+def grant_privileges(permission_type):
+    """ Return the privileges of a "tables_to_receive_grant_<kind>" permission type, or None. """
+    if not permission_type.startswith(GRANT_PERMISSION_PREFIX):
+        return None
+    return GRANT_PRIVILEGES.get(permission_type[len(GRANT_PERMISSION_PREFIX):])
+
+
+def match_grant_privileges(permission_type):
+    """
+    Return the privileges of any permission type naming them among its "_" separated words, or None.
+
+    This is the looser matching process_csv.py has always used: "full" wins, then "select"
+    together with "usage", then "select" alone.
+    """
+    parts = permission_type.split("_")
+    if "full" in parts:
+        return GRANT_PRIVILEGES["full"]
+    if "select" in parts and "usage" in parts:
+        return GRANT_PRIVILEGES["select_usage"]
+    if "select" in parts:
+        return GRANT_PRIVILEGES["select"]
+    return None
+
+
+def iter_compile_grants(grant_parameters, privileges_for=grant_privileges):
+    """
+    Lazily compile permissions/tables/role records into "table_grant" plan steps.
+
+    Works on the list returned by load_parameters as well as the stream from iter_grant_records.
+    privileges_for maps a permission type to the privileges it grants. Table grants are
+    independent of each other, so the steps have no dependencies.
+    """
+    index = 0
+    for record_number, record in enumerate(grant_parameters, start=1):
+        permission_type, tables, role = record
+        # Streamed records know their CSV line; in-memory lists are numbered by record
+        source = getattr(record, "line", record_number)
+        privileges = privileges_for(permission_type)
+        if privileges is None:
+            logging.warning("Unsupported permission type %s for role %s. Skipping.", permission_type, role)
+            continue
+        for table in sorted(split_tables(tables)):
+            yield PlanStep(index, table_grant_statement(privileges, table, role), "table_grant", table, role,
+                           privileges, (), None, source)
+            index += 1
+
+
+def compile_grants(grant_parameters, privileges_for=grant_privileges):
+    """ Compile permissions/tables/role records into an immutable plan (a tuple of PlanStep). """
+    return tuple(iter_compile_grants(grant_parameters, privileges_for))
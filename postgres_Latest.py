@@ -1,11 +1,60 @@
 import argparse
-import psycopg2
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextvars
 import csv
+import hashlib
+import heapq
+import itertools
+import json
 import logging
+import os
+import queue
+import random
+import re
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+try:
+    import psycopg
+except ImportError:  # psycopg 3 is optional and only needed by --backend pipeline
+    psycopg = None
+
+from grants import (
+    GrantRecord,
+    PlanStep,
+    compile_grants,
+    iter_compile_grants,
+    table_grant_statement,
+)
 
 # Configure logging with a specific format and set the log level to INFO
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Upper bound, in characters, for a single batched GRANT statement
+DEFAULT_MAX_STATEMENT_SIZE = 65536
+
+# Statements buffered per worker when executing with --workers
+WORK_QUEUE_SIZE = 1000
+
+# Statements sent ahead of their replies by the pipeline backend
+PIPELINE_WINDOW = 1000
+
+# Per (host, port) locks serialising cluster-wide changes (roles, databases) between concurrent targets
+CLUSTER_LOCKS = {}
+CLUSTER_LOCKS_GUARD = threading.Lock()
+
 
 def load_parameters(csv_file_path):
     """
@@ -49,53 +98,50 @@ def load_parameters(csv_file_path):
             return structured_data
     return {}
 
+def iter_grant_records(csv_file_path):
+    """
+    Lazily yield (permission_type, table, role) records from a permissions/tables/role CSV file.
+
+    Unlike load_parameters, the file is read one row at a time, so memory use does not
+    grow with the size of the file. Tables repeated within one row are yielded once.
+    Records are GrantRecord tuples carrying the line of the file they come from.
+    """
+    with open(csv_file_path, "r", encoding="utf-8") as csv_file:
+        reader = csv.reader(csv_file)
+        header = next(reader, None)
+        if not header or len(header) != 3:
+            logging.warning("%s is not a permissions/tables/role CSV file. No grants loaded.", csv_file_path)
+            return
+
+        for row in reader:
+            if len(row) < 3:
+                continue
+            permission_type = row[0].strip().lower()
+            role = row[2].strip()
+            for table in dict.fromkeys(t.strip() for t in row[1].split(",") if t.strip()):
+                yield GrantRecord(permission_type, table, role, reader.line_num)
+    logging.info("Streamed structured parameters successfully.")
+
+
 def create_database(cursor_postgres,args):
     """
     Check if the database exists, and create it if it doesn't.
     """
     logging.info("Checking for database %s on server %s", args.dbname, args.host)
     try:
-        cursor_postgres.execute("SELECT 1 FROM pg_database WHERE datname = %s", (args.dbname,))
-        if cursor_postgres.fetchone():
-            logging.info("Database %s already exists", args.dbname)
-        else:
-            logging.info("Creating database %s", args.dbname)
-            cursor_postgres.execute(f"CREATE DATABASE {args.dbname};")
+        execute_plan(cursor_postgres, compile_create_database(args.dbname))
     except Exception as e:
         logging.error("Error checking or creating database: %s", e)
 
 
-def create_datadog_role(cursor, cursor_postgres, args):
-    """
-    Function to create Datadog role and assign required permissions.
-    """
-    logging.info("Checking if 'datadog' user exists...")
-    cursor_postgres.execute("SELECT 1 FROM pg_user WHERE usename = 'datadog';")
-    if cursor_postgres.fetchone() is None:
-        logging.info("Creating 'datadog' user...")
-        cursor_postgres.execute("CREATE USER datadog;")
-    else:
-        logging.info("User 'datadog' already exists.")
-
-    # Enable pg_stat_statements in the postgres database
-    logging.info("Creating EXTENSION pg_stat_statements in postgres database")
-    cursor_postgres.execute("CREATE EXTENSION IF NOT EXISTS pg_stat_statements;")
-
-    # Enable pg_stat_statements in the application database
-    logging.info(f"Creating EXTENSION pg_stat_statements in {args.dbname} database")
-    cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_stat_statements;")
-
-    # Grant permissions and set up Datadog schema
-    logging.info("Granting permissions to Datadog user...")
-    cursor.execute(f"GRANT datadog TO {args.username};")
-    cursor.execute(f"CREATE SCHEMA IF NOT EXISTS datadog;")
-    cursor.execute(f"GRANT USAGE ON SCHEMA datadog TO datadog;")
-    cursor.execute(f"GRANT USAGE ON SCHEMA public TO datadog;")
-    cursor.execute(f"GRANT pg_monitor TO datadog;")
-    cursor.execute(f"GRANT CONNECT ON DATABASE {args.dbname} TO datadog;")
-
-    # Create or replace function for Datadog
-    cursor.execute("""
+def compile_create_database(dbname):
+    """ Compile the create_database task into a plan run on the postgres maintenance database. """
+    return (PlanStep(0, f"CREATE DATABASE {dbname};", "create_database", dbname, None, None, (),
+                     ("database", dbname), "dbname"),)
+
+
+# Function the Datadog agent calls to collect execution plans
+DATADOG_EXPLAIN_FUNCTION = """
         CREATE OR REPLACE FUNCTION datadog.explain_statement(
             l_query TEXT,
             OUT explain JSON
@@ -115,76 +161,999 @@ def create_datadog_role(cursor, cursor_postgres, args):
         LANGUAGE 'plpgsql'
         RETURNS NULL ON NULL INPUT
         SECURITY DEFINER;
-    """)
+    """
+
+
+def compile_datadog_role(dbname, username):
+    """
+    Compile the create_datadog_role task.
+
+    Returns (postgres steps, application steps): the steps run on the postgres maintenance
+    database and the steps run on the application database.
+    """
+    postgres_steps = [
+        ("CREATE USER datadog;", "create_user", "datadog", None, ("role", "datadog")),
+        # Enable pg_stat_statements in the postgres database
+        ("CREATE EXTENSION IF NOT EXISTS pg_stat_statements;", "create_extension", "pg_stat_statements", None, None),
+    ]
+    application_steps = [
+        # Enable pg_stat_statements in the application database
+        ("CREATE EXTENSION IF NOT EXISTS pg_stat_statements;", "create_extension", "pg_stat_statements", None, None),
+        # Grant permissions and set up Datadog schema
+        (f"GRANT datadog TO {username};", "grant_membership", "datadog", username, None),
+        ("CREATE SCHEMA IF NOT EXISTS datadog;", "create_schema", "datadog", None, None),
+        ("GRANT USAGE ON SCHEMA datadog TO datadog;", "schema_privileges", "datadog", "datadog", None),
+        ("GRANT USAGE ON SCHEMA public TO datadog;", "schema_privileges", "public", "datadog", None),
+        ("GRANT pg_monitor TO datadog;", "grant_membership", "pg_monitor", "datadog", None),
+        (f"GRANT CONNECT ON DATABASE {dbname} TO datadog;", "database_privileges", dbname, "datadog", None),
+        # Create or replace function for Datadog
+        (DATADOG_EXPLAIN_FUNCTION, "create_function", "datadog.explain_statement", None, None),
+    ]
+    return tuple(
+        tuple(PlanStep(index, statement, category, obj, grantee, None, (), guard, "useDatadog")
+              for index, (statement, category, obj, grantee, guard) in enumerate(steps))
+        for steps in (postgres_steps, application_steps)
+    )
+
+
+def create_datadog_role(cursor, cursor_postgres, args):
+    """
+    Function to create Datadog role and assign required permissions.
+    """
+    postgres_steps, application_steps = compile_datadog_role(args.dbname, args.username)
+    logging.info("Setting up the 'datadog' user and pg_stat_statements in the postgres database...")
+    execute_plan(cursor_postgres, postgres_steps)
+    logging.info("Granting permissions to Datadog user in %s database...", args.dbname)
+    execute_plan(cursor, application_steps)
 
     logging.info("Datadog role setup completed successfully.")
 
-def create_user(cursor, user):
+# Upper bounds, in milliseconds, of the latency histogram buckets of the run profile
+PROFILE_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 10000)
+
+# (category, pattern) pairs classifying executed statements; the "target" group is the object acted on
+STATEMENT_CATEGORIES = [
+    (category, re.compile(pattern, re.IGNORECASE | re.DOTALL)) for category, pattern in [
+        ("create_user", r"CREATE\s+USER\s+(?P<target>\S+?);?\s*$"),
+        ("create_role", r"CREATE\s+ROLE\s+(?P<target>\S+?);?\s*$"),
+        ("create_schema", r"CREATE\s+SCHEMA\s+(?:IF\s+NOT\s+EXISTS\s+)?(?P<target>\S+)"),
+        ("create_database", r"CREATE\s+DATABASE\s+(?P<target>\S+?);?\s*$"),
+        ("alter_database_owner", r"ALTER\s+DATABASE\s+(?P<target>\S+)"),
+        ("default_privileges", r"ALTER\s+DEFAULT\s+PRIVILEGES\s+IN\s+SCHEMA\s+(?P<target>.+?)\s+(?:GRANT|REVOKE)\s"),
+        ("all_objects_privileges", r"GRANT\s.+?\sON\s+ALL\s+\w+\s+IN\s+SCHEMA\s+(?P<target>.+?)\s+TO\s"),
+        ("schema_privileges", r"GRANT\s.+?\sON\s+SCHEMA\s+(?P<target>.+?)\s+TO\s"),
+        ("table_grant", r"GRANT\s.+?\sON\s+(?:TABLE\s+)?(?P<target>.+?)\s+TO\s"),
+        ("grant_membership", r"GRANT\s+(?P<target>.+?)\s+TO\s"),
+        ("revoke", r"REVOKE\s.+?\sFROM\s+(?P<target>.+?);?\s*$"),
+        ("set_role", r"(?:SET|RESET)\s+ROLE\b\s*(?P<target>[^;\s]*)"),
+        ("server_block", r"DO\s"),
+        ("catalog_probe", r"(?:SELECT|WITH)\s.*?\sFROM\s+(?P<target>[\w.]+)"),
+        ("catalog_probe", r"(?:SELECT|WITH)\s"),
+    ]
+]
+
+# Savepoint statements TransactionBatchCursor sends ahead of the statement it runs
+SAVEPOINT_PREFIX = re.compile(r"^\s*((RELEASE\s+)?SAVEPOINT\s+\w+;\s*)+", re.IGNORECASE)
+
+def describe_statement(statement):
+    """ Return the (category, target object) of an executed statement for the run profile. """
+    statement = SAVEPOINT_PREFIX.sub("", statement)
+    for category, pattern in STATEMENT_CATEGORIES:
+        match = pattern.match(statement.lstrip())
+        if match:
+            return category, (match.groupdict().get("target") or "").strip()
+    return "other", ""
+
+
+class Profile:
     """
-    Create a PostgreSQL user if it does not already exist.
+    Latency profile of one run, aggregated as statements complete.
+
+    Each category keeps a count, total, maximum and latency histogram; only the top_n slowest
+    statements are kept verbatim, so memory does not grow with the number of statements.
+    """
+
+    def __init__(self, top_n=10):
+        self.top_n = top_n
+        self.started = time.perf_counter()
+        self.round_trip = None
+        self.categories = {}
+        self.slowest = []
+        self.statement_seconds = 0.0
+        self.round_trips = 0
+        self.lock = threading.Lock()
+
+    def record(self, statement, seconds, category=None, target=None, round_trip=True, overlapped=False):
+        """
+        Record one statement. round_trip is False for work that did not wait on a reply of its
+        own, and overlapped statements are left out of the time split because their latencies
+        run concurrently on one connection (the caller records the span they covered instead).
+        """
+        if category is None:
+            category, target = describe_statement(statement)
+        with self.lock:
+            entry = self.categories.setdefault(
+                category, {"count": 0, "seconds": 0.0, "max_seconds": 0.0, "buckets": [0] * (len(PROFILE_BUCKETS_MS) + 1)})
+            entry["count"] += 1
+            entry["seconds"] += seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+            entry["buckets"][bisect.bisect_left(PROFILE_BUCKETS_MS, seconds * 1000)] += 1
+            self.statement_seconds += 0.0 if overlapped else seconds
+            self.round_trips += 1 if round_trip else 0
+            item = (seconds, category, target or "", " ".join(statement.split())[:200])
+            if len(self.slowest) < self.top_n:
+                heapq.heappush(self.slowest, item)
+            elif item > self.slowest[0]:
+                heapq.heapreplace(self.slowest, item)
+
+    def measure_round_trip(self, conn, samples=5):
+        """ Estimate the network round trip on conn as the fastest of a few trivial queries. """
+        timings = []
+        with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+            for _ in range(samples):
+                started = time.perf_counter()
+                cursor.execute("SELECT 1;")
+                timings.append(time.perf_counter() - started)
+        self.round_trip = min(timings)
+
+    def report(self):
+        """
+        Return the profile as a JSON-serialisable dictionary.
+
+        Statement time is the time spent waiting on the driver, summed over every connection.
+        Network time is estimated as one measured round trip per statement and the rest of the
+        statement time is attributed to the server; client time is the remaining wall time.
+        """
+        wall = time.perf_counter() - self.started
+        connect = self.categories.get("connect", {}).get("seconds", 0.0)
+        network = min((self.round_trip or 0.0) * self.round_trips, self.statement_seconds - connect)
+        labels = [f"<={bound}ms" for bound in PROFILE_BUCKETS_MS] + [f">{PROFILE_BUCKETS_MS[-1]}ms"]
+        return {
+            "wall_seconds": wall,
+            "split_seconds": {
+                "client": max(wall - self.statement_seconds, 0.0),
+                "connect": connect,
+                "network": network,
+                "server": max(self.statement_seconds - connect - network, 0.0),
+            },
+            "round_trip_seconds": self.round_trip,
+            "statements": sum(entry["count"] for name, entry in self.categories.items()
+                              if name not in ("connect", "pipeline")),
+            "categories": {
+                name: {
+                    "count": entry["count"],
+                    "seconds": entry["seconds"],
+                    "mean_seconds": entry["seconds"] / entry["count"],
+                    "max_seconds": entry["max_seconds"],
+                    "histogram": {label: count for label, count in zip(labels, entry["buckets"]) if count},
+                }
+                for name, entry in sorted(self.categories.items(), key=lambda item: -item[1]["seconds"])
+            },
+            "slowest": [{"seconds": seconds, "category": category, "target": target, "statement": statement}
+                        for seconds, category, target, statement in sorted(self.slowest, reverse=True)],
+        }
+
+
+def log_profile(report):
+    """ Log a run profile produced by Profile.report. """
+    split = report["split_seconds"]
+    logging.info("Run profile: %.3fs wall, %d statements; client %.3fs, connect %.3fs, network ~%.3fs, server ~%.3fs.",
+                 report["wall_seconds"], report["statements"], split["client"], split["connect"],
+                 split["network"], split["server"])
+    for name, entry in report["categories"].items():
+        logging.info("  %-24s %8d statements %9.3fs total %8.2fms mean %8.2fms max  %s", name, entry["count"],
+                     entry["seconds"], entry["mean_seconds"] * 1000, entry["max_seconds"] * 1000,
+                     " ".join(f"{label}:{count}" for label, count in entry["histogram"].items()))
+    logging.info("Slowest statements:")
+    for entry in report["slowest"]:
+        logging.info("  %8.2fms %-24s %s", entry["seconds"] * 1000, entry["category"], entry["statement"])
+
+
+class Metrics:
+    """
+    Counters and task timings of one run, written as an OpenMetrics textfile for the
+    node_exporter textfile collector.
+
+    Every value describes the run that wrote the file, so all metrics are gauges: a cron or CI
+    run replaces the file and alerts compare the latest values rather than rates.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.statements = collections.Counter()
+        self.skipped = collections.Counter()
+        # {(host, port, database, task): (seconds, failures, finished timestamp)}
+        self.tasks = {}
+        # {(host, port): (paused seconds, parked worker seconds)}
+        self.throttled = {}
+        self.lock = threading.Lock()
+
+    def count_statement(self, kind):
+        with self.lock:
+            self.statements[kind] += 1
+
+    def count_skipped(self, kind, count=1):
+        with self.lock:
+            self.skipped[kind] += count
+
+    def record_task(self, args, seconds, failures):
+        """ Record one run of args.task; failures is the number of failed statements, or None if it raised. """
+        with self.lock:
+            self.tasks[(args.host, args.port, args.dbname, args.task)] = (seconds, failures, time.time())
+
+    def record_throttle(self, host, port, paused_seconds, parked_seconds):
+        with self.lock:
+            self.throttled[(host, port)] = (paused_seconds, parked_seconds)
+
+    def render(self):
+        """ Return the metrics in the OpenMetrics text format. """
+        lines = []
+
+        def family(name, kind, help_text, samples, unit=None):
+            lines.append(f"# TYPE {name} {kind}")
+            if unit:
+                lines.append(f"# UNIT {name} {unit}")
+            lines.append(f"# HELP {name} {help_text}")
+            for labels, value in samples:
+                rendered = ",".join(f'{key}="{escape_label(value)}"' for key, value in labels)
+                lines.append(f"{name}{{{rendered}}} {value}" if rendered else f"{name} {value}")
+
+        with self.lock:
+            family("db_permissions_statements", "gauge", "Statements sent to the server in the last run, by kind.",
+                   [((("kind", kind),), count) for kind, count in sorted(self.statements.items())])
+            family("db_permissions_skipped", "gauge",
+                   "Statements skipped in the last run because their object or grant already existed, by kind.",
+                   [((("kind", kind),), count) for kind, count in sorted(self.skipped.items())])
+            family("db_permissions_catalog_queries", "gauge", "Catalog queries issued in the last run.",
+                   [((), self.statements.get("catalog_probe", 0))])
+            tasks = sorted(self.tasks.items(), key=lambda item: tuple(str(value) for value in item[0]))
+            labelled = [((("host", host), ("port", port), ("database", database), ("task", task)), entry)
+                        for (host, port, database, task), entry in tasks]
+            family("db_permissions_task_duration_seconds", "gauge", "Duration of the last run of each task.",
+                   [(labels, f"{seconds:.6f}") for labels, (seconds, _, _) in labelled], unit="seconds")
+            family("db_permissions_task_failures", "gauge",
+                   "Statements that failed in the last run of each task, or 1 if the task aborted.",
+                   [(labels, 1 if failures is None else failures) for labels, (_, failures, _) in labelled])
+            family("db_permissions_task_success", "gauge", "1 if the last run of each task had no failures.",
+                   [(labels, 1 if failures == 0 else 0) for labels, (_, failures, _) in labelled])
+            family("db_permissions_task_last_run_timestamp_seconds", "gauge",
+                   "Unix time at which the last run of each task finished.",
+                   [(labels, f"{finished:.3f}") for labels, (_, _, finished) in labelled], unit="seconds")
+            throttled = sorted(self.throttled.items(), key=lambda item: str(item[0]))
+            family("db_permissions_throttled_seconds", "gauge",
+                   "Time the last run was held back by the replication lag and load throttle, by server: "
+                   "paused is wall time with all connections paused, parked is worker time of parked connections.",
+                   [((("host", host), ("port", port), ("reason", reason)), f"{seconds:.3f}")
+                    for (host, port), seconds_by_reason in throttled
+                    for reason, seconds in zip(("paused", "parked"), seconds_by_reason)], unit="seconds")
+            family("db_permissions_run_duration_seconds", "gauge", "Wall time of the whole run.",
+                   [((), f"{time.time() - self.started:.6f}")], unit="seconds")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """ Write the metrics to path atomically, so the collector never reads a partial file. """
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(temporary, path)
+
+
+def escape_label(value):
+    """ Escape a label value for the OpenMetrics text format. """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def record_statement(run, statement, seconds, round_trip=True, overlapped=False):
+    """ Record an executed statement in the profile and the metrics of run, when they are active. """
+    category, target = describe_statement(statement)
+    if run.profile is not None:
+        run.profile.record(statement, seconds, category, target, round_trip, overlapped)
+    if run.metrics is not None:
+        run.metrics.count_statement(category)
+
+
+def count_skipped(run, kind, count=1):
+    """ Count statements skipped because what they would create or grant is already in place. """
+    if run.metrics is not None and count:
+        run.metrics.count_skipped(kind, count)
+
+
+class ProfilingCursor(psycopg2.extensions.cursor):
+    """ Cursor recording every execute in the profile and the metrics of its run, when either is active. """
+
+    def execute(self, query, vars=None):
+        run = run_state(self.connection)
+        if run.profile is None and run.metrics is None:
+            return super().execute(query, vars)
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_statement(run, query, time.perf_counter() - started)
+
+
+class ProfilingConnection(psycopg2.extensions.connection):
+    """ Connection recording its own setup time in the profile of its run and handing out ProfilingCursor cursors. """
+
+    def __init__(self, *args, **kwargs):
+        started = time.perf_counter()
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = ProfilingCursor
+        self.run_state = None
+        # Recorded in the profile of the first run the connection is attached to
+        self.connect_seconds = time.perf_counter() - started
+
+    def attach(self, run):
+        """ Attach the connection to run, whose profile, metrics, error policy and throttles then apply to it. """
+        if run is not None and run.profile is not None and self.connect_seconds is not None:
+            run.profile.record("connect", self.connect_seconds, "connect", self.info.dbname, round_trip=False)
+            self.connect_seconds = None
+        self.run_state = run
+
+
+def connect(args, dbname=None, **kwargs):
+    """
+    Open a psycopg2 connection to dbname (args.dbname by default) on the server args points at,
+    attached to the run of args.
+    """
+    conn = psycopg2.connect(host=args.host, port=args.port, user=args.username, dbname=dbname or args.dbname,
+                            connection_factory=ProfilingConnection, **kwargs)
+    conn.attach(getattr(args, "run_state", None))
+    return conn
+
+
+# Statements PostgreSQL refuses to run inside a transaction block
+NON_TRANSACTIONAL_STATEMENT = re.compile(
+    r"\s*((CREATE|DROP)\s+DATABASE|ALTER\s+SYSTEM|VACUUM|(CREATE|DROP|REINDEX)\s.*\bCONCURRENTLY\b)",
+    re.IGNORECASE | re.DOTALL,
+)
+
+
+class TransactionBatchCursor(ProfilingCursor):
+    """
+    Cursor grouping statements into transactions of batch_size statements instead of autocommitting each.
+
+    Every statement runs under its own savepoint. A failing statement is rolled back to that
+    savepoint and its error raised as usual, so the statements before it stay in the open
+    transaction. Statements that cannot run in a transaction commit the open batch and run
+    in autocommit. The open batch is committed by commit() and close().
+    """
+    batch_size = 1
+    pending = 0
+    holding_savepoint = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Statements of the open batch waiting for its commit to be journaled, see Journal.record
+        self.journal = None
+        self.journaled = []
+
+    def execute(self, query, vars=None):
+        if NON_TRANSACTIONAL_STATEMENT.match(query):
+            self.commit()
+            self.connection.autocommit = True
+            try:
+                return super().execute(query, vars)
+            finally:
+                self.connection.autocommit = False
+
+        # The savepoint travels in the same round trip as the statement. A read keeps its
+        # savepoint until the next statement, so that its rows stay fetchable
+        read = query.lstrip()[:6].upper() == "SELECT"
+        release = "RELEASE SAVEPOINT batch_statement;\n" if self.holding_savepoint else ""
+        self.holding_savepoint = False
+        try:
+            super().execute(f"{release}SAVEPOINT batch_statement;\n{query}\n;"
+                            f"{'' if read else 'RELEASE SAVEPOINT batch_statement;'}", vars)
+        except psycopg2.Error:
+            super().execute("ROLLBACK TO SAVEPOINT batch_statement; RELEASE SAVEPOINT batch_statement;")
+            raise
+        if read:
+            self.holding_savepoint = True
+            return None
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.commit()
+        return None
+
+    def commit(self):
+        """ Commit the open batch, if any. """
+        if self.connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            self.connection.commit()
+        self.pending = 0
+        self.holding_savepoint = False
+        if self.journaled:
+            self.journal.record_many(self.journaled)
+            self.journaled = []
+
+    def close(self):
+        if not self.closed and not self.connection.closed:
+            self.commit()
+        super().close()
+
+
+def open_cursor(conn, args):
+    """
+    Open a cursor on an autocommit connection, a RetryingCursor under --continue_on_error.
+
+    With --transaction_batch N, the connection leaves autocommit and the cursor commits
+    every N statements instead, see TransactionBatchCursor.
+    """
+    batch_size = getattr(args, "transaction_batch", 0) or 0
+    if batch_size <= 0:
+        # Under --continue_on_error, retryable failures are retried on a fresh connection
+        policy = run_state(args).error_policy
+        return RetryingCursor(conn, args, policy) if policy is not None else conn.cursor()
+    conn.autocommit = False
+    cursor = conn.cursor(cursor_factory=TransactionBatchCursor)
+    cursor.batch_size = batch_size
+    return cursor
+
+
+def commit_batch(cursor):
+    """ Commit the statements a TransactionBatchCursor holds open; autocommit cursors have none. """
+    if isinstance(cursor, TransactionBatchCursor):
+        cursor.commit()
+
+
+# SQLSTATEs worth retrying, see RetryingCursor: lock and serialization conflicts, cancelled
+# statements, server restarts and failovers. Class 08 (connection exceptions) is retried as a whole
+RETRYABLE_SQLSTATES = {
+    "40001",  # serialization_failure
+    "40P01",  # deadlock_detected
+    "40003",  # statement_completion_unknown
+    "55P03",  # lock_not_available, raised by lock_timeout
+    "57014",  # query_canceled, raised by statement_timeout
+    "57P01", "57P02", "57P03",  # admin_shutdown, crash_shutdown, cannot_connect_now
+    "53300",  # too_many_connections
+    "25006",  # read_only_sql_transaction, a primary demoted by a failover
+}
+RETRYABLE_SQLSTATE_CLASSES = {"08"}
+
+# SQLSTATEs caused by one bad row of the parameter file; the statement is skipped and the run goes on
+SKIPPABLE_SQLSTATES = {
+    "42P01",  # undefined_table
+    "42704",  # undefined_object, e.g. a missing role
+    "3F000",  # invalid_schema_name
+    "42710", "42P04", "42P06", "42P07",  # duplicate object, database, schema, table
+    "42601", "42602", "42622",  # syntax_error, invalid_name, name_too_long: malformed names
+    "0LP01",  # invalid_grant_operation
+    "42809",  # wrong_object_type
+}
+
+# Errors raised by either driver; the pipeline backend runs on psycopg 3
+DATABASE_ERRORS = (psycopg2.Error,) if psycopg is None else (psycopg2.Error, psycopg.Error)
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError) + (
+    () if psycopg is None else (psycopg.OperationalError, psycopg.InterfaceError))
+
+
+def error_sqlstate(error):
+    """ Return the SQLSTATE of a psycopg2 or psycopg 3 error, or None. """
+    return getattr(error, "pgcode", None) or getattr(error, "sqlstate", None)
+
+
+def classify_error(sqlstate, error=None):
+    """
+    Classify an error as "retryable", "skippable" or "fatal" from its SQLSTATE.
+
+    Errors without one are connection failures when they are OperationalError or InterfaceError.
+    """
+    if not sqlstate:
+        return "retryable" if isinstance(error, CONNECTION_ERRORS) else "fatal"
+    if sqlstate in RETRYABLE_SQLSTATES or sqlstate[:2] in RETRYABLE_SQLSTATE_CLASSES:
+        return "retryable"
+    if sqlstate in SKIPPABLE_SQLSTATES:
+        return "skippable"
+    return "fatal"
+
+
+class ErrorPolicy:
+    """
+    Continue-on-error policy of a run.
+
+    Retryable errors are retried by RetryingCursor; every error that reaches a caller is
+    recorded with the parameter key or CSV line of its step, and skippable ones, along with
+    retryable ones whose retries ran out on a live connection, let the run go on.
+    """
+
+    def __init__(self, retries=3, backoff=1.0):
+        self.retries = retries
+        self.backoff = backoff
+        self.failures = []
+        self.lock = threading.Lock()
+        # Statements skipped on the current thread, so dispatch_task can count them as failed
+        self.local = threading.local()
+
+    def record(self, target, statement, source, sqlstate, message, attempts=1, error=None):
+        """ Record a failed statement and return its classification. """
+        classification = classify_error(sqlstate, error)
+        with self.lock:
+            self.failures.append({
+                "target": target, "source": "" if source is None else str(source), "sqlstate": sqlstate or "",
+                "classification": classification, "attempts": attempts,
+                "statement": " ".join(statement.split())[:200], "message": " ".join(message.split()),
+            })
+        return classification
+
+    def skip(self, cursor, statement, source, error):
+        """
+        Record an error raised by cursor and return True when the run should go on without the statement.
+        """
+        sqlstate = error_sqlstate(error)
+        classification = self.record(describe_connection(cursor.connection), statement, source, sqlstate,
+                                     str(error), getattr(error, "attempts", 1), error)
+        if classification == "skippable" or (classification == "retryable" and not cursor.connection.closed):
+            logging.error("Skipping %s (from %s, SQLSTATE %s): %s", statement, source, sqlstate,
+                          " ".join(str(error).split()))
+            self.local.skipped = self.skipped() + 1
+            return True
+        return False
+
+    def skipped(self):
+        """ Return the number of statements skipped on the current thread. """
+        return getattr(self.local, "skipped", 0)
+
+    def add_skipped(self, count):
+        """ Count statements that worker threads skipped against the current thread. """
+        self.local.skipped = self.skipped() + count
+
+
+def describe_connection(conn):
+    """ Return host:port/database for a psycopg2 or psycopg 3 connection. """
+    return f"{conn.info.host}:{conn.info.port}/{conn.info.dbname}"
+
+
+def execute_step(cursor, step):
+    """
+    Execute one plan step. Under the error policy, a skippable failure is recorded against the
+    step's source and the step reported as not executed instead of raising.
+    """
+    try:
+        cursor.execute(step.statement)
+        return True
+    except DATABASE_ERRORS as e:
+        policy = run_state(cursor).error_policy
+        if policy is None or not policy.skip(cursor, step.statement, step.source, e):
+            raise
+        return False
+
+
+# Session settings RetryingCursor carries over to a new connection
+SESSION_SETTING_PATTERN = re.compile(r"\s*(SET|RESET)\s+(ROLE|lock_timeout)\b", re.IGNORECASE)
+
+# Retryable SQLSTATEs only a new connection gets past: server shutdowns and a primary demoted by a
+# failover. Class 08 (connection exceptions) and errors without a SQLSTATE reconnect too; psycopg2
+# raises lock, serialization and cancellation errors as OperationalError, so the class alone says nothing
+RECONNECT_SQLSTATES = {"57P01", "57P02", "57P03", "25006"}
 
-    Checks the pg_roles catalog to see if the user exists, and if not, creates the user.
+
+class RetryingCursor:
+    """
+    Cursor retrying statements that fail with a retryable error.
+
+    Retries wait with exponential backoff and jitter, as run_target_with_retries does for
+    whole targets. Lock and serialization conflicts are retried on the same connection; a lost
+    connection is replaced by a fresh autocommit one owned by the cursor, on which the
+    session's role and lock_timeout are replayed. The caller's connection is never closed.
+    Errors whose SQLSTATE is in deferred_sqlstates are raised at once, for the caller to
+    reschedule. Other attributes are those of the underlying cursor.
     """
-    if not user:
+
+    def __init__(self, conn, args, policy):
+        self.args = args
+        self.policy = policy
+        self.dbname = conn.info.dbname
+        self.cursor = conn.cursor()
+        self.owned = None
+        # {setting: last SET statement}, replayed in order after a reconnection
+        self.session = {}
+        self.deferred_sqlstates = set()
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def execute(self, query, vars=None):
+        attempt = 1
+        while True:
+            try:
+                result = self.cursor.execute(query, vars)
+                break
+            except psycopg2.Error as e:
+                if (attempt > self.policy.retries or e.pgcode in self.deferred_sqlstates
+                        or classify_error(e.pgcode, e) != "retryable"):
+                    e.attempts = attempt
+                    raise
+                fresh = (self.cursor.connection.closed or not e.pgcode or e.pgcode[:2] == "08"
+                         or e.pgcode in RECONNECT_SQLSTATES)
+                delay = self.policy.backoff * 2 ** (attempt - 1) + random.uniform(0, self.policy.backoff)
+                logging.warning("Retryable error (SQLSTATE %s) on attempt %d, retrying on %s connection "
+                                "in %.1f seconds: %s", e.pgcode, attempt, "a fresh" if fresh else "the same", delay,
+                                " ".join(str(e).split()))
+                time.sleep(delay)
+                attempt += 1
+                if fresh:
+                    self.reconnect()
+        setting = SESSION_SETTING_PATTERN.match(query) if isinstance(query, str) else None
+        if setting is not None:
+            if setting.group(1).upper() == "SET":
+                self.session[setting.group(2).lower()] = query
+            else:
+                self.session.pop(setting.group(2).lower(), None)
+        return result
+
+    def reconnect(self):
+        """
+        Replace the connection with one the cursor owns. The previous one is closed only when the
+        cursor owns it; a failed reconnection leaves the lost connection for the next attempt to fail on.
+        """
+        try:
+            conn = connect(self.args, self.dbname)
+            conn.autocommit = True
+            cursor = conn.cursor()
+            for statement in self.session.values():
+                cursor.execute(statement)
+        except psycopg2.Error as e:
+            logging.warning("Could not reconnect to %s: %s", self.dbname, " ".join(str(e).split()))
+            return
+        if self.owned is not None:
+            self.owned.close()
+        self.owned = conn
+        self.cursor = cursor
+
+    def close(self):
+        self.cursor.close()
+        if self.owned is not None:
+            self.owned.close()
+
+
+def log_failure_report(failures):
+    """ Log the failures recorded by the error policy, one line each. """
+    if not failures:
+        logging.info("Failure report: no failed statements.")
         return
-    # Check if user already exists
-    cursor.execute("SELECT 1 FROM pg_roles WHERE rolname = %s", (user,))
-    if cursor.fetchone():
-        logging.info("User %s already exists. Skipping.", user)
-    else:
-        logging.info("Creating user %s...", user)
-        # Create the user
-        cursor.execute(f"CREATE USER {user};")
+    counts = collections.Counter(failure["sqlstate"] or "-" for failure in failures)
+    logging.info("Failure report: %d failed statements (%s).", len(failures),
+                 ", ".join(f"{sqlstate} x{count}" for sqlstate, count in counts.most_common()))
+    for failure in failures:
+        logging.info("  %s row %s: SQLSTATE %s, %s after %d attempts: %s -- %s", failure["target"], failure["source"],
+                     failure["sqlstate"] or "-", failure["classification"], failure["attempts"],
+                     failure["statement"], failure["message"])
+
+
+# Replication lag, in bytes and seconds, and active client sessions of the server. On a
+# primary the lag is that of its slowest standby; on a standby, its own replay lag
+THROTTLE_SAMPLE_QUERY = """
+    SELECT CASE WHEN pg_is_in_recovery()
+                THEN COALESCE(pg_wal_lsn_diff(pg_last_wal_receive_lsn(), pg_last_wal_replay_lsn()), 0)
+                ELSE (SELECT COALESCE(max(pg_wal_lsn_diff(pg_current_wal_lsn(), replay_lsn)), 0)
+                      FROM pg_stat_replication)
+           END,
+           CASE WHEN pg_is_in_recovery()
+                THEN COALESCE(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)
+                ELSE (SELECT COALESCE(max(extract(epoch FROM replay_lag)), 0) FROM pg_stat_replication)
+           END,
+           (SELECT count(*) FROM pg_stat_activity
+            WHERE state = 'active' AND backend_type = 'client backend' AND pid <> pg_backend_pid())
+"""
+
+# Statements sent between two throttle samples: the initial burst, and its bounds as the throttle
+# halves it while the server is over a ceiling and grows it back while it is well under all of them
+THROTTLE_INITIAL_BURST = 100
+THROTTLE_MIN_BURST = 10
+THROTTLE_MAX_BURST = 10000
+
+class Throttle:
+    """
+    Adaptive throttle of the statements sent to one server.
+
+    Replication lag and active sessions are sampled every interval seconds, or sooner once a
+    burst of statements has been sent. While a sample is over a ceiling every connection to
+    the server pauses, and the burst and the number of workers allowed to send are halved;
+    while all samples stay under half their ceiling they grow back, the burst additively
+    and the workers one at a time.
+    """
+
+    def __init__(self, host, port, user, dbname, settings):
+        self.dsn = dict(host=host, port=port, user=user, dbname=dbname)
+        self.settings = settings
+        self.conn = None
+        self.burst = THROTTLE_INITIAL_BURST
+        self.concurrency = settings.workers
+        self.sent = 0
+        # The first statement samples the server, so a run never starts on an overloaded one
+        self.sampled = float("-inf")
+        self.pauses = 0
+        self.paused_seconds = 0.0
+        self.parked_seconds = 0.0
+        self.peak = (0, 0.0, 0)
+        self.lock = threading.Lock()
+
+    def admit(self, worker=0, statements=1):
+        """ Wait until worker may send statements to the server. """
+        while True:
+            with self.lock:
+                if self.sent >= self.burst or time.monotonic() - self.sampled >= self.settings.interval:
+                    self.adjust()
+                if worker < self.concurrency:
+                    self.sent += statements
+                    return
+            # Parked workers keep sampling, as the workers still sending may all be idle
+            parked = time.monotonic()
+            time.sleep(self.settings.interval)
+            with self.lock:
+                self.parked_seconds += time.monotonic() - parked
+
+    def adjust(self):
+        """ Sample the server, pausing while it is over a ceiling. Called with the lock held. """
+        self.sent = 0
+        sample = self.sample()
+        if sample is not None and self.over(sample):
+            self.pauses += 1
+            paused = time.monotonic()
+            logging.warning("%s:%s is over the throttle ceiling (lag %d bytes / %.1f seconds, %d active sessions), "
+                            "pausing.", self.dsn["host"], self.dsn["port"], *sample)
+            while sample is not None and self.over(sample):
+                self.burst = max(THROTTLE_MIN_BURST, self.burst // 2)
+                self.concurrency = max(1, self.concurrency // 2)
+                time.sleep(self.settings.interval)
+                sample = self.sample()
+            self.paused_seconds += time.monotonic() - paused
+            logging.info("Resuming with bursts of %d statements over %d connections.", self.burst, self.concurrency)
+        elif sample is not None and self.relaxed(sample):
+            self.burst = min(THROTTLE_MAX_BURST, self.burst + THROTTLE_INITIAL_BURST)
+            self.concurrency = min(self.settings.workers, self.concurrency + 1)
+        self.sampled = time.monotonic()
+
+    def sample(self):
+        """ Return (lag bytes, lag seconds, active sessions), or None if the server could not be sampled. """
+        try:
+            if self.conn is None or self.conn.closed:
+                self.conn = psycopg2.connect(**self.dsn)
+                self.conn.autocommit = True
+            with self.conn.cursor() as cursor:
+                cursor.execute(THROTTLE_SAMPLE_QUERY)
+                lag_bytes, lag_seconds, active = cursor.fetchone()
+        except psycopg2.Error as e:
+            logging.warning("Could not sample %s:%s for throttling: %s", self.dsn["host"], self.dsn["port"], e)
+            self.conn = None
+            return None
+        sample = (int(lag_bytes), float(lag_seconds), active)
+        self.peak = tuple(max(peak, value) for peak, value in zip(self.peak, sample))
+        return sample
+
+    def over(self, sample):
+        return any(ceiling and value > ceiling for value, ceiling in zip(sample, self.ceilings()))
+
+    def relaxed(self, sample):
+        return all(not ceiling or value < ceiling / 2 for value, ceiling in zip(sample, self.ceilings()))
+
+    def ceilings(self):
+        return (self.settings.max_lag_bytes, self.settings.max_lag_seconds, self.settings.max_active_sessions)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+
+class Throttles:
+    """ The Throttle of every server a run sends statements to, created on first use. """
+
+    def __init__(self, args):
+        self.settings = argparse.Namespace(
+            max_lag_bytes=getattr(args, "max_replication_lag_bytes", 0) or 0,
+            max_lag_seconds=getattr(args, "max_replication_lag", 0) or 0,
+            max_active_sessions=getattr(args, "max_active_sessions", 0) or 0,
+            interval=getattr(args, "throttle_interval", 1.0),
+            workers=max(getattr(args, "workers", 1), 1),
+        )
+        self.throttles = {}
+        self.lock = threading.Lock()
+
+    def for_connection(self, conn):
+        info = conn.info
+        with self.lock:
+            key = (info.host, info.port)
+            if key not in self.throttles:
+                self.throttles[key] = Throttle(info.host, info.port, info.user, info.dbname, self.settings)
+            return self.throttles[key]
+
+    def report(self, metrics=None):
+        """ Log the time each server spent throttled, record it in metrics, if given, and close the samplers. """
+        for (host, port), throttle in sorted(self.throttles.items(), key=lambda item: str(item[0])):
+            logging.info("Throttled %s:%s for %.1f seconds in %d pauses, with workers parked for %.1f seconds "
+                         "(peak lag %d bytes / %.1f seconds, peak %d active sessions).", host, port,
+                         throttle.paused_seconds, throttle.pauses, throttle.parked_seconds, *throttle.peak)
+            if metrics is not None:
+                metrics.record_throttle(host, port, throttle.paused_seconds, throttle.parked_seconds)
+            throttle.close()
+
+
+def throttle(conn, worker=0, statements=1):
+    """ Wait, when the run of conn is throttled, until worker may send statements on conn. """
+    throttles = run_state(conn).throttles
+    if throttles is not None:
+        throttles.for_connection(conn).admit(worker, statements)
+
+
+def report_throttles(args):
+    """ Report the throttling of the run of args, when it is throttled. """
+    run = run_state(args)
+    if run.throttles is not None:
+        run.throttles.report(run.metrics)
+
+
+class RunState:
+    """
+    Profile, metrics, error policy and throttles of one run, each None unless its options ask for it.
+
+    main creates one per run, daemon jobs included, and hands it down as args.run_state. connect
+    attaches it to the connections it opens, so code holding only a cursor finds it too, and
+    concurrent runs of a daemon never see each other's state.
+    """
+
+    def __init__(self, profile=None, metrics=None, error_policy=None, throttles=None):
+        self.profile = profile
+        self.metrics = metrics
+        self.error_policy = error_policy
+        self.throttles = throttles
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(
+            profile=Profile(getattr(args, "profile_top", 10)) if (
+                getattr(args, "profile", False) or getattr(args, "profile_json", None)) else None,
+            metrics=Metrics() if getattr(args, "metrics_file", None) else None,
+            error_policy=ErrorPolicy(getattr(args, "retries", 3), getattr(args, "retry_backoff", 1.0)) if (
+                getattr(args, "continue_on_error", False)) else None,
+            throttles=Throttles(args) if any(getattr(args, ceiling, 0) for ceiling in (
+                "max_replication_lag", "max_replication_lag_bytes", "max_active_sessions")) else None,
+        )
+
+
+# Run state of code called outside main, e.g. from tests: nothing is profiled, metered, skipped or throttled
+NO_RUN_STATE = RunState()
+
+
+def run_state(holder):
+    """ Return the RunState of args, a connection or a cursor, or NO_RUN_STATE when it belongs to no run. """
+    connection = getattr(holder, "connection", None)
+    return getattr(connection if connection is not None else holder, "run_state", None) or NO_RUN_STATE
+
+
+def cluster_lock(args):
+    """
+    Return the lock guarding cluster-wide objects of the server args points at.
+
+    Roles and databases are shared by every database of a cluster, so concurrent runs against
+    the same server take turns changing them while runs against other servers proceed.
+    """
+    key = (getattr(args, "host", None), str(getattr(args, "port", "")))
+    with CLUSTER_LOCKS_GUARD:
+        return CLUSTER_LOCKS.setdefault(key, threading.Lock())
+
+
+def fold_identifier(name):
+    """
+    Return the name PostgreSQL stores for an identifier written in SQL:
+    unquoted identifiers are folded to lower case, quoted ones are taken verbatim.
+    """
+    name = name.strip()
+    if len(name) >= 2 and name.startswith('"') and name.endswith('"'):
+        return name[1:-1].replace('""', '"')
+    return name.lower()
+
+
+def fetch_roles(cursor):
+    """ Return the set of all role names in pg_roles. """
+    cursor.execute("SELECT rolname FROM pg_roles")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def fetch_memberships(cursor):
+    """ Return the set of (role, member) pairs in pg_auth_members. """
+    cursor.execute("""
+        SELECT r.rolname, u.rolname FROM pg_auth_members m
+        JOIN pg_roles r ON r.oid = m.roleid
+        JOIN pg_roles u ON u.oid = m.member
+    """)
+    return {(role, member) for role, member in cursor.fetchall()}
+
+
+def load_catalog_snapshot(cursor):
+    """
+    Load all roles, role memberships and schemas in three queries.
+
+    The snapshot answers the existence checks of create_user, create_role, create_schema
+    and is_role_assigned from memory, and is kept up to date as those helpers create objects.
+    """
+    snapshot = {}
+    refresh_catalog_snapshot(cursor, snapshot)
+    return snapshot
+
+
+def refresh_catalog_snapshot(cursor, snapshot):
+    """ Reload a snapshot in place from the catalog. """
+    snapshot["roles"] = fetch_roles(cursor)
+    snapshot["memberships"] = fetch_memberships(cursor)
+    cursor.execute("SELECT nspname FROM pg_namespace")
+    snapshot["schemas"] = {row[0] for row in cursor.fetchall()}
+    snapshot["stale"] = False
+    logging.info("Catalog snapshot loaded: %d roles, %d memberships, %d schemas.",
+                 len(snapshot["roles"]), len(snapshot["memberships"]), len(snapshot["schemas"]))
+
+
+def invalidate_catalog_snapshot(snapshot):
+    """ Mark a snapshot as stale so it is reloaded before its next lookup. """
+    snapshot["stale"] = True
+
+
+def snapshot_contains(cursor, snapshot, kind, key):
+    """ Look up a role, membership or schema in the snapshot, reloading it first if it is stale. """
+    if snapshot.get("stale", True):
+        refresh_catalog_snapshot(cursor, snapshot)
+    return key in snapshot[kind]
 
-def create_role(cursor, role):
+
+def execute_single_step(cursor, statement, category, obj, grantee=None, privileges=None, guard=None,
+                        snapshot=None):
+    """
+    Execute one plan step built on the spot, as execute_plan does, skipping it when its guard
+    already holds. Returns the number of statements executed.
+    """
+    return execute_plan(cursor, [PlanStep(0, statement, category, obj, grantee, privileges, (), guard, None)],
+                        snapshot)
+
+
+def create_user(cursor, user, snapshot=None):
+    """
+    Create a PostgreSQL user if it does not already exist.
+
+    Checks the pg_roles catalog (or the catalog snapshot, when given) through the step's guard.
+    """
+    if user:
+        execute_single_step(cursor, f"CREATE USER {user};", "create_user", user, guard=("role", user),
+                            snapshot=snapshot)
+
+def create_role(cursor, role, snapshot=None):
     """
     Create a PostgreSQL role if it does not already exist.
 
-    Checks the pg_roles catalog to see if the role exists, and if not, creates the role.
+    Checks the pg_roles catalog (or the catalog snapshot, when given) through the step's guard.
     """
-    if not role:
-        return
-    # Check if role already exists
-    cursor.execute("SELECT 1 FROM pg_roles WHERE rolname = %s", (role,))
-    if cursor.fetchone():
-        logging.info("Role %s already exists. Skipping.", role)
-    else:
-        logging.info("Creating role %s...", role)
-        # Create the role
-        cursor.execute(f"CREATE ROLE {role};")
+    if role:
+        execute_single_step(cursor, f"CREATE ROLE {role};", "create_role", role, guard=("role", role),
+                            snapshot=snapshot)
 
-def create_schema(cursor, schema, owner):
+def create_schema(cursor, schema, owner, snapshot=None):
     """
     Create a database schema if it does not already exist.
 
     The schema is created with the specified owner.
     """
-    # Check if the schema already exists in the database
-    cursor.execute("SELECT schema_name FROM information_schema.schemata WHERE schema_name = %s", (schema,))
-    if cursor.fetchone():
-        logging.info("Schema %s already exists. Skipping.", schema)
-    else:
-        logging.info("Creating schema %s with owner %s...", schema, owner)
-        # Create the schema with the given owner
-        cursor.execute(f"CREATE SCHEMA {schema} AUTHORIZATION {owner};")
+    execute_single_step(cursor, f"CREATE SCHEMA {schema} AUTHORIZATION {owner};", "create_schema", schema,
+                        grantee=owner, guard=("schema", schema), snapshot=snapshot)
 
 def alter_database_owner(cursor, database, owner):
-    # Determine the current user of the session
-    cursor.execute("SELECT session_user;")
-    session_user = cursor.fetchone()[0]
-
-    # If the current user does not match the owner, we execute GRANT
-    if session_user != owner:
-        logging.info("Granting access %s to session user.", database)
-        cursor.execute(f"GRANT {owner} TO SESSION_USER;")
-
-    logging.info("Setting owner of database %s to %s...", database, owner)
-    cursor.execute(f"ALTER DATABASE {database} OWNER TO {owner};")
+    """ Change the owner of a database, granting the owner to the session user first unless they are the same. """
+    execute_single_step(cursor, f"GRANT {owner} TO SESSION_USER;", "grant_session_user", owner,
+                        guard=("session_user", owner))
+    execute_single_step(cursor, f"ALTER DATABASE {database} OWNER TO {owner};", "alter_database_owner", database,
+                        grantee=owner)
 
-def is_role_assigned(cursor, role, user):
+def is_role_assigned(cursor, role, user, snapshot=None):
     """
     Check if a user already has a specific role.
     """
+    if snapshot is not None:
+        return snapshot_contains(cursor, snapshot, "memberships", (fold_identifier(role), fold_identifier(user)))
     cursor.execute("""
         SELECT 1 FROM pg_roles r
         JOIN pg_auth_members m ON r.oid = m.roleid
@@ -193,102 +1162,49 @@ def is_role_assigned(cursor, role, user):
     """, (role, user))
     return cursor.fetchone() is not None
 
-def grant_role_to_user(cursor, role, user):
+def grant_role_to_user(cursor, role, user, snapshot=None):
     """
     Grant a specific role to a user if it is not already assigned.
     """
     if role and user:
-        if is_role_assigned(cursor, role, user):
-            logging.info("Role %s is already assigned to user %s. Skipping.", role, user)
-        else:
-            logging.info("Granting role %s to user %s...", role, user)
-            cursor.execute(f"GRANT {role} TO {user};")
-
-def grant_usage_on_schema(cursor, schema, role):
-    logging.info("Granting USAGE on schema %s to %s...", schema, role)
-    cursor.execute(f"GRANT USAGE ON SCHEMA {schema} TO {role};")
-
-def grant_usage_on_sequence(cursor, schema, role):
-    logging.info("Granting USAGE on all sequences in schema %s to %s...", schema, role)
-    cursor.execute(f"GRANT USAGE ON ALL SEQUENCES IN SCHEMA {schema} TO {role};")
-    cursor.execute(f"ALTER DEFAULT PRIVILEGES IN SCHEMA {schema} GRANT USAGE ON SEQUENCES TO {role};")
-
-def grant_create_on_schema(cursor, schema, role):
-    logging.info("Granting CREATE on schema %s to %s...", schema, role)
-    cursor.execute(f"GRANT CREATE ON SCHEMA {schema} TO {role};")
-
-def grant_select_on_tables(cursor, schema, role):
-    logging.info("Granting SELECT on all tables in schema %s to %s...", schema, role)
-    cursor.execute(f"GRANT SELECT ON ALL TABLES IN SCHEMA {schema} TO {role};")
-    cursor.execute(f"ALTER DEFAULT PRIVILEGES IN SCHEMA {schema} GRANT SELECT ON TABLES TO {role};")
-
-def grant_select_on_sequences(cursor, schema, role):
-    logging.info("Granting SELECT on all sequences in schema %s to %s...", schema, role)
-    cursor.execute(f"GRANT SELECT ON ALL SEQUENCES IN SCHEMA {schema} TO {role};")
-    cursor.execute(f"ALTER DEFAULT PRIVILEGES IN SCHEMA {schema} GRANT SELECT ON SEQUENCES TO {role};")
-
-def grant_insert_update_delete_on_tables(cursor, schema, role):
-    logging.info("Granting INSERT, UPDATE, DELETE on all tables in schema %s to %s...", schema, role)
-    cursor.execute(f"GRANT INSERT, UPDATE, DELETE ON ALL TABLES IN SCHEMA {schema} TO {role};")
-    cursor.execute(f"ALTER DEFAULT PRIVILEGES IN SCHEMA {schema} GRANT INSERT, UPDATE, DELETE ON TABLES TO {role};")
-
-def grant_update_on_sequences(cursor, schema, role):
-    logging.info("Granting UPDATE on all sequences in schema %s to %s...", schema, role)
-    cursor.execute(f"GRANT UPDATE ON ALL SEQUENCES IN SCHEMA {schema} TO {role};")
-    cursor.execute(f"ALTER DEFAULT PRIVILEGES IN SCHEMA {schema} GRANT UPDATE ON SEQUENCES TO {role};")
-
-def grant_truncate_on_tables(cursor, schema, role):
-    logging.info("Granting TRUNCATE on all tables in schema %s to %s...", schema, role)
-    cursor.execute(f"GRANT TRUNCATE ON ALL TABLES IN SCHEMA {schema} TO {role};")
-    cursor.execute(f"ALTER DEFAULT PRIVILEGES IN SCHEMA {schema} GRANT TRUNCATE ON TABLES TO {role};")
-
-
-def grant_full_permissions(cursor, role, tables):
-    """ Grants SELECT, INSERT, UPDATE, DELETE permissions on tables. """
-    for table in tables:
-        logging.info("Granting SELECT, INSERT, UPDATE, DELETE on %s to %s...", table, role)
-        cursor.execute(f"GRANT SELECT, INSERT, UPDATE, DELETE ON {table} TO {role};")
+        execute_single_step(cursor, f"GRANT {role} TO {user};", "grant_membership", role, grantee=user,
+                            guard=("membership", (role, user)), snapshot=snapshot)
 
+def schema_privilege_statements(kind, privileges, schema, role):
+    """
+    Build the statements granting privileges at schema level, as (category, statement) pairs.
 
-def grant_select_usage_permissions(cursor, role, tables):
-    """ Grants SELECT and USAGE permissions (for schemas or sequences). """
-    for table in tables:
-        logging.info("Granting SELECT, USAGE on %s to %s...", table, role)
-        cursor.execute(f"GRANT SELECT, USAGE ON {table} TO {role};")
-
+    kind is "schema" for the schema itself, or "tables" / "sequences" for every existing
+    object of that kind in the schema plus the default privileges of objects created later.
+    """
+    if kind == "schema":
+        return [("schema_privileges", f"GRANT {privileges} ON SCHEMA {schema} TO {role};")]
+    keyword = "TABLES" if kind == "tables" else "SEQUENCES"
+    return [
+        (f"all_{kind}_privileges", f"GRANT {privileges} ON ALL {keyword} IN SCHEMA {schema} TO {role};"),
+        (f"default_{kind}_privileges",
+         f"ALTER DEFAULT PRIVILEGES IN SCHEMA {schema} GRANT {privileges} ON {keyword} TO {role};"),
+    ]
 
-def grant_select_permissions(cursor, role, tables):
-    """ Grants only SELECT permission on tables. """
-    for table in tables:
-        logging.info("Granting SELECT on %s to %s...", table, role)
-        cursor.execute(f"GRANT SELECT ON {table} TO {role};")
 
+def grant_schema_role(cursor, role_key, schemas, role):
+    """ Grant role, on each schema, the privileges compile_task gives the role_key role of SCHEMA_ROLE_GRANTS. """
+    grants = next(grants for key, _, grants in SCHEMA_ROLE_GRANTS if key == role_key)
+    execute_plan(cursor, [PlanStep(0, statement, category, schema, role, privileges, (), None, None)
+                          for schema in schemas for kind, privileges in grants
+                          for category, statement in schema_privilege_statements(kind, privileges, schema, role)])
 
 def grant_role_cr(cursor, schemas, role):
-    for schema in schemas:
-        grant_usage_on_schema(cursor, schema, role)
-        grant_create_on_schema(cursor, schema, role)
+    grant_schema_role(cursor, "role_cr", schemas, role)
 
 def grant_role_ro(cursor, schemas, role):
-    for schema in schemas:
-        grant_usage_on_schema(cursor, schema, role)
-        grant_select_on_tables(cursor, schema, role)
-        grant_usage_on_sequence(cursor, schema, role)
-        grant_select_on_sequences(cursor, schema, role)
+    grant_schema_role(cursor, "role_ro", schemas, role)
 
 def grant_role_rw(cursor, schemas, role):
-    for schema in schemas:
-        grant_usage_on_schema(cursor, schema, role)
-        grant_select_on_tables(cursor, schema, role)
-        grant_insert_update_delete_on_tables(cursor, schema, role)
-        grant_usage_on_sequence(cursor, schema, role)
-        grant_select_on_sequences(cursor, schema, role)
-        grant_update_on_sequences(cursor, schema, role)
+    grant_schema_role(cursor, "role_rw", schemas, role)
 
 def grant_role_tr(cursor, schemas, role):
-    for schema in schemas:
-        grant_usage_on_schema(cursor, schema, role)
-        grant_truncate_on_tables(cursor, schema, role)
+    grant_schema_role(cursor, "role_tr", schemas, role)
 
 def set_role_to_session_user(cursor):
     """
@@ -299,163 +1215,2804 @@ def set_role_to_session_user(cursor):
     session_user = cursor.fetchone()[0]  # Fetch the session user
     logging.info("Current session user: %s", session_user)
 
-def process_grants(cursor, grant_parameters):
-    """Executes grant queries based on structured parameters."""
+# Privileges each schema-level role receives, per schema, in the order execute_task grants them.
+# Every entry is (object kind, privileges) where the object kind is "schema", "tables" or "sequences".
+SCHEMA_ROLE_GRANTS = [
+    ("role_cr", "schema_cr_list", [("schema", "USAGE"), ("schema", "CREATE")]),
+    ("role_ro", "schema_ro_list", [("schema", "USAGE"), ("tables", "SELECT"),
+                                   ("sequences", "USAGE"), ("sequences", "SELECT")]),
+    ("role_rw", "schema_rw_list", [("schema", "USAGE"), ("tables", "SELECT"),
+                                   ("tables", "INSERT, UPDATE, DELETE"), ("sequences", "USAGE"),
+                                   ("sequences", "SELECT"), ("sequences", "UPDATE")]),
+    ("role_tr", "schema_tr_list", [("schema", "USAGE"), ("tables", "TRUNCATE")]),
+]
 
-    grant_functions = {
-        "full": grant_full_permissions,
-        "select": grant_select_permissions,
-        "select_usage": grant_select_usage_permissions,
-    }
 
-    total_grants_executed = 0
-    prefix = "tables_to_receive_grant_"
+def compile_task(parameters, dbname):
+    """
+    Compile key/value parameters into the ordered, immutable plan execute_task carries out.
 
-    for permission_type, tables, role in grant_parameters:
-        grant_type = permission_type[len(prefix):]  # Extracts "full", "select", etc.
-        grant_function = grant_functions.get(grant_type)
+    Compilation is pure: nothing is read from or sent to the database. Steps that create users,
+    roles, schemas or memberships carry a guard so executors can skip objects that already exist,
+    and depends_on links every step to the earlier steps creating what it needs.
 
-        for table in {t.strip() for table_list in tables for t in table_list.split(",")}:  # Properly splits tables
-            grant_function(cursor, role, [table])
-            total_grants_executed += 1
-            
-    logging.info("Grants applied!")
-    logging.info("Executed %d grant statements successfully.", total_grants_executed)
+    Returns a tuple of PlanStep.
+    """
+    steps = []
+    creators = {}
 
+    def add(statement, category, obj, grantee=None, privileges=None, needs=(), guard=None, source=None):
+        depends_on = tuple(sorted({creators[need] for need in needs if need in creators}))
+        steps.append(PlanStep(len(steps), statement, category, obj, grantee, privileges, depends_on, guard, source))
+        return len(steps) - 1
+
+    def add_role(statement_prefix, category, name, source):
+        if name and ("role", fold_identifier(name)) not in creators:
+            creators[("role", fold_identifier(name))] = add(f"{statement_prefix} {name};", category, name, guard=("role", name), source=source)
+
+    def add_membership(role, member, source):
+        if role and member:
+            add(f"GRANT {role} TO {member};", "grant_membership", role, grantee=member,
+                needs=[("role", fold_identifier(role)), ("role", fold_identifier(member))],
+                guard=("membership", (role, member)), source=source)
 
-# Execute the task based on the parameters loaded from the CSV file
-def execute_task(cursor, parameters, args):
     # Create users along with db owner
-    user_list = parameters.get("user_owner", []) + parameters.get("another_users", [])
-    for user in user_list:
-        create_user(cursor, user)
+    for key in ("user_owner", "another_users"):
+        for user in parameters.get(key, []):
+            add_role("CREATE USER", "create_user", user, key)
 
-    # Change the database owner to 'user_owner' if specified
+    # Change the database owner to 'user_owner', granting it to the session user first
     owner = parameters["user_owner"][0]
-    if parameters.get("user_owner"):
-        alter_database_owner(cursor, args.dbname, owner)
+    owner_key = ("role", fold_identifier(owner))
+    creators[("session_user",)] = add(f"GRANT {owner} TO SESSION_USER;", "grant_session_user", owner,
+                                      needs=[owner_key], guard=("session_user", owner), source="user_owner")
+    add(f"ALTER DATABASE {dbname} OWNER TO {owner};", "alter_database_owner", dbname, grantee=owner,
+        needs=[owner_key, ("session_user",)], source="user_owner")
 
-    # Create schemas as specified in the 'schema_list' parameter with the owner from 'user_owner'
+    # Create schemas owned by 'user_owner'
     for schema in parameters.get("schema_list", []):
-        create_schema(cursor, schema, owner)
+        key = ("schema", fold_identifier(schema))
+        if key not in creators:
+            creators[key] = add(f"CREATE SCHEMA {schema} AUTHORIZATION {owner};", "create_schema", schema,
+                                grantee=owner, needs=[owner_key, ("session_user",)], guard=("schema", schema),
+                                source="schema_list")
 
     # Create roles
-    # Combine various role parameters into a single list and create each role
-    role_list = parameters.get("role_list", []) + [
-        parameters.get("role_cr", [None])[0],
-        parameters.get("role_ro", [None])[0],
-        parameters.get("role_rw", [None])[0],
-        parameters.get("role_tr", [None])[0],
-        parameters.get("role_pg_monitor", [None])[0]
-    ]
-    for role in role_list:
-        create_role(cursor, role)
-
-    # Extract values, handling missing keys
+    for role in parameters.get("role_list", []):
+        add_role("CREATE ROLE", "create_role", role, "role_list")
+    for key in ("role_cr", "role_ro", "role_rw", "role_tr", "role_pg_monitor"):
+        add_role("CREATE ROLE", "create_role", parameters.get(key, [None])[0], key)
+
+    # Grant roles to users: {role: list of users to receive the role}
+    for role, (key, users) in {
+        parameters.get("role_ro", [None])[0]: ("users_to_receive_role_ro", parameters.get("users_to_receive_role_ro", [])),
+        parameters.get("role_rw", [None])[0]: ("users_to_receive_role_rw", parameters.get("users_to_receive_role_rw", [])),
+        parameters.get("role_tr", [None])[0]: ("users_to_receive_role_tr", parameters.get("users_to_receive_role_tr", [])),
+        parameters.get("role_cr", [None])[0]: ("users_to_receive_role_cr", parameters.get("users_to_receive_role_cr", [])),
+    }.items():
+        for user in users:
+            add_membership(role, user, key)
+    for user in parameters.get("users_to_receive_role_tr", []):
+        add_membership(owner, user, "users_to_receive_role_tr")
     role_pg_monitor = parameters.get("role_pg_monitor", [None])[0]
-    users_to_receive_pg_monitor = parameters.get("users_to_receive_pg_monitor", [])
+    for user in parameters.get("users_to_receive_pg_monitor", []):
+        add_membership(role_pg_monitor, user, "users_to_receive_pg_monitor")
+
+    # Schema grants run as the owner so default privileges are recorded against it
+    creators[("set_role",)] = add(f"SET ROLE {owner};", "set_role", owner, needs=[owner_key, ("session_user",)],
+                                  source="user_owner")
+    for role_key, schema_key, grants in SCHEMA_ROLE_GRANTS:
+        role = parameters.get(role_key, [None])[0]
+        if not role:
+            continue
+        for schema in parameters.get(schema_key, []):
+            for kind, privileges in grants:
+                for category, statement in schema_privilege_statements(kind, privileges, schema, role):
+                    add(statement, category, schema, grantee=role, privileges=privileges,
+                        needs=[("schema", fold_identifier(schema)), ("role", fold_identifier(role)), ("set_role",)],
+                        source=schema_key)
+
+    return tuple(steps)
+
+
+def role_exists(cursor, role, snapshot=None):
+    if snapshot is not None:
+        return snapshot_contains(cursor, snapshot, "roles", fold_identifier(role))
+    cursor.execute("SELECT 1 FROM pg_roles WHERE rolname = %s", (fold_identifier(role),))
+    return cursor.fetchone() is not None
 
-    # Log notice if values are missing or empty
-    if not role_pg_monitor:
-        logging.info("Notice: 'role_pg_monitor' is not set or is empty in the CSV. Skipping related operations.")
-    if not users_to_receive_pg_monitor:
-        logging.info("Notice: 'users_to_receive_pg_monitor' is not set or is empty in the CSV. Skipping role grants.")
 
-    # Grant roles to users based on mappings defined in the parameters.
-    # The mapping is defined as: {role: list of users to receive the role}
-    for role, users in {
-        parameters.get("role_ro", [None])[0]: parameters.get("users_to_receive_role_ro", []),
-        parameters.get("role_rw", [None])[0]: parameters.get("users_to_receive_role_rw", []),
-        parameters.get("role_tr", [None])[0]: parameters.get("users_to_receive_role_tr", []),
-        parameters.get("role_cr", [None])[0]: parameters.get("users_to_receive_role_cr", []),
-    }.items():
-        for user in users:
-            grant_role_to_user(cursor, role, user)
+def schema_exists(cursor, schema, snapshot=None):
+    if snapshot is not None:
+        return snapshot_contains(cursor, snapshot, "schemas", fold_identifier(schema))
+    cursor.execute("SELECT 1 FROM pg_namespace WHERE nspname = %s", (fold_identifier(schema),))
+    return cursor.fetchone() is not None
 
-    # Grant owner roles to users_to_receive_role_tr users.
-    users_to_receive_role_tr = parameters.get("users_to_receive_role_tr", [])
-    for user in users_to_receive_role_tr:
-        grant_role_to_user(cursor, owner, user)
 
-    # Grant the pg_monitor role to users specified in the 'users_to_receive_pg_monitor' parameter
-    if users_to_receive_pg_monitor and role_pg_monitor:
-        for role, users in {
-            role_pg_monitor: users_to_receive_pg_monitor,
-        }.items():
-            for user in users:
-                grant_role_to_user(cursor, role, user)
+def guard_satisfied(cursor, guard, snapshot=None):
+    """ Return True when the object a guarded plan step would create is already in place. """
+    kind, name = guard
+    if kind == "role":
+        return role_exists(cursor, name, snapshot)
+    if kind == "schema":
+        return schema_exists(cursor, name, snapshot)
+    if kind == "membership":
+        return is_role_assigned(cursor, name[0], name[1], snapshot)
+    if kind == "database":
+        cursor.execute("SELECT 1 FROM pg_database WHERE datname = %s", (fold_identifier(name),))
+        return cursor.fetchone() is not None
+    if kind == "session_user":
+        if snapshot is not None and "session_user" in snapshot:
+            session_user = snapshot["session_user"]
+        else:
+            cursor.execute("SELECT session_user;")
+            session_user = cursor.fetchone()[0]
+            if snapshot is not None:
+                snapshot["session_user"] = session_user
+        return session_user == fold_identifier(name)
+    raise ValueError(f"Unknown plan guard {guard!r}")
 
-    cursor.execute(f"SET ROLE {parameters['user_owner'][0]};")
 
-    # Continue with other grant operations
-    grant_role_cr(cursor, parameters.get("schema_cr_list", []), parameters.get("role_cr", [None])[0])
-    grant_role_ro(cursor, parameters.get("schema_ro_list", []), parameters.get("role_ro", [None])[0])
-    grant_role_rw(cursor, parameters.get("schema_rw_list", []), parameters.get("role_rw", [None])[0])
-    grant_role_tr(cursor, parameters.get("schema_tr_list", []), parameters.get("role_tr", [None])[0])
+def record_guard(snapshot, guard):
+    """ Record in the snapshot the object a guarded plan step has just created. """
+    if snapshot is None or guard is None or snapshot.get("stale", True):
+        return
+    kind, name = guard
+    if kind == "role":
+        snapshot["roles"].add(fold_identifier(name))
+    elif kind == "schema":
+        snapshot["schemas"].add(fold_identifier(name))
+    elif kind == "membership":
+        snapshot["memberships"].add((fold_identifier(name[0]), fold_identifier(name[1])))
+
 
-def main(args):
+def pending_steps(cursor, steps, snapshot=None):
     """
-    Main function that parses command-line arguments, loads parameters from a CSV file,
-    connects to the PostgreSQL database, and executes a series of operations to create users,
-    roles, schemas, alter database ownership, and grant various privileges.
+    Yield the steps whose guard does not already hold.
+
+    A step whose guard was already yielded is a duplicate and is skipped too. The snapshot is
+    left to the caller, which records a guard once its step has actually succeeded.
     """
-    # Connect to the PostgreSQL database using the provided credentials
+    yielded = set()
+    for step in steps:
+        if step.guard is not None:
+            if step.guard in yielded or guard_satisfied(cursor, step.guard, snapshot):
+                logging.info("%s %s is already in place. Skipping.", step.category, step.obj)
+                count_skipped(run_state(cursor), step.category)
+                continue
+            yielded.add(step.guard)
+        yield step
+
+
+def execute_plan(cursor, steps, snapshot=None, journal=None):
     """
-    Main function to handle database setup and operations.
+    Execute plan steps in order on one cursor, skipping guarded steps already in place
+    and, with a journal, steps an earlier run already applied.
     """
-    # Connect to the PostgreSQL Application database using the provided credentials
-    conn = psycopg2.connect(host=args.host, port=args.port, user=args.username, dbname=args.dbname)
-    conn.autocommit = True
-    cursor = conn.cursor()
+    executed = 0
+    for step in pending_steps(cursor, skip_journaled(steps, journal), snapshot):
+        logging.info("Executing %s: %s", step.category, step.statement)
+        throttle(cursor.connection)
+        if not execute_step(cursor, step):
+            continue
+        record_guard(snapshot, step.guard)
+        executed += 1
+        if journal is not None:
+            journal.record(step.statement, cursor)
+    return executed
 
-    # Connect to the PostgreSQL database using the provided credentials
-    conn_postgres = psycopg2.connect(host=args.host, port=args.port, user=args.username, dbname='postgres')
-    conn_postgres.autocommit = True
-    cursor_postgres = conn_postgres.cursor()
 
-    # Check if the task is to update user passwords and store them in Key Vault
-    if args.task == "create_database":
-        create_database(cursor_postgres, args)
-        cursor_postgres.close()
-        conn_postgres.close()
-        return
-    elif args.task == "create_datadog_role":
-        if args.useDatadog == 'Enabled':
-            create_datadog_role(cursor, cursor_postgres, args)
-            # Close the postgres cursor and connection
-            cursor_postgres.close()
-            conn_postgres.close()
-            return
-        else:
-            logging.info("Datadog role creation is disabled. Skipping.")
-            return
-    elif args.task == "execute_grants":
-        # Load parameters and execute grants
-        # parameters = load_grant_parameters(args.parameter_file)
-        parameters = load_parameters(args.parameter_file)
-        process_grants(cursor, parameters)
-        
+# SQLSTATE of a statement that gave up waiting for a lock after lock_timeout
+LOCK_NOT_AVAILABLE = "55P03"
 
-    else:
-        # Load parameters from the provided CSV file
-        parameters = load_parameters(args.parameter_file)
-        # Set role to current session user
-        set_role_to_session_user(cursor)
-        execute_task(cursor, parameters, args)
-        # Close the cursor and connection
-        cursor.close()
-        conn.close()
+# Message of the internal error (XX000) raised when a concurrent transaction updated the same
+# catalog row, e.g. the ACL of a table, while the statement waited for it
+CONCURRENT_UPDATE_MESSAGE = "tuple concurrently updated"
+
+# Factor by which the lock_timeout grows on every retry round of deferred statements
+LOCK_TIMEOUT_GROWTH = 2
+
+# Retry rounds of deferred statements before giving up on them
+DEFAULT_LOCK_RETRIES = 4
+
+
+def execute_lock_scheduled(cursor, steps, lock_timeout, rounds, journal=None):
+    """
+    Execute plan steps in order with a short lock_timeout, in milliseconds, deferring those
+    blocked by another transaction instead of waiting for it.
+
+    A deferred step also defers the later steps on the same object and those depending on it,
+    so each object still sees its statements in plan order. The deferred steps are retried
+    in up to rounds further passes, each with a lock_timeout LOCK_TIMEOUT_GROWTH times longer;
+    a stalled object therefore only delays itself. Steps still blocked after the last round
+    are failures: recorded under --continue_on_error, raised otherwise. A statement that waited
+    on a catalog row another transaction then updated counts as blocked too.
+
+    Returns an (executed, failed) tuple.
+    """
+    cursor.execute("SELECT current_setting('lock_timeout');")
+    original_timeout = cursor.fetchone()[0]
+    if isinstance(cursor, RetryingCursor):
+        cursor.deferred_sqlstates = {LOCK_NOT_AVAILABLE}
+    executed = 0
+    # The first round streams the steps; later rounds go over the deferred ones only
+    policy = run_state(cursor).error_policy
+    deferred = pending_steps(cursor, skip_journaled(steps, journal))
+    try:
+        for attempt in range(rounds + 1):
+            timeout = lock_timeout * LOCK_TIMEOUT_GROWTH ** attempt
+            cursor.execute(f"SET lock_timeout = {int(timeout)};")
+            blocked, blocked_objects, blocked_indexes, error = [], set(), set(), None
+            for step in deferred:
+                if step.obj in blocked_objects or blocked_indexes.intersection(step.depends_on):
+                    blocked.append(step)
+                    blocked_indexes.add(step.index)
+                    continue
+                logging.info("Executing %s: %s", step.category, step.statement)
+                throttle(cursor.connection)
+                try:
+                    cursor.execute(step.statement)
+                except psycopg2.Error as e:
+                    if e.pgcode == LOCK_NOT_AVAILABLE or (
+                            e.pgcode == "XX000" and CONCURRENT_UPDATE_MESSAGE in str(e)):
+                        logging.info("%s is locked by another transaction, deferring: %s", step.obj, step.statement)
+                        blocked.append(step)
+                        blocked_objects.add(step.obj)
+                        blocked_indexes.add(step.index)
+                        error = e
+                        continue
+                    if policy is None or not policy.skip(cursor, step.statement, step.source, e):
+                        raise
+                    continue
+                executed += 1
+                if journal is not None:
+                    journal.record(step.statement, cursor)
+            deferred = blocked
+            if not deferred:
+                break
+            if attempt < rounds:
+                logging.info("Retrying %d deferred statements with a lock_timeout of %d ms...", len(deferred),
+                             lock_timeout * LOCK_TIMEOUT_GROWTH ** (attempt + 1))
+    finally:
+        if isinstance(cursor, RetryingCursor):
+            cursor.deferred_sqlstates = set()
+        if not cursor.connection.closed:
+            cursor.execute(f"SET lock_timeout = {quote_literal(original_timeout)};")
+
+    for step in deferred:
+        logging.error("Gave up on %s after %d rounds, its object %s is still locked.", step.statement, rounds + 1,
+                      step.obj)
+    if deferred and policy is None:
+        raise error
+    for step in deferred:
+        policy.record(describe_connection(cursor.connection), step.statement, step.source,
+                      error.pgcode, str(error), rounds + 1, error)
+    return executed, len(deferred)
+
+
+def split_task_plan(plan):
+    """
+    Split a compile_task plan around its SET ROLE step.
+
+    Returns (cluster steps, set role step, schema grant steps): the users, roles, database owner,
+    schemas and memberships; the SET ROLE to the owner; and the schema grants made as the owner.
+    """
+    set_role_index = next(step.index for step in plan if step.category == "set_role")
+    return plan[:set_role_index], plan[set_role_index], plan[set_role_index + 1:]
+
+
+# Statement templates, as (prefix, suffix) around the schema list, for each schema grant category
+SCHEMA_GRANT_TEMPLATES = {
+    "schema_privileges": ("GRANT {privileges} ON SCHEMA ", " TO {grantee};"),
+    "all_tables_privileges": ("GRANT {privileges} ON ALL TABLES IN SCHEMA ", " TO {grantee};"),
+    "default_tables_privileges": ("ALTER DEFAULT PRIVILEGES IN SCHEMA ", " GRANT {privileges} ON TABLES TO {grantee};"),
+    "all_sequences_privileges": ("GRANT {privileges} ON ALL SEQUENCES IN SCHEMA ", " TO {grantee};"),
+    "default_sequences_privileges": ("ALTER DEFAULT PRIVILEGES IN SCHEMA ",
+                                     " GRANT {privileges} ON SEQUENCES TO {grantee};"),
+}
+
+
+def merge_schema_grant_steps(steps, max_statement_size=DEFAULT_MAX_STATEMENT_SIZE):
+    """
+    Merge schema grant steps into the fewest statements granting the same privileges.
+
+    Privileges given to one role on one schema and object kind are combined into a single
+    privilege list, schemas receiving the same list are named in one statement, and roles
+    receiving the same list on the same schemas share that statement too. Statements are
+    split to stay within max_statement_size characters.
+
+    Returns a tuple of PlanStep whose obj, grantee and source are comma separated lists.
+    """
+    # {(category, grantee, schema): privileges}, privileges kept in first-seen order
+    privileges = {}
+    sources = {}
+    for step in steps:
+        key = (step.category, step.grantee, step.obj)
+        privileges.setdefault(key, {}).update(
+            dict.fromkeys(privilege.strip() for privilege in step.privileges.split(",")))
+        sources.setdefault(key, {})[step.source] = None
+
+    schemas = {}
+    for (category, grantee, schema), merged in privileges.items():
+        schemas.setdefault((category, grantee, ", ".join(merged)), []).append(schema)
+
+    grantees = {}
+    for (category, grantee, merged), schema_list in schemas.items():
+        grantees.setdefault((category, merged, tuple(schema_list)), []).append(grantee)
+
+    merged_steps = []
+    for (category, merged, schema_list), grantee_list in grantees.items():
+        source = ", ".join(dict.fromkeys(source for grantee in grantee_list for schema in schema_list
+                                         for source in sources[(category, grantee, schema)]))
+        grantee = ", ".join(grantee_list)
+        prefix, suffix = (template.format(privileges=merged, grantee=grantee)
+                          for template in SCHEMA_GRANT_TEMPLATES[category])
+        for chunk in chunk_tables(prefix, schema_list, suffix, max_statement_size):
+            merged_steps.append(PlanStep(len(merged_steps), prefix + ", ".join(chunk) + suffix, category,
+                                         ", ".join(chunk), grantee, merged, (), None, source))
+    return tuple(merged_steps)
+
+
+def merge_membership_steps(steps, max_statement_size=DEFAULT_MAX_STATEMENT_SIZE):
+    """
+    Merge "grant_membership" steps into the fewest multi-target GRANT statements.
+
+    Members receiving the same set of roles share one "GRANT role, ... TO member, ...;" statement,
+    split to stay within max_statement_size characters. The merged steps carry no guard, so only
+    memberships known to be missing should be passed in.
+
+    Returns a tuple of PlanStep whose obj, grantee and source are comma separated lists.
+    """
+    # {member: {role: None}} and {(role, member): source}, in first-seen order
+    roles_by_member = {}
+    sources = {}
+    for step in steps:
+        roles_by_member.setdefault(step.grantee, {})[step.obj] = None
+        sources.setdefault((step.obj, step.grantee), step.source)
+
+    members_by_roles = {}
+    for member, roles in roles_by_member.items():
+        members_by_roles.setdefault(tuple(roles), []).append(member)
+
+    merged_steps = []
+    for roles, members in members_by_roles.items():
+        prefix = f"GRANT {', '.join(roles)} TO "
+        for chunk in chunk_tables(prefix, members, ";", max_statement_size):
+            source = ", ".join(dict.fromkeys(sources[(role, member)] for member in chunk for role in roles))
+            merged_steps.append(PlanStep(len(merged_steps), prefix + ", ".join(chunk) + ";", "grant_membership",
+                                         ", ".join(roles), ", ".join(chunk), None, (), None, source))
+    return tuple(merged_steps)
+
+
+# Positions (1-based) of the role names in %s that pg_roles does not know about
+MISSING_ROLES_QUERY = """
+    SELECT r.position FROM unnest(%s::text[]) WITH ORDINALITY AS r(name, position)
+    WHERE NOT EXISTS (SELECT 1 FROM pg_roles WHERE rolname = r.name)
+"""
+
+# Positions (1-based) of the (role, member) pairs in %s, %s that pg_auth_members does not hold
+MISSING_MEMBERSHIPS_QUERY = """
+    SELECT p.position FROM unnest(%s::text[], %s::text[]) WITH ORDINALITY AS p(role, member, position)
+    WHERE NOT EXISTS (
+        SELECT 1 FROM pg_auth_members m
+        JOIN pg_roles r ON r.oid = m.roleid
+        JOIN pg_roles u ON u.oid = m.member
+        WHERE r.rolname = p.role AND u.rolname = p.member
+    )
+"""
+
+
+def execute_cluster_steps_bulk(cursor, steps, snapshot=None, max_statement_size=DEFAULT_MAX_STATEMENT_SIZE,
+                               journal=None):
+    """
+    Execute the cluster steps of a compile_task plan with users, roles and memberships handled in bulk.
+
+    The users and roles missing from pg_roles are found in one query and created first, several
+    CREATE statements per round trip; a batch that fails is retried one guarded step at a time.
+    The remaining steps run as in execute_plan, then the missing memberships are found in one
+    query and granted with the multi-target statements of merge_membership_steps. With a
+    journal, steps an earlier run already applied are skipped and applied ones recorded.
+
+    Returns the number of statements executed.
+    """
+    steps = list(skip_journaled(steps, journal))
+    roles = [step for step in steps if step.category in ("create_user", "create_role")]
+    memberships = [step for step in steps if step.category == "grant_membership"]
+    others = [step for step in steps if step.category not in ("create_user", "create_role", "grant_membership")]
+    executed = 0
+
+    cursor.execute(MISSING_ROLES_QUERY, ([fold_identifier(step.obj) for step in roles],))
+    missing = [roles[position - 1] for position, in cursor.fetchall()]
+    for category, count in (collections.Counter(step.category for step in roles)
+                            - collections.Counter(step.category for step in missing)).items():
+        count_skipped(run_state(cursor), category, count)
+    logging.info("%d of %d users and roles are missing.", len(missing), len(roles))
+    for chunk in chunk_tables("", [step.statement for step in missing], "", max_statement_size):
+        statements = set(chunk)
+        chunk_steps = [step for step in missing if step.statement in statements]
+        logging.info("Creating %d users and roles in one round trip...", len(chunk))
+        throttle(cursor.connection, statements=len(chunk))
+        try:
+            cursor.execute("\n".join(chunk))
+        except psycopg2.Error as e:
+            logging.warning("Bulk role creation failed, creating the roles one at a time: %s", e)
+            executed += execute_plan(cursor, chunk_steps, snapshot, journal)
+            continue
+        executed += len(chunk)
+        for step in chunk_steps:
+            record_guard(snapshot, step.guard)
+            if journal is not None:
+                journal.record(step.statement, cursor)
+
+    executed += execute_plan(cursor, others, snapshot, journal)
+
+    cursor.execute(MISSING_MEMBERSHIPS_QUERY, ([fold_identifier(step.obj) for step in memberships],
+                                               [fold_identifier(step.grantee) for step in memberships]))
+    missing = [memberships[position - 1] for position, in cursor.fetchall()]
+    count_skipped(run_state(cursor), "grant_membership", len(memberships) - len(missing))
+    logging.info("%d of %d role memberships are missing.", len(missing), len(memberships))
+    merged = merge_membership_steps(missing, max_statement_size)
+    granted = execute_plan(cursor, merged, journal=journal)
+    executed += granted
+    if granted == len(merged):
+        for step in missing:
+            record_guard(snapshot, step.guard)
+    elif snapshot is not None:
+        # A merged statement was skipped; which memberships it covered is left to the catalog
+        invalidate_catalog_snapshot(snapshot)
+    return executed
+
+
+def process_grants(cursor, grant_parameters, batch=False, max_statement_size=DEFAULT_MAX_STATEMENT_SIZE,
+                   journal=None):
+    """
+    Executes grant queries based on structured parameters.
+
+    When batch is True, tables are grouped by (grant kind, role) and granted with
+    multi-table GRANT statements instead of one statement per table. With a journal,
+    statements an earlier run already applied are skipped.
+    """
+    if batch:
+        return process_grants_batched(cursor, grant_parameters, max_statement_size, journal)
+
+    total_grants_executed = 0
+    for step in skip_journaled(iter_compile_grants(grant_parameters), journal):
+        logging.info("Granting %s on %s to %s...", step.privileges, step.obj, step.grantee)
+        throttle(cursor.connection)
+        if not execute_step(cursor, step):
+            continue
+        total_grants_executed += 1
+        if journal is not None:
+            journal.record(step.statement, cursor)
+
+    logging.info("Grants applied!")
+    logging.info("Executed %d grant statements successfully.", total_grants_executed)
+    return total_grants_executed
+
+
+def chunk_tables(prefix, tables, suffix, max_statement_size):
+    """
+    Split tables into comma separated lists so that each resulting
+    "prefix + tables + suffix" statement stays within max_statement_size characters.
+    A single table longer than the limit still gets a statement of its own.
+    """
+    chunk = []
+    size = len(prefix) + len(suffix)
+    for table in tables:
+        extra = len(table) + (2 if chunk else 0)
+        if chunk and size + extra > max_statement_size:
+            yield chunk
+            chunk = []
+            size = len(prefix) + len(suffix)
+            extra = len(table)
+        chunk.append(table)
+        size += extra
+    if chunk:
+        yield chunk
+
+
+def batched_grant_statements(privileges, role, tables, max_statement_size=DEFAULT_MAX_STATEMENT_SIZE):
+    """ Builds the multi-table GRANT statements for privileges on tables to role. """
+    prefix = f"GRANT {privileges} ON "
+    suffix = f" TO {role};"
+    return [prefix + ", ".join(chunk) + suffix
+            for chunk in chunk_tables(prefix, tables, suffix, max_statement_size)]
+
+
+def grant_tables_batched(cursor, privileges, role, steps, max_statement_size=DEFAULT_MAX_STATEMENT_SIZE,
+                         journal=None):
+    """
+    Grants privileges on the tables of "table_grant" plan steps with as few GRANT statements as possible.
+
+    A batch failing with a skippable error is retried one table at a time, so under
+    --continue_on_error only the bad tables are skipped, each recorded against its CSV line.
+    Returns the number of tables granted, leaving out journaled batches and skipped tables.
+    """
+    granted = 0
+    steps = {step.obj: step for step in steps}
+    prefix = f"GRANT {privileges} ON "
+    suffix = f" TO {role};"
+    for chunk in chunk_tables(prefix, list(steps), suffix, max_statement_size):
+        statement = prefix + ", ".join(chunk) + suffix
+        if journal is not None and journal.is_completed(statement):
+            continue
+        chunk_steps = [steps[table] for table in chunk]
+        logging.info("Granting %s on a batch of tables to %s...", privileges, role)
+        throttle(cursor.connection)
+        try:
+            cursor.execute(statement)
+        except DATABASE_ERRORS as e:
+            policy = run_state(cursor).error_policy
+            if policy is not None and classify_error(error_sqlstate(e), e) == "skippable":
+                logging.warning("Batched grant failed, granting the tables one at a time: %s", e)
+                granted += execute_plan(cursor, chunk_steps, journal=journal)
+                continue
+            source = ", ".join(dict.fromkeys(str(step.source) for step in chunk_steps))
+            if policy is None or not policy.skip(cursor, statement, source, e):
+                raise
+            continue
+        granted += len(chunk)
+        if journal is not None:
+            journal.record(statement, cursor)
+    return granted
+
+
+def process_grants_batched(cursor, grant_parameters, max_statement_size=DEFAULT_MAX_STATEMENT_SIZE, journal=None):
+    """
+    Executes grant queries grouped by (grant kind, role).
+
+    Tables are buffered per group only until a full statement's worth is collected, so
+    grant_parameters can be a lazy stream such as iter_grant_records.
+    The reported grant count is the number of tables actually granted, as process_grants
+    reports it, less the grants a batch repeats; only the number of round trips to the
+    server changes.
+    """
+    total_grants_executed = 0
+    for privileges, role, steps, _ in iter_grant_batches(iter_compile_grants(grant_parameters), max_statement_size):
+        total_grants_executed += grant_tables_batched(cursor, privileges, role, steps, max_statement_size, journal)
+
+    logging.info("Grants applied!")
+    logging.info("Executed %d grant statements successfully.", total_grants_executed)
+    return total_grants_executed
+
+
+def iter_grant_batches(steps, max_statement_size=DEFAULT_MAX_STATEMENT_SIZE):
+    """
+    Group "table_grant" plan steps by (privileges, role).
+
+    Yields (privileges, role, steps, grants) as soon as a group holds a full statement's worth of
+    tables, then the remaining groups in first-seen order; steps holds the first step seen for
+    each table, and grants is the number of steps folded into the group, duplicates included.
+    """
+    # {(privileges, role): [{table: step}, statement size, steps]}, dict keys drop duplicates within a statement
+    pending = {}
+    for step in steps:
+        key = (step.privileges, step.grantee)
+        group = pending.setdefault(key, [{}, 0, 0])
+        if step.obj not in group[0]:
+            group[0][step.obj] = step
+            group[1] += len(step.obj) + 2
+        group[2] += 1
+
+        if group[1] >= max_statement_size:
+            yield (*key, list(group[0].values()), group[2])
+            del pending[key]
+
+    for (privileges, role), (tables, _, grants) in pending.items():
+        yield privileges, role, list(tables.values()), grants
+
+
+def iter_table_grant_work(grant_parameters):
+    """ Yield (table, step) work items for the grants process_grants would execute. """
+    for step in iter_compile_grants(grant_parameters):
+        yield step.obj, step
+
+
+def execute_sharded(args, work, workers, setup_statements=(), journal=None):
+    """
+    Execute (shard key, plan step) work items across a bounded pool of autocommit connections.
+
+    Every item with the same key is sent to the same worker and executed in input order,
+    so two connections never update the same catalog row at once. Steps go through
+    execute_step as on the serial path: under --continue_on_error a skippable failure is
+    recorded against the step's source and counted, any other failure stops every worker
+    and is raised once they have finished. With a journal, statements an earlier run
+    already applied are skipped.
+
+    Returns a (succeeded, failed) tuple aggregated over all workers; the failed steps are also
+    added to the error policy's skip count of the calling thread.
+    """
+    pool = psycopg2.pool.ThreadedConnectionPool(
+        1, workers, host=args.host, port=args.port, user=args.username, dbname=args.dbname,
+        connection_factory=ProfilingConnection,
+    )
+    queues = [queue.Queue(maxsize=WORK_QUEUE_SIZE) for _ in range(workers)]
+    results = [(0, 0)] * workers
+    # Errors that stop the run; once one is set, workers drain their queue without executing
+    errors = []
+    run = run_state(args)
+
+    def worker(index):
+        succeeded = failed = 0
+        conn = cursor = None
+        try:
+            conn = pool.getconn()
+            conn.attach(run)
+            conn.autocommit = True
+            cursor = open_cursor(conn, args)
+            for statement in setup_statements:
+                cursor.execute(statement)
+        except psycopg2.Error as e:
+            logging.error("Worker %d could not prepare its connection: %s", index, e)
+            errors.append(e)
+
+        # Keep draining the queue even after an error so the producer never blocks
+        while True:
+            step = queues[index].get()
+            if step is None:
+                break
+            if errors:
+                continue
+            try:
+                logging.info("Worker %d executing: %s", index, step.statement)
+                # A RetryingCursor may have replaced the worker's connection
+                throttle(cursor.connection, index)
+                if not execute_step(cursor, step):
+                    failed += 1
+                    continue
+                succeeded += 1
+                if journal is not None:
+                    journal.record(step.statement, cursor)
+            except psycopg2.Error as e:
+                logging.error("Worker %d failed to execute %s: %s", index, step.statement, e)
+                errors.append(e)
+
+        if cursor is not None:
+            try:
+                cursor.close()
+            except psycopg2.Error as e:
+                logging.error("Worker %d could not commit its last batch: %s", index, e)
+        if conn is not None:
+            pool.putconn(conn)
+        results[index] = (succeeded, failed)
+
+    # Each worker runs in a copy of the caller's context, so its logs reach the caller's daemon client
+    threads = [threading.Thread(target=contextvars.copy_context().run, args=(worker, i), daemon=True)
+               for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        for key, step in work:
+            if errors:
+                break
+            if journal is not None and journal.is_completed(step.statement):
+                continue
+            queues[zlib.crc32(key.encode("utf-8")) % workers].put(step)
+    finally:
+        for q in queues:
+            q.put(None)
+        for thread in threads:
+            thread.join()
+        pool.closeall()
+
+    succeeded = sum(r[0] for r in results)
+    failed = sum(r[1] for r in results)
+    logging.info("Executed %d statements successfully across %d workers, %d failed.", succeeded, workers, failed)
+    if errors:
+        raise errors[0]
+    if run.error_policy is not None:
+        # The workers skipped these on their own threads
+        run.error_policy.add_skipped(failed)
+    return succeeded, failed
+
+
+async def wait_async(conn):
+    """ Drive an asynchronous psycopg2 connection until its pending operation completes. """
+    loop = asyncio.get_running_loop()
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        ready = loop.create_future()
+        if state == psycopg2.extensions.POLL_READ:
+            loop.add_reader(conn.fileno(), ready.set_result, None)
+            try:
+                await ready
+            finally:
+                loop.remove_reader(conn.fileno())
+        elif state == psycopg2.extensions.POLL_WRITE:
+            loop.add_writer(conn.fileno(), ready.set_result, None)
+            try:
+                await ready
+            finally:
+                loop.remove_writer(conn.fileno())
+        else:
+            raise psycopg2.OperationalError(f"Unexpected poll state {state}")
+
+
+async def connect_async(args):
+    """ Open an asynchronous (always autocommit) psycopg2 connection to the application database. """
+    started = time.perf_counter()
+    conn = psycopg2.connect(host=args.host, port=args.port, user=args.username, dbname=args.dbname, async_=1)
+    await wait_async(conn)
+    profile = run_state(args).profile
+    if profile is not None:
+        profile.record("connect", time.perf_counter() - started, "connect", args.dbname, round_trip=False)
+    return conn
+
+
+async def execute_async(conn, cursor, statement, run=NO_RUN_STATE):
+    started = time.perf_counter()
+    cursor.execute(statement)
+    await wait_async(conn)
+    if run.profile is not None or run.metrics is not None:
+        record_statement(run, statement, time.perf_counter() - started)
+
+
+async def execute_sharded_async(args, work, workers, setup_statements=(), journal=None):
+    """
+    asyncio counterpart of execute_sharded.
+
+    The same (shard key, plan step) work items are spread over a few asynchronous connections
+    driven by one event loop instead of one thread per connection, and failures follow the
+    same error policy.
+
+    Returns a (succeeded, failed) tuple aggregated over all connections.
+    """
+    queues = [asyncio.Queue(maxsize=WORK_QUEUE_SIZE) for _ in range(workers)]
+    # Errors that stop the run; once one is set, workers drain their queue without executing
+    errors = []
+    run = run_state(args)
+
+    async def worker(index):
+        succeeded = failed = 0
+        conn = cursor = None
+        try:
+            conn = await connect_async(args)
+            cursor = conn.cursor()
+            for statement in setup_statements:
+                await execute_async(conn, cursor, statement, run)
+        except psycopg2.Error as e:
+            logging.error("Async worker %d could not prepare its connection: %s", index, e)
+            errors.append(e)
+
+        # Keep draining the queue even after an error so the producer never blocks
+        while True:
+            step = await queues[index].get()
+            if step is None:
+                break
+            if errors:
+                continue
+            try:
+                logging.info("Async worker %d executing: %s", index, step.statement)
+                if run.throttles is not None:
+                    # A paused throttle sleeps, which must not block the event loop
+                    await asyncio.to_thread(run.throttles.for_connection(conn).admit, index)
+                await execute_async(conn, cursor, step.statement, run)
+                succeeded += 1
+                if journal is not None:
+                    journal.record(step.statement)
+            except psycopg2.Error as e:
+                # The event loop runs on the calling thread, so skips count against it directly
+                if run.error_policy is not None and run.error_policy.skip(cursor, step.statement, step.source, e):
+                    failed += 1
+                    continue
+                logging.error("Async worker %d failed to execute %s: %s", index, step.statement, e)
+                errors.append(e)
+
+        if conn is not None:
+            conn.close()
+        return succeeded, failed
+
+    tasks = [asyncio.create_task(worker(i)) for i in range(workers)]
+    try:
+        for key, step in work:
+            if errors:
+                break
+            if journal is not None and journal.is_completed(step.statement):
+                continue
+            await queues[zlib.crc32(key.encode("utf-8")) % workers].put(step)
+    finally:
+        for q in queues:
+            await q.put(None)
+        results = await asyncio.gather(*tasks)
+
+    succeeded = sum(r[0] for r in results)
+    failed = sum(r[1] for r in results)
+    logging.info("Executed %d statements successfully across %d async connections, %d failed.",
+                 succeeded, workers, failed)
+    if errors:
+        raise errors[0]
+    return succeeded, failed
+
+
+def execute_pipelined(args, steps, setup_statements=(), window=PIPELINE_WINDOW, journal=None):
+    """
+    Execute plan steps over one psycopg 3 connection in pipeline mode.
+
+    Up to window statements are sent inside conn.pipeline() before their replies are read, so
+    they run in one implicit transaction. When one of them fails the whole window is rolled
+    back and replayed a statement at a time through execute_step, which attributes the error
+    to its CSV record or parameter and applies --continue_on_error as the other backends do.
+
+    Returns a (succeeded, failed) tuple.
+    """
+    if psycopg is None:
+        raise RuntimeError("The pipeline backend requires psycopg 3 (pip install psycopg).")
+
+    succeeded = failed = 0
+    run = run_state(args)
+    started = time.perf_counter()
+    conn = psycopg.connect(host=args.host, port=args.port, user=args.username, dbname=args.dbname,
+                           autocommit=True)
+    if run.profile is not None:
+        run.profile.record("connect", time.perf_counter() - started, "connect", args.dbname, round_trip=False)
+    conn.run_state = run
+    try:
+        cursor = conn.cursor()
+        for statement in setup_statements:
+            cursor.execute(statement)
+        streamed = time.perf_counter()
+        pending = skip_journaled(steps, journal)
+        while True:
+            batch = list(itertools.islice(pending, window))
+            if not batch:
+                break
+            throttle(conn, statements=len(batch))
+            sent = time.perf_counter()
+            try:
+                with conn.pipeline():
+                    for step in batch:
+                        logging.info("Pipelining %s: %s", step.category, step.statement)
+                        cursor.execute(step.statement)
+            except psycopg.Error as e:
+                if conn.closed:
+                    raise
+                logging.warning("Pipelined window of %d statements failed (SQLSTATE %s); "
+                                "replaying it one statement at a time.", len(batch), error_sqlstate(e))
+                for step in batch:
+                    if execute_step(cursor, step):
+                        succeeded += 1
+                        if journal is not None:
+                            journal.record(step.statement)
+                    else:
+                        failed += 1
+                continue
+            if run.profile is not None or run.metrics is not None:
+                elapsed = time.perf_counter() - sent
+                for step in batch:
+                    record_statement(run, step.statement, elapsed, round_trip=False, overlapped=True)
+            succeeded += len(batch)
+            if journal is not None:
+                journal.record_many(step.statement for step in batch)
+        if run.profile is not None:
+            # The statements above overlap; the span of the whole stream is what the run waited for
+            run.profile.record("pipeline", time.perf_counter() - streamed, "pipeline", args.dbname)
+    finally:
+        conn.close()
+
+    logging.info("Pipelined %d statements: %d succeeded, %d failed.", succeeded + failed, succeeded, failed)
+    return succeeded, failed
+
+
+async def execute_task_async(cursor, parameters, args, journal=None):
+    """
+    asyncio variant of execute_task.
+
+    The plan from compile_task is checked against a catalog snapshot read over the synchronous
+    cursor, then independent steps run concurrently in dependency phases: users and roles,
+    then schemas and role memberships, then the schema grants. With a journal, steps an
+    earlier run already applied are skipped.
+    """
+    workers = max(getattr(args, "workers", 1), 1)
+    cluster_steps, set_role_step, grant_steps = split_task_plan(compile_task(parameters, args.dbname))
+
+    with cluster_lock(args):
+        snapshot = load_catalog_snapshot(cursor)
+        steps = list(pending_steps(cursor, skip_journaled(cluster_steps, journal), snapshot))
+
+        # Phase 1: users and roles
+        await execute_sharded_async(
+            args, [(step.obj, step) for step in steps if step.category in ("create_user", "create_role")], workers,
+            journal=journal)
+
+        # The database owner must be in place before schemas are created for it
+        execute_plan(cursor, [step for step in steps
+                              if step.category in ("grant_session_user", "alter_database_owner")], journal=journal)
+        commit_batch(cursor)
+
+        # Phase 2: schemas and role memberships
+        await execute_sharded_async(
+            args, [(step.grantee if step.category == "grant_membership" else step.obj, step)
+                   for step in steps if step.category in ("create_schema", "grant_membership")], workers,
+            journal=journal)
+
+    # Phase 3: schema grants, made as the owner so default privileges are recorded against it
+    if getattr(args, "merge_schema_grants", False):
+        execute_plan(cursor, (set_role_step,) + merge_schema_grant_steps(
+            grant_steps, getattr(args, "max_statement_size", DEFAULT_MAX_STATEMENT_SIZE)), journal=journal)
+        return
+    await execute_sharded_async(args, [(step.obj, step) for step in grant_steps], workers,
+                                [set_role_step.statement], journal)
+
+
+# Execute the task based on the parameters loaded from the CSV file
+def execute_task(cursor, parameters, args, snapshot=None, plan=None, journal=None):
+    # Log notice if values are missing or empty
+    if not parameters.get("role_pg_monitor", [None])[0]:
+        logging.info("Notice: 'role_pg_monitor' is not set or is empty in the CSV. Skipping related operations.")
+    if not parameters.get("users_to_receive_pg_monitor", []):
+        logging.info("Notice: 'users_to_receive_pg_monitor' is not set or is empty in the CSV. Skipping role grants.")
+
+    cluster_steps, set_role_step, grant_steps = split_task_plan(plan or compile_task(parameters, args.dbname))
+
+    # Roles are shared by every database of the cluster, so runs provisioning several
+    # databases at once take turns creating them and granting memberships
+    with cluster_lock(args):
+        if getattr(args, "bulk_roles", False):
+            execute_cluster_steps_bulk(cursor, cluster_steps, snapshot,
+                                       getattr(args, "max_statement_size", DEFAULT_MAX_STATEMENT_SIZE), journal)
+        else:
+            execute_plan(cursor, cluster_steps, snapshot, journal)
+        commit_batch(cursor)
+
+    execute_plan(cursor, [set_role_step])
+
+    if getattr(args, "merge_schema_grants", False):
+        grant_steps = merge_schema_grant_steps(
+            grant_steps, getattr(args, "max_statement_size", DEFAULT_MAX_STATEMENT_SIZE))
+
+    # Steps skipped by the pipeline and the workers are counted by the error policy
+    if getattr(args, "backend", "sync") == "pipeline":
+        execute_pipelined(args, grant_steps, [set_role_step.statement], journal=journal)
+        return 0
+
+    # Statements blocked by other transactions are retried after the rest
+    if getattr(args, "lock_timeout", 0) > 0:
+        _, failed = execute_lock_scheduled(cursor, grant_steps, args.lock_timeout,
+                                           getattr(args, "lock_retries", DEFAULT_LOCK_RETRIES), journal)
+        return failed
+
+    # Merged statements span several schemas, so they are few and run on this connection
+    if getattr(args, "merge_schema_grants", False):
+        execute_plan(cursor, grant_steps, journal=journal)
+        return 0
+
+    # Shard the schema grants across pooled connections when more than one worker is requested
+    workers = getattr(args, "workers", 1)
+    if workers > 1:
+        execute_sharded(args, [(step.obj, step) for step in grant_steps], workers, [set_role_step.statement], journal)
+        return 0
+
+    # Continue with other grant operations
+    execute_plan(cursor, grant_steps, journal=journal)
+    return 0
+
+
+# Upper bound, in characters, for one server-side DO block; larger plans are sent in several blocks.
+# Every step is a subtransaction of the block, and their cost grows faster than linearly per block
+DEFAULT_SERVER_BLOCK_SIZE = 128 * 1024
+
+# Session setting the DO block leaves its per-statement results in, for the query that follows it
+SERVER_RESULTS_SETTING = "db_permissions.plan_results"
+
+
+def quote_literal(value):
+    """ Quote a string as an SQL literal (standard_conforming_strings is assumed on). """
+    return "'" + value.replace("'", "''") + "'"
+
+
+def guard_condition(guard):
+    """ Render a plan guard as an SQL condition that holds when the guarded step still has to run. """
+    kind, name = guard
+    if kind == "role":
+        return f"NOT EXISTS (SELECT 1 FROM pg_roles WHERE rolname = {quote_literal(fold_identifier(name))})"
+    if kind == "schema":
+        return f"NOT EXISTS (SELECT 1 FROM pg_namespace WHERE nspname = {quote_literal(fold_identifier(name))})"
+    if kind == "membership":
+        return ("NOT EXISTS (SELECT 1 FROM pg_auth_members m JOIN pg_roles r ON r.oid = m.roleid "
+                "JOIN pg_roles u ON u.oid = m.member "
+                f"WHERE r.rolname = {quote_literal(fold_identifier(name[0]))} "
+                f"AND u.rolname = {quote_literal(fold_identifier(name[1]))})")
+    if kind == "database":
+        return f"NOT EXISTS (SELECT 1 FROM pg_database WHERE datname = {quote_literal(fold_identifier(name))})"
+    if kind == "session_user":
+        return f"session_user <> {quote_literal(fold_identifier(name))}"
+    raise ValueError(f"Unknown plan guard {guard!r}")
+
+
+def render_server_step(step):
+    """ Render one plan step as a PL/pgSQL block recording whether it was executed, skipped or failed. """
+    execute = f"EXECUTE {quote_literal(step.statement)}; step_status := 'executed';"
+    if step.guard is not None:
+        execute = f"IF {guard_condition(step.guard)} THEN {execute} ELSE step_status := 'skipped'; END IF;"
+    return (f"    BEGIN\n        {execute}\n        step_sqlstate := NULL; step_message := NULL;\n"
+            "    EXCEPTION WHEN OTHERS THEN\n"
+            "        step_status := 'failed'; step_sqlstate := SQLSTATE; step_message := SQLERRM;\n"
+            "    END;\n"
+            "    statuses := statuses || step_status; sqlstates := sqlstates || step_sqlstate; "
+            "messages := messages || step_message;\n")
+
+
+def render_server_block(steps):
+    """
+    Render plan steps as one DO block followed by a query returning a row per step.
+
+    Guards are evaluated server-side right before their step, and each step runs in its own
+    exception block so a failure is reported without undoing the other steps. The query
+    returns (position, status, sqlstate, message) rows in step order.
+    """
+    return (
+        "DO $plan$\nDECLARE\n"
+        "    step_status text; step_sqlstate text; step_message text;\n"
+        "    statuses text[] := '{}'; sqlstates text[] := '{}'; messages text[] := '{}';\n"
+        "BEGIN\n"
+        + "".join(render_server_step(step) for step in steps)
+        + f"    PERFORM set_config({quote_literal(SERVER_RESULTS_SETTING)}, (\n"
+        "        SELECT COALESCE(json_agg(json_build_object('position', position, 'status', status,\n"
+        "                                                   'sqlstate', code, 'message', message)), '[]')\n"
+        "        FROM unnest(statuses, sqlstates, messages) WITH ORDINALITY AS r(status, code, message, position)\n"
+        "    )::text, false);\n"
+        "END\n$plan$;\n"
+        "SELECT position, status, sqlstate, message "
+        f"FROM json_to_recordset(current_setting({quote_literal(SERVER_RESULTS_SETTING)})::json) "
+        "AS r(position integer, status text, sqlstate text, message text) ORDER BY position;"
+    )
+
+
+def iter_server_blocks(steps, max_size=DEFAULT_SERVER_BLOCK_SIZE):
+    """ Group plan steps so that each rendered DO block stays within max_size characters. """
+    chunk, size = [], 0
+    for step in steps:
+        step_size = len(render_server_step(step))
+        if chunk and size + step_size > max_size:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(step)
+        size += step_size
+    if chunk:
+        yield chunk
+
+
+def execute_server_side(cursor, steps, max_size=DEFAULT_SERVER_BLOCK_SIZE):
+    """
+    Execute plan steps as PL/pgSQL DO blocks, one round trip per block.
+
+    Every step is logged from the returned result set as executed, skipped or failed.
+    Returns an (executed, skipped, failed) tuple.
+    """
+    executed = skipped = failed = blocks = 0
+    policy = run_state(cursor).error_policy
+    # A plain cursor keeps the result set of the query following the DO block
+    with cursor.connection.cursor() as server_cursor:
+        for chunk in iter_server_blocks(steps, max_size):
+            throttle(cursor.connection, statements=len(chunk))
+            server_cursor.execute(render_server_block(chunk))
+            blocks += 1
+            for position, status, sqlstate, message in server_cursor.fetchall():
+                step = chunk[position - 1]
+                if status == "executed":
+                    logging.info("Executed %s: %s", step.category, step.statement)
+                    executed += 1
+                elif status == "skipped":
+                    logging.info("%s %s is already in place. Skipping.", step.category, step.obj)
+                    count_skipped(run_state(cursor), step.category)
+                    skipped += 1
+                else:
+                    logging.error("Failed to execute %s (%s): %s", step.statement, sqlstate, message)
+                    failed += 1
+                    if policy is not None:
+                        policy.record(describe_connection(cursor.connection), step.statement, step.source,
+                                      sqlstate, message)
+    logging.info("Executed %d statements server-side in %d blocks: %d skipped, %d failed.",
+                 executed, blocks, skipped, failed)
+    return executed, skipped, failed
+
+
+def execute_task_server(cursor, parameters, args):
+    """
+    Server-side variant of execute_task: the whole compiled plan, existence checks included,
+    runs in DO blocks. Returns the number of failed statements.
+    """
+    cluster_steps, set_role_step, grant_steps = split_task_plan(compile_task(parameters, args.dbname))
+    if getattr(args, "merge_schema_grants", False):
+        grant_steps = merge_schema_grant_steps(
+            grant_steps, getattr(args, "max_statement_size", DEFAULT_MAX_STATEMENT_SIZE))
+    with cluster_lock(args):
+        _, _, failed = execute_server_side(cursor, cluster_steps + (set_role_step,) + tuple(grant_steps))
+        commit_batch(cursor)
+    return failed
+
+
+# pg_class relkinds covered by GRANT ... ON ALL TABLES / ALL SEQUENCES IN SCHEMA
+TABLE_RELKINDS = ("r", "p", "v", "m", "f")
+SEQUENCE_RELKINDS = ("S",)
+
+# pg_default_acl object types used by ALTER DEFAULT PRIVILEGES ... ON TABLES / ON SEQUENCES
+DEFAULT_ACL_OBJTYPES = {"tables": "r", "sequences": "S"}
+
+
+def split_qualified_name(name):
+    """ Split "schema.table" (optionally quoted) into its folded parts. """
+    parts, current, quoted = [], "", False
+    for char in name.strip():
+        if char == '"':
+            quoted = not quoted
+        if char == "." and not quoted:
+            parts.append(current)
+            current = ""
+        else:
+            current += char
+    parts.append(current)
+    return [fold_identifier(part) for part in parts]
+
+
+def load_catalog_state(cursor):
+    """
+    Read the current roles, memberships, schemas and privileges in bulk.
+
+    Returns a dictionary with:
+        - session_user, database, database_owner and search_path
+        - roles: set of role names
+        - memberships: set of (role, member) pairs from pg_auth_members
+        - schema_acls: {schema: {grantee: {privilege, ...}}} from pg_namespace.nspacl
+        - relations: {(schema, relation): relkind} from pg_class
+        - relation_acls: {(schema, relation): {grantee: {privilege, ...}}} from pg_class.relacl
+        - default_acls: {(owner, schema, objtype): {grantee: {privilege, ...}}} from pg_default_acl
+    """
+    state = {
+        "roles": set(),
+        "memberships": set(),
+        "schema_acls": {},
+        "relations": {},
+        "relation_acls": {},
+        "default_acls": {},
+    }
+
+    cursor.execute("""
+        SELECT session_user, current_database(), pg_catalog.pg_get_userbyid(d.datdba), current_schemas(false)
+        FROM pg_database d WHERE d.datname = current_database()
+    """)
+    state["session_user"], state["database"], state["database_owner"], state["search_path"] = cursor.fetchone()
+
+    state["roles"].update(fetch_roles(cursor))
+    state["memberships"].update(fetch_memberships(cursor))
+
+    cursor.execute("""
+        SELECT n.nspname, COALESCE(g.rolname, 'PUBLIC'), a.privilege_type
+        FROM pg_namespace n
+        CROSS JOIN LATERAL aclexplode(COALESCE(n.nspacl, acldefault('n', n.nspowner))) a
+        LEFT JOIN pg_roles g ON g.oid = a.grantee
+    """)
+    for schema, grantee, privilege in cursor.fetchall():
+        state["schema_acls"].setdefault(schema, {}).setdefault(grantee, set()).add(privilege)
+
+    cursor.execute("""
+        SELECT n.nspname, c.relname, c.relkind, COALESCE(g.rolname, 'PUBLIC'), a.privilege_type
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        LEFT JOIN LATERAL aclexplode(COALESCE(
+            c.relacl, acldefault(CASE WHEN c.relkind = 'S' THEN 's' ELSE 'r' END::"char", c.relowner)
+        )) a ON true
+        LEFT JOIN pg_roles g ON g.oid = a.grantee
+        WHERE c.relkind IN ('r', 'p', 'v', 'm', 'f', 'S')
+          AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+          AND n.nspname NOT LIKE 'pg_toast%'
+    """)
+    for schema, relation, relkind, grantee, privilege in cursor.fetchall():
+        state["relations"][(schema, relation)] = relkind
+        acl = state["relation_acls"].setdefault((schema, relation), {})
+        if privilege:
+            acl.setdefault(grantee, set()).add(privilege)
+
+    cursor.execute("""
+        SELECT o.rolname, n.nspname, d.defaclobjtype, COALESCE(g.rolname, 'PUBLIC'), a.privilege_type
+        FROM pg_default_acl d
+        JOIN pg_roles o ON o.oid = d.defaclrole
+        JOIN pg_namespace n ON n.oid = d.defaclnamespace
+        CROSS JOIN LATERAL aclexplode(d.defaclacl) a
+        LEFT JOIN pg_roles g ON g.oid = a.grantee
+    """)
+    for owner, schema, objtype, grantee, privilege in cursor.fetchall():
+        state["default_acls"].setdefault((owner, schema, objtype), {}).setdefault(grantee, set()).add(privilege)
+
+    logging.info("Loaded catalog state: %d roles, %d memberships, %d schemas, %d relations.",
+                 len(state["roles"]), len(state["memberships"]), len(state["schema_acls"]),
+                 len(state["relations"]))
+    return state
+
+
+def missing_privileges(acl, grantee, privileges):
+    """ Return the privileges from a comma separated list that grantee does not hold in acl. """
+    held = acl.get(grantee, set())
+    return [p.strip() for p in privileges.split(",") if p.strip() not in held]
+
+
+def add_privileges(acl, grantee, privileges):
+    acl.setdefault(grantee, set()).update(p.strip() for p in privileges.split(","))
+
+
+def resolve_relation(state, table):
+    """ Find the catalog key of a table name the way the server's search_path would. """
+    parts = split_qualified_name(table)
+    if len(parts) >= 2:
+        return (parts[-2], parts[-1])
+    for schema in state["search_path"]:
+        if (schema, parts[0]) in state["relations"]:
+            return (schema, parts[0])
+    return None
+
+
+def plan_step_missing(state, step, owner):
+    """
+    Return True when a compiled step is not yet reflected in the catalog state.
+
+    The state is updated for every missing step, so repeated grants within one run are only planned once.
+    """
+    category = step.category
+    obj = fold_identifier(step.obj)
+
+    if category in ("create_user", "create_role"):
+        missing = obj not in state["roles"]
+        state["roles"].add(obj)
+        return missing
+    if category == "grant_session_user":
+        membership = (obj, state["session_user"])
+        missing = state["session_user"] != obj and membership not in state["memberships"]
+        state["memberships"].add(membership)
+        return missing
+    if category == "alter_database_owner":
+        missing = state["database_owner"] != fold_identifier(step.grantee)
+        state["database_owner"] = fold_identifier(step.grantee)
+        return missing
+    if category == "create_schema":
+        if obj in state["schema_acls"]:
+            return False
+        state["schema_acls"][obj] = {fold_identifier(step.grantee): {"USAGE", "CREATE"}}
+        return True
+    if category == "grant_membership":
+        membership = (obj, fold_identifier(step.grantee))
+        missing = membership not in state["memberships"]
+        state["memberships"].add(membership)
+        return missing
+
+    grantee = fold_identifier(step.grantee)
+    if category == "schema_privileges":
+        acl = state["schema_acls"].setdefault(obj, {})
+        missing = bool(missing_privileges(acl, grantee, step.privileges))
+        add_privileges(acl, grantee, step.privileges)
+        return missing
+    if category in ("all_tables_privileges", "all_sequences_privileges"):
+        relkinds = TABLE_RELKINDS if category == "all_tables_privileges" else SEQUENCE_RELKINDS
+        acls = [state["relation_acls"][key] for key, relkind in state["relations"].items()
+                if key[0] == obj and relkind in relkinds]
+        missing = any(missing_privileges(acl, grantee, step.privileges) for acl in acls)
+        for acl in acls:
+            add_privileges(acl, grantee, step.privileges)
+        return missing
+    if category in ("default_tables_privileges", "default_sequences_privileges"):
+        kind = "tables" if category == "default_tables_privileges" else "sequences"
+        acl = state["default_acls"].setdefault((fold_identifier(owner), obj, DEFAULT_ACL_OBJTYPES[kind]), {})
+        missing = bool(missing_privileges(acl, grantee, step.privileges))
+        add_privileges(acl, grantee, step.privileges)
+        return missing
+    if category == "table_grant":
+        # Tables the catalog does not know about are always planned, so the server reports them
+        acl = state["relation_acls"].get(resolve_relation(state, step.obj))
+        if acl is None:
+            return True
+        missing = bool(missing_privileges(acl, grantee, step.privileges))
+        add_privileges(acl, grantee, step.privileges)
+        return missing
+    return True
+
+
+def planned(state, step, owner, run):
+    """ plan_step_missing, counting the steps left out of the plan as skipped in run. """
+    if plan_step_missing(state, step, owner):
+        return True
+    count_skipped(run, step.category)
+    return False
+
+
+def plan_task(state, parameters, args):
+    """
+    Compute the statements execute_task would run that are not already reflected in the catalog state.
+
+    The compiled plan is filtered against the state, so statements keep execute_task's order.
+    With --merge_schema_grants, the schema grants still missing are merged after filtering, and
+    with --bulk_roles so are the missing role memberships. Returns a list of PlanStep, whose
+    guards are dropped since the state already answered them.
+    """
+    owner = parameters["user_owner"][0]
+    run = run_state(args)
+    cluster_steps, set_role_step, grant_steps = split_task_plan(compile_task(parameters, args.dbname))
+    cluster_steps = [step for step in cluster_steps if planned(state, step, owner, run)]
+    if getattr(args, "bulk_roles", False):
+        cluster_steps = [step for step in cluster_steps if step.category != "grant_membership"] + list(
+            merge_membership_steps([step for step in cluster_steps if step.category == "grant_membership"],
+                                   getattr(args, "max_statement_size", DEFAULT_MAX_STATEMENT_SIZE)))
+    plan = [step._replace(guard=None) for step in cluster_steps]
+    schema_grants = [step for step in grant_steps if planned(state, step, owner, run)]
+    if getattr(args, "merge_schema_grants", False):
+        schema_grants = merge_schema_grant_steps(
+            schema_grants, getattr(args, "max_statement_size", DEFAULT_MAX_STATEMENT_SIZE))
+    if schema_grants:
+        # Default privileges are recorded against the current role, so grant as the owner
+        plan.append(set_role_step._replace(guard=None))
+        plan.extend(step._replace(guard=None) for step in schema_grants)
+    return plan
+
+
+def plan_grants(state, grant_parameters, batch=False, max_statement_size=DEFAULT_MAX_STATEMENT_SIZE,
+                run=NO_RUN_STATE):
+    """
+    Compute the GRANT statements process_grants would run that are not already in pg_class.relacl.
+
+    Tables the catalog does not know about are always planned, so the server reports them as it does today.
+    Grants already in place are counted as skipped in run. Returns a list of "table_grant" PlanStep;
+    batched steps name all their tables and CSV rows.
+    """
+    # {(privileges, role): {table: step}}
+    missing = {}
+    for step in iter_compile_grants(grant_parameters):
+        if planned(state, step, None, run):
+            missing.setdefault((step.privileges, step.grantee), {}).setdefault(step.obj, step)
+
+    plan = []
+    for (privileges, role), steps in missing.items():
+        if not batch:
+            plan.extend(steps.values())
+            continue
+        prefix = f"GRANT {privileges} ON "
+        suffix = f" TO {role};"
+        for chunk in chunk_tables(prefix, list(steps), suffix, max_statement_size):
+            source = ", ".join(dict.fromkeys(str(steps[table].source) for table in chunk))
+            plan.append(PlanStep(len(plan), prefix + ", ".join(chunk) + suffix, "table_grant", ", ".join(chunk),
+                                 role, privileges, (), None, source))
+    return plan
+
+
+def apply_plan(cursor, plan, journal=None):
+    """
+    Execute planned steps in order, as execute_plan does, and return how many were executed.
+    """
+    executed = execute_plan(cursor, plan, journal=journal)
+    logging.info("Applied %d of %d planned statements.", executed, len(plan))
+    return executed
+
+
+# (category, statement template) undoing each kind of grant step that incremental runs revoke
+REVOKE_TEMPLATES = {
+    "grant_membership": ("revoke_membership", "REVOKE {obj} FROM {grantee};"),
+    "schema_privileges": ("revoke_schema_privileges", "REVOKE {privileges} ON SCHEMA {obj} FROM {grantee};"),
+    "all_tables_privileges": ("revoke_all_tables_privileges",
+                              "REVOKE {privileges} ON ALL TABLES IN SCHEMA {obj} FROM {grantee};"),
+    "default_tables_privileges": ("revoke_default_tables_privileges",
+                                  "ALTER DEFAULT PRIVILEGES IN SCHEMA {obj} REVOKE {privileges} ON TABLES FROM {grantee};"),
+    "all_sequences_privileges": ("revoke_all_sequences_privileges",
+                                 "REVOKE {privileges} ON ALL SEQUENCES IN SCHEMA {obj} FROM {grantee};"),
+    "default_sequences_privileges": ("revoke_default_sequences_privileges",
+                                     "ALTER DEFAULT PRIVILEGES IN SCHEMA {obj} REVOKE {privileges} ON SEQUENCES FROM {grantee};"),
+    "table_grant": ("table_revoke", "REVOKE {privileges} ON {obj} FROM {grantee};"),
+}
+
+# Grant rows sorted in memory at once by the external sort of incremental runs
+SORT_RUN_SIZE = 100000
+
+
+def revoke_step(step):
+    """ Return the step revoking what a grant step granted. """
+    category, template = REVOKE_TEMPLATES[step.category]
+    return step._replace(statement=template.format(obj=step.obj, grantee=step.grantee, privileges=step.privileges),
+                         category=category, depends_on=(), guard=None)
+
+
+def compile_task_delta(old_parameters, new_parameters, dbname):
+    """
+    Compile the steps taking a database provisioned from old_parameters to new_parameters.
+
+    Both parameter sets are compiled and compared statement by statement. Memberships and schema
+    grants only the old plan made are revoked, before anything is granted so that a privilege
+    moving between statements is not lost. Users, roles and schemas only the old plan created
+    are left in place.
+
+    Returns a tuple of PlanStep: membership revokes, the new cluster steps, the schema grant
+    revokes after SET ROLE to the old owner, then the new schema grants after SET ROLE to the
+    new owner; the second SET ROLE is left out while the owner is unchanged.
+    """
+    old_cluster, old_set_role_step, old_grants = split_task_plan(compile_task(old_parameters, dbname))
+    new_cluster, set_role_step, new_grants = split_task_plan(compile_task(new_parameters, dbname))
+
+    def delta(old_steps, new_steps):
+        old_statements = {step.statement for step in old_steps}
+        new_statements = {step.statement for step in new_steps}
+        removed = {step.statement: step for step in old_steps if step.statement not in new_statements}
+        for step in removed.values():
+            if step.category not in REVOKE_TEMPLATES:
+                logging.warning("%s %s is no longer in the parameter file but is left in place.",
+                                step.category, step.obj)
+        return ([revoke_step(step) for step in removed.values() if step.category in REVOKE_TEMPLATES],
+                [step for step in new_steps if step.statement not in old_statements])
+
+    cluster_revokes, cluster_added = delta(old_cluster, new_cluster)
+    grant_revokes, grants_added = delta(old_grants, new_grants)
+    steps = cluster_revokes + cluster_added
+    # Schema grants and default privileges are revoked as the role that granted them, the old owner
+    if grant_revokes:
+        steps += [old_set_role_step] + grant_revokes
+    if grants_added:
+        if not grant_revokes or old_set_role_step.statement != set_role_step.statement:
+            steps.append(set_role_step)
+        steps += grants_added
+    return tuple(step._replace(index=index, depends_on=()) for index, step in enumerate(steps))
+
+
+def iter_sorted_grant_rows(csv_file_path, run_size=SORT_RUN_SIZE):
+    """
+    Yield the (table, role, privilege, record) rows of a permissions/tables/role CSV file in sorted order.
+
+    Runs of run_size rows are sorted in memory and spilled to temporary files, which are then
+    merged, so memory use does not grow with the size of the file.
+    """
+    with tempfile.TemporaryDirectory(prefix="db_permissions_sort_") as directory:
+        runs = []
+        chunk = []
+
+        def spill():
+            path = os.path.join(directory, f"run{len(runs)}.csv")
+            with open(path, "w", encoding="utf-8", newline="") as f:
+                csv.writer(f).writerows(sorted(chunk))
+            runs.append(path)
+            chunk.clear()
+
+        for step in iter_compile_grants(iter_grant_records(csv_file_path)):
+            for privilege in step.privileges.split(", "):
+                chunk.append((step.obj, step.grantee, privilege, step.source))
+            if len(chunk) >= run_size:
+                spill()
+        if not runs:
+            yield from sorted(chunk)
+            return
+        if chunk:
+            spill()
+
+        files = [open(path, encoding="utf-8", newline="") for path in runs]
+        try:
+            yield from heapq.merge(*[((table, role, privilege, int(record))
+                                      for table, role, privilege, record in csv.reader(f)) for f in files])
+        finally:
+            for f in files:
+                f.close()
+
+
+def diff_sorted_rows(old_rows, new_rows):
+    """
+    Merge-join two sorted streams of (table, role, privilege, record) rows.
+
+    Yields ("-", row) for every (table, role, privilege) only in old_rows and ("+", row) for every
+    one only in new_rows, in sorted order; repeated rows are reported once.
+    """
+    def distinct(rows):
+        last = None
+        for row in rows:
+            if row[:3] != last:
+                last = row[:3]
+                yield row
+
+    old_rows, new_rows = distinct(old_rows), distinct(new_rows)
+    old, new = next(old_rows, None), next(new_rows, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[:3] < new[:3]):
+            yield "-", old
+            old = next(old_rows, None)
+        elif old is None or new[:3] < old[:3]:
+            yield "+", new
+            new = next(new_rows, None)
+        else:
+            old, new = next(old_rows, None), next(new_rows, None)
+
+
+def iter_grant_delta(old_csv_file_path, new_csv_file_path, run_size=SORT_RUN_SIZE):
+    """
+    Yield the steps taking the table grants of one permissions/tables/role CSV file to another.
+
+    For every (table, role) whose privileges changed, the privileges only the old file granted are
+    revoked, then the privileges only the new file grants are granted. Both files are streamed
+    through iter_sorted_grant_rows. The source of each step is the record it came from, in the old
+    file for revokes and in the new file for grants.
+    """
+    index = 0
+    changes = diff_sorted_rows(iter_sorted_grant_rows(old_csv_file_path, run_size),
+                               iter_sorted_grant_rows(new_csv_file_path, run_size))
+    for (table, role), group in itertools.groupby(changes, key=lambda change: change[1][:2]):
+        revoked, granted = {}, {}
+        for sign, (_, _, privilege, record) in group:
+            (revoked if sign == "-" else granted)[privilege] = record
+        if revoked:
+            privileges = ", ".join(revoked)
+            yield PlanStep(index, f"REVOKE {privileges} ON {table} FROM {role};", "table_revoke", table, role,
+                           privileges, (), None, ", ".join(str(record) for record in dict.fromkeys(revoked.values())))
+            index += 1
+        if granted:
+            privileges = ", ".join(granted)
+            yield PlanStep(index, table_grant_statement(privileges, table, role), "table_grant", table, role,
+                           privileges, (), None, ", ".join(str(record) for record in dict.fromkeys(granted.values())))
+            index += 1
+
+
+# Default upper bound, in bytes, for the on-disk plan cache
+DEFAULT_PLAN_CACHE_SIZE = 256 * 1024 * 1024
+
+# Part of every plan cache key, so a new version of this script never reuses plans compiled by an older one
+with open(__file__, "rb") as _source:
+    TOOL_VERSION = hashlib.sha256(_source.read()).hexdigest()[:16]
+
+# Options that change which statements a task compiles or how it applies them, with their defaults
+PLAN_CACHE_OPTIONS = {
+    "plan": False,
+    "merge_schema_grants": False,
+    "bulk_roles": False,
+    "batch_grants": False,
+    "max_statement_size": DEFAULT_MAX_STATEMENT_SIZE,
+}
+
+# One round trip summarising every catalog the tasks read or change. Each catalog is hashed on the
+# server as it is aggregated, so only fixed-size digests are combined and one digest is returned
+CATALOG_FINGERPRINT_QUERY = """
+    SELECT md5(concat_ws('|',
+        (SELECT pg_catalog.pg_get_userbyid(datdba) FROM pg_database WHERE datname = current_database()),
+        (SELECT md5(string_agg(rolname, ',' ORDER BY rolname)) FROM pg_roles),
+        (SELECT md5(string_agg(roleid || ':' || member, ',' ORDER BY roleid, member)) FROM pg_auth_members),
+        (SELECT md5(string_agg(nspname || '=' || COALESCE(nspacl::text, ''), ',' ORDER BY nspname))
+         FROM pg_namespace),
+        (SELECT md5(string_agg(c.oid || '=' || COALESCE(c.relacl::text, ''), ',' ORDER BY c.oid))
+         FROM pg_class c WHERE c.relkind IN ('r', 'p', 'v', 'm', 'f', 'S') AND c.relpersistence <> 't'),
+        (SELECT md5(string_agg(oid || '=' || defaclacl::text, ',' ORDER BY oid)) FROM pg_default_acl)
+    ))
+"""
+
+
+def file_sha256(path):
+    """ Return the sha256 hex digest of a file, read in chunks. """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def plan_cache_key(args):
+    """ Key a plan by parameter file contents, target database, task, plan-changing options and tool version. """
+    previous = getattr(args, "previous_parameter_file", None)
+    identity = [file_sha256(args.parameter_file), args.host, args.port, args.dbname, args.task, TOOL_VERSION,
+                file_sha256(previous) if previous else None,
+                {option: getattr(args, option, default) for option, default in PLAN_CACHE_OPTIONS.items()}]
+    return hashlib.sha256(json.dumps(identity).encode("utf-8")).hexdigest()
+
+
+def catalog_fingerprint(cursor):
+    """ Return a digest of roles, memberships, schema and relation ACLs and default privileges. """
+    cursor.execute(CATALOG_FINGERPRINT_QUERY)
+    return cursor.fetchone()[0]
+
+
+def plan_cache_path(cache_dir, key):
+    return os.path.join(cache_dir, key + ".jsonl")
+
+
+def plan_cache_lookup(cache_dir, key):
+    """
+    Return the metadata stored for key, or None on a miss.
+
+    A hit refreshes the entry's modification time, which is what eviction orders by.
+    """
+    path = plan_cache_path(cache_dir, key)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            metadata = json.loads(f.readline())
+        os.utime(path)
+    except (OSError, ValueError):
+        return None
+    return metadata
+
+
+def plan_cache_store(cache_dir, key, fingerprint, steps, max_size=DEFAULT_PLAN_CACHE_SIZE):
+    """
+    Write a cache entry: a metadata line followed by one line per compiled PlanStep.
+
+    The entry is written to a temporary file and renamed into place, then the least recently
+    used entries other than this one are evicted until the cache fits in max_size bytes.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = plan_cache_path(cache_dir, key)
+    temporary = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+    count = 0
+    with open(temporary, "w", encoding="utf-8") as f:
+        # Written first so lookups never need to read past one line
+        f.write(json.dumps({"key": key, "fingerprint": fingerprint, "tool_version": TOOL_VERSION,
+                            "created": time.time()}) + "\n")
+        for step in steps:
+            f.write(json.dumps(step._asdict()) + "\n")
+            count += 1
+    os.replace(temporary, path)
+    logging.info("Cached plan of %d steps as %s.", count, key[:12])
+    evict_plan_cache(cache_dir, max_size, keep=key)
+
+
+def load_cached_plan(cache_dir, key):
+    """ Return the PlanStep tuple stored for key. """
+    def freeze(value):
+        # JSON arrays come back as lists; plan steps hold (nested) tuples, e.g. membership guards
+        return tuple(freeze(item) for item in value) if isinstance(value, list) else value
+
+    with open(plan_cache_path(cache_dir, key), "r", encoding="utf-8") as f:
+        next(f)  # Skip metadata
+        return tuple(PlanStep(**{name: freeze(value) for name, value in json.loads(line).items()}) for line in f)
+
+
+def evict_plan_cache(cache_dir, max_size=DEFAULT_PLAN_CACHE_SIZE, keep=None):
+    """
+    Remove least recently used entries until the cache is at most max_size bytes. Returns the number removed.
+
+    The entry for key keep, when given, counts towards the size but is never removed.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(".jsonl"):
+            continue
+        try:
+            stat = os.stat(os.path.join(cache_dir, name))
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+    entries.sort()
+
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, name in entries:
+        if total <= max_size:
+            break
+        if keep is not None and name == keep + ".jsonl":
+            continue
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    if removed:
+        logging.info("Evicted %d plan cache entries.", removed)
+    return removed
+
+
+# Bytes of the digest journaled for every applied statement
+JOURNAL_DIGEST_SIZE = 8
+
+# The journal is written and fsync'ed once this many statements or seconds have accumulated
+JOURNAL_SYNC_STATEMENTS = 1000
+JOURNAL_SYNC_SECONDS = 1.0
+
+
+class Journal:
+    """
+    Append-only record of the statements a run has applied, for --resume.
+
+    Every statement is stored as the 8-byte BLAKE2b digest of its text, so identical plans
+    resume whichever backend, batching or worker count applied them. Digests are buffered and
+    written with one fsync every JOURNAL_SYNC_STATEMENTS statements or JOURNAL_SYNC_SECONDS
+    seconds; a crash loses at most the last batch, whose statements are applied again on resume.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.completed = set()
+        if resume and os.path.exists(path):
+            with open(path, "rb") as f:
+                data = f.read()
+            # A write torn by a crash leaves a partial digest at the end, which is dropped
+            usable = len(data) - len(data) % JOURNAL_DIGEST_SIZE
+            os.truncate(path, usable)
+            self.completed = {data[i:i + JOURNAL_DIGEST_SIZE] for i in range(0, usable, JOURNAL_DIGEST_SIZE)}
+            logging.info("Resuming from journal %s: %d statements already applied.", path, len(self.completed))
+        self.file = open(path, "ab" if resume else "wb")
+        self.buffer = bytearray()
+        self.buffered = 0
+        self.synced = time.monotonic()
+        self.skipped = 0
+        self.closed = False
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def digest(statement):
+        return hashlib.blake2b(statement.encode("utf-8"), digest_size=JOURNAL_DIGEST_SIZE).digest()
+
+    def is_completed(self, statement):
+        """ Return True when an earlier run applied statement. """
+        if not self.completed or self.digest(statement) not in self.completed:
+            return False
+        with self.lock:
+            self.skipped += 1
+        return True
+
+    def record(self, statement, cursor=None):
+        """ Record an applied statement; on a TransactionBatchCursor, once its batch commits. """
+        if isinstance(cursor, TransactionBatchCursor) and not cursor.connection.autocommit:
+            cursor.journal = self
+            cursor.journaled.append(statement)
+            return
+        self.record_many((statement,))
+
+    def record_many(self, statements):
+        with self.lock:
+            if self.closed:
+                return
+            for statement in statements:
+                self.buffer += self.digest(statement)
+                self.buffered += 1
+            if self.buffered >= JOURNAL_SYNC_STATEMENTS or time.monotonic() - self.synced >= JOURNAL_SYNC_SECONDS:
+                self.sync()
+
+    def sync(self):
+        """ Write and fsync the buffered digests. The caller holds the lock. """
+        if self.buffer:
+            self.file.write(self.buffer)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.buffer.clear()
+        self.buffered = 0
+        self.synced = time.monotonic()
+
+    def close(self, complete=False):
+        """ Sync and close the journal, removing it when the run is complete. """
+        with self.lock:
+            if self.closed:
+                return
+            self.sync()
+            self.file.close()
+            self.closed = True
+        if self.skipped:
+            logging.info("Skipped %d statements applied by an earlier run.", self.skipped)
+        if complete:
+            os.remove(self.path)
+            logging.info("Run complete, journal %s removed.", self.path)
+        else:
+            logging.info("Progress journal kept at %s; rerun with --resume to continue.", self.path)
+
+
+def journal_path(args):
+    """ Key the journal of a run by parameter file contents, target database and task. """
+    previous = getattr(args, "previous_parameter_file", None)
+    identity = [file_sha256(args.parameter_file), file_sha256(previous) if previous else None,
+                args.host, args.port, args.dbname, args.task]
+    return os.path.join(args.journal_dir, hashlib.sha256(json.dumps(identity).encode("utf-8")).hexdigest() + ".journal")
+
+
+def open_journal(args):
+    """ Open the progress journal of a run, or return None without --journal_dir and for the create_* tasks. """
+    if not getattr(args, "journal_dir", None) or args.task in ("create_database", "create_datadog_role"):
+        return None
+    os.makedirs(args.journal_dir, exist_ok=True)
+    return Journal(journal_path(args), resume=getattr(args, "resume", False))
+
+
+def skip_journaled(steps, journal):
+    """ Yield the steps an earlier run has not applied. SET ROLE steps only change the session and always run. """
+    for step in steps:
+        if journal is None or step.category == "set_role" or not journal.is_completed(step.statement):
+            yield step
+
+
+def compile_cached_plan(args):
+    """ Compile the plan a role task executes, for storing in the plan cache. """
+    return compile_task(load_parameters(args.parameter_file), args.dbname)
+
+
+def run_task(cursor, cursor_postgres, args):
+    """
+    Run args.task against one database and return the number of statements that failed.
+
+    cursor is connected to the application database, cursor_postgres to the postgres maintenance database.
+    The duration and failures of the task are recorded in the run metrics, when they are active.
+    """
+    started = time.perf_counter()
+    failed = None
+    try:
+        failed = run_cached_task(cursor, cursor_postgres, args)
+        return failed
+    finally:
+        metrics = run_state(args).metrics
+        if metrics is not None:
+            metrics.record_task(args, time.perf_counter() - started, failed)
+
+
+def run_cached_task(cursor, cursor_postgres, args):
+    """
+    Run args.task through the plan cache.
+
+    With --plan_cache_dir, a run whose parameter file and catalog fingerprint both match a cached
+    entry is skipped after a single fingerprint query.
+    """
+    cache_dir = getattr(args, "plan_cache_dir", None)
+    if not cache_dir or args.task in ("create_database", "create_datadog_role"):
+        return run_journaled_task(cursor, cursor_postgres, args)
+
+    key = plan_cache_key(args)
+    entry = plan_cache_lookup(cache_dir, key)
+    if entry is not None and entry["fingerprint"] == catalog_fingerprint(cursor):
+        logging.info("Plan cache hit for %s on %s: catalog unchanged since the last run. Skipping.",
+                     args.parameter_file, args.dbname)
+        return 0
+
+    plan = load_cached_plan(cache_dir, key) if entry is not None and args.task != "execute_grants" else None
+    failed = run_journaled_task(cursor, cursor_postgres, args, plan)
+    commit_batch(cursor)
+    # Only fully applied plans are cached; a partial run must be retried in full next time.
+    # Grant runs re-read their CSV as a stream and never load a cached plan, so only the fingerprint is kept.
+    if not failed:
+        if args.task == "execute_grants":
+            steps = ()
+        else:
+            steps = plan or compile_cached_plan(args)
+        plan_cache_store(cache_dir, key, catalog_fingerprint(cursor), steps,
+                         getattr(args, "plan_cache_size", DEFAULT_PLAN_CACHE_SIZE))
+    return failed
+
+
+def run_journaled_task(cursor, cursor_postgres, args, plan=None):
+    """
+    Run dispatch_task with the progress journal of args, when --journal_dir is given.
+
+    The journal is removed once the task has completed without failures, so only interrupted
+    or partially failed runs leave one behind for --resume.
+    """
+    journal = open_journal(args)
+    if journal is None:
+        return dispatch_task(cursor, cursor_postgres, args, plan)
+    failed = None
+    try:
+        failed = dispatch_task(cursor, cursor_postgres, args, plan, journal)
+        # Statements of an open transaction batch are journaled when it commits
+        commit_batch(cursor)
+        return failed
+    finally:
+        journal.close(complete=failed == 0)
+
+
+def dispatch_task(cursor, cursor_postgres, args, plan=None, journal=None):
+    """
+    Execute args.task and return the number of statements that failed without raising.
+
+    plan, when given, is a previously compiled plan for the default task. journal, when given,
+    records the statements applied and skips those an earlier run applied. Statements skipped
+    under --continue_on_error count as failed.
+    """
+    failed = 0
+    policy = run_state(args).error_policy
+    skipped = policy.skipped() if policy is not None else 0
+    # Check if the task is to update user passwords and store them in Key Vault
+    if args.task == "create_database":
+        with cluster_lock(args):
+            create_database(cursor_postgres, args)
+            commit_batch(cursor_postgres)
+    elif args.task == "create_datadog_role":
+        if args.useDatadog == 'Enabled':
+            with cluster_lock(args):
+                create_datadog_role(cursor, cursor_postgres, args)
+                commit_batch(cursor_postgres)
+                commit_batch(cursor)
+        else:
+            logging.info("Datadog role creation is disabled. Skipping.")
+    elif args.task == "execute_grants":
+        # Stream parameters and execute grants
+        # parameters = load_grant_parameters(args.parameter_file)
+        parameters = iter_grant_records(args.parameter_file)
+        if getattr(args, "previous_parameter_file", None):
+            logging.info("Applying the grant changes from %s to %s...", args.previous_parameter_file,
+                         args.parameter_file)
+            execute_plan(cursor, iter_grant_delta(args.previous_parameter_file, args.parameter_file), journal=journal)
+        elif getattr(args, "plan", False):
+            state = load_catalog_state(cursor)
+            apply_plan(cursor, plan_grants(
+                state,
+                parameters,
+                batch=getattr(args, "batch_grants", False),
+                max_statement_size=getattr(args, "max_statement_size", DEFAULT_MAX_STATEMENT_SIZE),
+                run=run_state(args),
+            ), journal)
+        elif getattr(args, "backend", "sync") == "server":
+            _, _, failed = execute_server_side(cursor, iter_compile_grants(parameters))
+        elif getattr(args, "backend", "sync") == "pipeline":
+            execute_pipelined(args, iter_compile_grants(parameters), journal=journal)
+        elif getattr(args, "backend", "sync") == "async":
+            asyncio.run(execute_sharded_async(args, iter_table_grant_work(parameters), max(args.workers, 1),
+                                              journal=journal))
+        elif getattr(args, "workers", 1) > 1:
+            execute_sharded(args, iter_table_grant_work(parameters), args.workers, journal=journal)
+        elif getattr(args, "lock_timeout", 0) > 0:
+            _, failed = execute_lock_scheduled(cursor, iter_compile_grants(parameters), args.lock_timeout,
+                                               getattr(args, "lock_retries", DEFAULT_LOCK_RETRIES), journal)
+        else:
+            process_grants(
+                cursor,
+                parameters,
+                batch=getattr(args, "batch_grants", False),
+                max_statement_size=getattr(args, "max_statement_size", DEFAULT_MAX_STATEMENT_SIZE),
+                journal=journal,
+            )
+    else:
+        # Load parameters from the provided CSV file
+        parameters = load_parameters(args.parameter_file)
+        # Set role to current session user
+        set_role_to_session_user(cursor)
+        if getattr(args, "previous_parameter_file", None):
+            logging.info("Applying the changes from %s to %s...", args.previous_parameter_file, args.parameter_file)
+            with cluster_lock(args):
+                execute_plan(cursor, compile_task_delta(load_parameters(args.previous_parameter_file),
+                                                        parameters, args.dbname), snapshot={}, journal=journal)
+                commit_batch(cursor)
+        elif getattr(args, "plan", False):
+            with cluster_lock(args):
+                state = load_catalog_state(cursor)
+                apply_plan(cursor, plan_task(state, parameters, args), journal)
+                commit_batch(cursor)
+        elif getattr(args, "backend", "sync") == "server":
+            failed = execute_task_server(cursor, parameters, args)
+        elif getattr(args, "backend", "sync") == "async":
+            asyncio.run(execute_task_async(cursor, parameters, args, journal))
+        else:
+            # An empty snapshot is loaded on first use, inside execute_task's role section
+            failed = execute_task(cursor, parameters, args, snapshot={}, plan=plan, journal=journal)
+    if policy is not None:
+        failed += policy.skipped() - skipped
+    return failed
+
+
+def load_manifest(csv_file_path):
+    """
+    Load a database manifest CSV with a header and one "database,parameter_file" row per target.
+
+    Returns a list of (database, parameter_file) tuples; the parameter file may be None.
+    """
+    targets = []
+    with open(csv_file_path, "r", encoding="utf-8") as csv_file:
+        reader = csv.reader(csv_file)
+        next(reader, None)  # Skip header
+        for row in reader:
+            if not row or not row[0].strip():
+                continue
+            parameter_file = row[1].strip() if len(row) > 1 and row[1].strip() else None
+            targets.append((row[0].strip(), parameter_file))
+    logging.info("Loaded %d databases from manifest %s.", len(targets), csv_file_path)
+    return targets
+
+
+def database_targets(args):
+    """
+    Return the (database, parameter_file) targets of a run: the --manifest file, the
+    comma separated --databases list with the shared --parameter_file, or the single --dbname.
+    """
+    if getattr(args, "manifest", None):
+        return load_manifest(args.manifest)
+    if getattr(args, "databases", None):
+        return [(db.strip(), args.parameter_file) for db in args.databases.split(",") if db.strip()]
+    return [(args.dbname, args.parameter_file)]
+
+
+def provision_databases(args, targets):
+    """
+    Run args.task against many databases of one server.
+
+    A single postgres maintenance connection is shared by every target. create_database runs
+    one database at a time on it; other tasks run concurrently, at most --parallel_databases
+    at once, each on its own application connection.
+
+    Returns a list of per-database summaries: (database, status, seconds, error).
+    """
+    conn_postgres = connect(args, 'postgres')
+    conn_postgres.autocommit = True
+    profile = run_state(args).profile
+    if profile is not None:
+        profile.measure_round_trip(conn_postgres)
+
+    def provision(database, parameter_file):
+        target_args = argparse.Namespace(**vars(args))
+        target_args.dbname = database
+        target_args.parameter_file = parameter_file
+        started = time.perf_counter()
+        conn = None
+        try:
+            # The maintenance connection is shared between threads, so it always stays in autocommit
+            with conn_postgres.cursor() as cursor_postgres:
+                if args.task == "create_database":
+                    run_task(None, cursor_postgres, target_args)
+                else:
+                    conn = connect(args, database)
+                    conn.autocommit = True
+                    with open_cursor(conn, target_args) as cursor:
+                        run_task(cursor, cursor_postgres, target_args)
+            return database, "ok", time.perf_counter() - started, ""
+        except Exception as e:
+            logging.error("Task %s failed on database %s: %s", args.task, database, e)
+            return database, "failed", time.perf_counter() - started, " ".join(str(e).split())
+        finally:
+            if conn is not None:
+                conn.close()
+
+    try:
+        if args.task == "create_database":
+            summary = [provision(database, parameter_file) for database, parameter_file in targets]
+        else:
+            parallelism = max(getattr(args, "parallel_databases", 1), 1)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=parallelism) as executor:
+                futures = [executor.submit(contextvars.copy_context().run, provision, *target) for target in targets]
+                summary = [future.result() for future in futures]
+    finally:
+        conn_postgres.close()
+
+    logging.info("Per-database summary for task %s:", args.task)
+    for database, status, seconds, error in summary:
+        logging.info("  %-40s %-7s %8.3fs %s", database, status, seconds, error)
+    failed = sum(1 for entry in summary if entry[1] != "ok")
+    logging.info("%d of %d databases succeeded.", len(summary) - failed, len(summary))
+    return summary
+
+
+def load_inventory(csv_file_path):
+    """
+    Load a fleet inventory CSV with a header and one "host,port,database,task,parameter_file" row
+    per unit of work. An empty task means the --task given on the command line.
+
+    Returns a list of (host, port, database, task, parameter_file) tuples in file order.
+    """
+    inventory = []
+    with open(csv_file_path, "r", encoding="utf-8") as csv_file:
+        reader = csv.reader(csv_file)
+        next(reader, None)  # Skip header
+        for row in reader:
+            if len(row) < 3 or not row[0].strip():
+                continue
+            row = [value.strip() for value in row] + [""] * (5 - len(row))
+            host, port, database, task, parameter_file = row[:5]
+            inventory.append((host, int(port), database, task or None, parameter_file or None))
+    logging.info("Loaded %d inventory entries from %s.", len(inventory), csv_file_path)
+    return inventory
+
+
+def connection_lost(error, *connections):
+    """ Return True when error means the connection is gone rather than that a statement failed. """
+    if error.pgcode is None or error.pgcode.startswith("08"):
+        return True
+    return any(conn is not None and conn.closed for conn in connections)
+
+
+def run_target_with_retries(args):
+    """
+    Open the connections args points at and run args.task, retrying lost connections.
+
+    Only connection loss is retried, up to --retries times with exponential backoff and jitter:
+    a failed connection attempt, an SQLSTATE of class 08, or a connection the server closed.
+    Any other error, lock and statement timeouts included, fails the target immediately;
+    statement-level retries are RetryingCursor's under --continue_on_error.
+
+    Returns a (status, attempts, seconds, error) tuple.
+    """
+    retries = getattr(args, "retries", 3)
+    backoff = getattr(args, "retry_backoff", 1.0)
+    started = time.perf_counter()
+    attempt = 0
+    while True:
+        attempt += 1
+        conn = conn_postgres = None
+        try:
+            conn_postgres = connect(args, 'postgres')
+            conn_postgres.autocommit = True
+            with open_cursor(conn_postgres, args) as cursor_postgres:
+                if args.task == "create_database":
+                    run_task(None, cursor_postgres, args)
+                else:
+                    conn = connect(args)
+                    conn.autocommit = True
+                    with open_cursor(conn, args) as cursor:
+                        run_task(cursor, cursor_postgres, args)
+            return "ok", attempt, time.perf_counter() - started, ""
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            if not connection_lost(e, conn, conn_postgres):
+                logging.error("Task %s failed on %s:%s/%s (SQLSTATE %s, %s): %s", args.task, args.host, args.port,
+                              args.dbname, e.pgcode, classify_error(e.pgcode, e), e)
+                return "failed", attempt, time.perf_counter() - started, " ".join(str(e).split())
+            if attempt > retries:
+                logging.error("Giving up on %s:%s/%s after %d attempts: %s", args.host, args.port, args.dbname, attempt, e)
+                return "failed", attempt, time.perf_counter() - started, " ".join(str(e).split())
+            delay = backoff * 2 ** (attempt - 1) + random.uniform(0, backoff)
+            logging.warning("Connection error on %s:%s/%s (attempt %d), retrying in %.1f seconds: %s",
+                            args.host, args.port, args.dbname, attempt, delay, e)
+            time.sleep(delay)
+        except Exception as e:
+            logging.error("Task %s failed on %s:%s/%s: %s", args.task, args.host, args.port, args.dbname, e)
+            return "failed", attempt, time.perf_counter() - started, " ".join(str(e).split())
+        finally:
+            for connection in (conn, conn_postgres):
+                if connection is not None:
+                    connection.close()
+
+
+def run_inventory(args, inventory):
+    """
+    Run every inventory entry across the fleet.
+
+    Entries for the same (host, port, database) run in file order, so create_database can precede
+    create_datadog_role, the default task and execute_grants; an entry is skipped once an earlier
+    one for the same database failed. Databases run concurrently, at most --max_concurrency in total
+    and --per_host_concurrency per host.
+
+    Returns a list of results: (host, port, database, task, status, attempts, seconds, error).
+    """
+    chains = {}
+    for host, port, database, task, parameter_file in inventory:
+        chains.setdefault((host, port, database), []).append((task or args.task, parameter_file))
+
+    per_host = max(getattr(args, "per_host_concurrency", 2), 1)
+
+    def run_chain(key):
+        host, port, database = key
+        results = []
+        failed = False
+        for task, parameter_file in chains[key]:
+            if failed:
+                results.append((host, port, database, task, "skipped", 0, 0.0, "earlier task failed"))
+                continue
+            target_args = argparse.Namespace(**vars(args))
+            target_args.host, target_args.port, target_args.dbname = host, port, database
+            target_args.task, target_args.parameter_file = task, parameter_file
+            status, attempts, seconds, error = run_target_with_retries(target_args)
+            failed = status != "ok"
+            results.append((host, port, database, task, status, attempts, seconds, error))
+        return results
+
+    # Databases waiting for a slot on their host are held here rather than in a pool thread,
+    # so a busy host never keeps the pool from working on the others
+    waiting = {}
+    for key in chains:
+        waiting.setdefault(key[:2], collections.deque()).append(key)
+    chain_results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(getattr(args, "max_concurrency", 8), 1)) as executor:
+        running = {}
+
+        def submit(host):
+            key = waiting[host].popleft()
+            running[executor.submit(contextvars.copy_context().run, run_chain, key)] = (host, key)
+
+        # Interleave hosts so that the first pool threads are spread across them
+        for _ in range(per_host):
+            for host in waiting:
+                if waiting[host]:
+                    submit(host)
+        while running:
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                host, key = running.pop(future)
+                chain_results[key] = future.result()
+                if waiting[host]:
+                    submit(host)
+    results = [result for key in chains for result in chain_results[key]]
+
+    header = ("host", "port", "database", "task", "status", "attempts", "seconds", "error")
+    logging.info("Fleet results:")
+    logging.info("  %-30s %-6s %-30s %-20s %-8s %-8s %-9s %s", *header)
+    for host, port, database, task, status, attempts, seconds, error in results:
+        logging.info("  %-30s %-6s %-30s %-20s %-8s %-8d %8.3fs %s",
+                     host, port, database, task, status, attempts, seconds, error)
+    succeeded = sum(1 for result in results if result[4] == "ok")
+    logging.info("%d of %d inventory entries succeeded.", succeeded, len(results))
+
+    if getattr(args, "results_file", None):
+        with open(args.results_file, "w", encoding="utf-8", newline="") as results_file:
+            writer = csv.writer(results_file)
+            writer.writerow(header)
+            for host, port, database, task, status, attempts, seconds, error in results:
+                writer.writerow((host, port, database, task, status, attempts, f"{seconds:.3f}", error))
+        logging.info("Fleet results written to %s.", args.results_file)
+    return results
+
+
+def render_sql_step(step):
+    """
+    Render a plan step as psql input.
+
+    A guarded step is sent through \\gexec by a query returning it only while its guard still
+    holds, so the file can be applied again without failing on objects that already exist.
+    """
+    statement = step.statement.strip()
+    if step.guard is None:
+        return statement if statement.endswith(";") else statement + ";"
+    return f"SELECT {quote_literal(statement)} WHERE {guard_condition(step.guard)} \\gexec"
+
+
+def iter_task_sql(args, remote=False):
+    """
+    Yield, as psql input, the statements args.task would execute against args.dbname.
+
+    Nothing is read from the database: existence checks are rendered into the output instead,
+    see render_sql_step. Each task starts with a \\connect to the database it runs in; with
+    remote, the \\connect names args.host and args.port too. The execute_grants records are
+    streamed from the parameter file, so memory does not grow with its size.
+    """
+    def connect_line(dbname):
+        return f"\\connect {dbname} - {args.host} {args.port}" if remote else f"\\connect {dbname}"
+
+    if args.task == "create_database":
+        yield connect_line("postgres")
+        steps = compile_create_database(args.dbname)
+    elif args.task == "create_datadog_role":
+        if args.useDatadog != 'Enabled':
+            yield "-- Datadog role creation is disabled."
+            return
+        postgres_steps, steps = compile_datadog_role(args.dbname, args.username)
+        yield connect_line("postgres")
+        yield from map(render_sql_step, postgres_steps)
+        yield connect_line(args.dbname)
+    elif args.task == "execute_grants":
+        yield connect_line(args.dbname)
+        steps = iter_compile_grants(iter_grant_records(args.parameter_file))
+        if getattr(args, "previous_parameter_file", None):
+            steps = iter_grant_delta(args.previous_parameter_file, args.parameter_file)
+        elif getattr(args, "batch_grants", False):
+            max_statement_size = getattr(args, "max_statement_size", DEFAULT_MAX_STATEMENT_SIZE)
+            for privileges, role, grant_steps, _ in iter_grant_batches(steps, max_statement_size):
+                yield from batched_grant_statements(privileges, role, [step.obj for step in grant_steps],
+                                                    max_statement_size)
+            return
+    elif getattr(args, "previous_parameter_file", None):
+        yield connect_line(args.dbname)
+        steps = compile_task_delta(load_parameters(args.previous_parameter_file),
+                                   load_parameters(args.parameter_file), args.dbname)
+    else:
+        yield connect_line(args.dbname)
+        cluster_steps, set_role_step, grant_steps = split_task_plan(
+            compile_task(load_parameters(args.parameter_file), args.dbname))
+        if getattr(args, "merge_schema_grants", False):
+            grant_steps = merge_schema_grant_steps(
+                grant_steps, getattr(args, "max_statement_size", DEFAULT_MAX_STATEMENT_SIZE))
+        steps = itertools.chain(cluster_steps, (set_role_step,), grant_steps)
+    for step in steps:
+        yield render_sql_step(step)
+
+
+def emit_sql(args, out):
+    """
+    Write the SQL every target of the run would execute to out, a text file, for review and
+    for applying with psql -f. The output only depends on the arguments and input files.
+
+    Returns the number of statements written.
+    """
+    if getattr(args, "inventory", None):
+        targets = []
+        for host, port, database, task, parameter_file in load_inventory(args.inventory):
+            target_args = argparse.Namespace(**vars(args))
+            target_args.host, target_args.port, target_args.dbname = host, port, database
+            target_args.task, target_args.parameter_file = task or args.task, parameter_file
+            targets.append(target_args)
+    else:
+        targets = []
+        for database, parameter_file in database_targets(args):
+            target_args = argparse.Namespace(**vars(args))
+            target_args.dbname, target_args.parameter_file = database, parameter_file
+            targets.append(target_args)
+
+    statements = 0
+    out.write("-- Generated by postgres_Latest.py in dry-run mode; apply with psql -f.\n")
+    for target_args in targets:
+        out.write(f"\n-- Task {target_args.task} on database {target_args.dbname}"
+                  f" (parameter file {target_args.parameter_file})\n")
+        for line in iter_task_sql(target_args, remote=bool(getattr(args, "inventory", None))):
+            out.write(line)
+            out.write("\n")
+            statements += 0 if line.startswith(("\\", "--")) else 1
+    logging.info("Dry run: wrote %d statements for %d targets.", statements, len(targets))
+    return statements
+
+
+def write_metrics(args):
+    """ Write the metrics of the run of args to --metrics_file, when metrics are enabled. """
+    metrics = run_state(args).metrics
+    if metrics is None:
+        return
+    try:
+        metrics.write(args.metrics_file)
+        logging.info("Run metrics written to %s.", args.metrics_file)
+    except OSError as e:
+        logging.error("Could not write run metrics to %s: %s", args.metrics_file, e)
+
+
+def report_failures(args):
+    """ Log the failure report and write it to --failure_report, when --continue_on_error is given. """
+    policy = run_state(args).error_policy
+    if policy is None:
+        return None
+    failures = policy.failures
+    log_failure_report(failures)
+    if getattr(args, "failure_report", None):
+        with open(args.failure_report, "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, ["target", "source", "sqlstate", "classification", "attempts",
+                                        "statement", "message"])
+            writer.writeheader()
+            writer.writerows(failures)
+        logging.info("Failure report written to %s.", args.failure_report)
+    return failures
+
+
+def report_profile(args):
+    """ Log the profile of the run of args and write it to --profile_json, when profiling is enabled. """
+    profile = run_state(args).profile
+    if profile is None:
+        return None
+    report = profile.report()
+    log_profile(report)
+    if getattr(args, "profile_json", None):
+        with open(args.profile_json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        logging.info("Run profile written to %s.", args.profile_json)
+    return report
+
+
+def option_conflict(args):
+    """
+    Return why two of the given execution options cannot be combined, or None.
+
+    Each executor honours only some of the scheduling options, so a combination one of them
+    would silently ignore is refused up front instead.
+    """
+    backend = getattr(args, "backend", "sync")
+    workers = getattr(args, "workers", 1)
+    if getattr(args, "previous_parameter_file", None) and (
+            backend != "sync" or workers > 1 or getattr(args, "plan", False)
+            or getattr(args, "batch_grants", False) or getattr(args, "merge_schema_grants", False)
+            or getattr(args, "bulk_roles", False) or getattr(args, "lock_timeout", 0) > 0):
+        return ("--previous_parameter_file applies the changes in order on one connection and cannot be combined "
+                "with --backend, --workers, --plan, --batch_grants, --merge_schema_grants, --bulk_roles "
+                "or --lock_timeout")
+    if getattr(args, "plan", False) and (backend != "sync" or workers > 1 or getattr(args, "lock_timeout", 0) > 0):
+        return "--plan applies its plan on one connection and cannot be combined with --backend, --workers or --lock_timeout"
+    if workers > 1 and backend in ("pipeline", "server"):
+        return f"--backend {backend} runs on one connection and cannot be combined with --workers"
+    if getattr(args, "merge_schema_grants", False) and workers > 1 and backend == "sync":
+        return "--merge_schema_grants runs the merged grants on one connection and cannot be combined with --workers"
+    if getattr(args, "batch_grants", False) and (backend != "sync" or workers > 1):
+        return "--batch_grants requires the sync backend with one worker"
+    if getattr(args, "bulk_roles", False) and backend in ("async", "server"):
+        return f"--bulk_roles cannot be combined with --backend {backend}"
+    if getattr(args, "transaction_batch", 0) > 0 and backend in ("async", "server"):
+        return f"--transaction_batch cannot be combined with --backend {backend}"
+    if getattr(args, "lock_timeout", 0) > 0 and (backend != "sync" or workers > 1 or getattr(args, "batch_grants", False)):
+        return "--lock_timeout requires the sync backend with one worker and without --batch_grants"
+    if getattr(args, "journal_dir", None) and backend == "server":
+        return ("--backend server runs the plan inside DO blocks that keep no journal and cannot be combined "
+                "with --journal_dir")
+    return None
+
+
+# Idle connections a daemon keeps per (host, port, user, database), and how long they may sit unused
+DAEMON_POOL_SIZE = 2
+DAEMON_POOL_IDLE_SECONDS = 600
+
+# Idle time after which a pooled connection is checked with a round trip before it is handed out
+DAEMON_HEALTH_CHECK_SECONDS = 10
+
+# Arguments naming files, resolved by the client since the daemon runs in another directory
+PATH_ARGUMENTS = ("parameter_file", "previous_parameter_file", "manifest", "inventory", "results_file",
+                  "profile_json", "emit_sql", "journal_dir", "metrics_file", "plan_cache_dir", "failure_report")
+
+
+class ConnectionPools:
+    """
+    Warm autocommit connections of a daemon, per (host, port, user, database).
+
+    A connection idle for more than DAEMON_HEALTH_CHECK_SECONDS is checked before it is handed
+    out, and a returned one is reset with DISCARD ALL, so a job never sees the role, settings
+    or locks of the one before it.
+    """
+
+    def __init__(self):
+        # {(host, port, user, dbname): [(connection, returned at)]}
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def checkout(self, args, dbname=None):
+        key = (args.host, str(args.port), args.username, dbname or args.dbname)
+        now = time.monotonic()
+        while True:
+            with self.lock:
+                idle = self.idle.get(key, [])
+                conn, returned = idle.pop() if idle else (None, None)
+            if conn is None:
+                conn = connect(args, dbname)
+                conn.autocommit = True
+                return conn
+            if conn.closed or now - returned > DAEMON_POOL_IDLE_SECONDS:
+                conn.close()
+                continue
+            if now - returned > DAEMON_HEALTH_CHECK_SECONDS:
+                try:
+                    with conn.cursor() as cursor:
+                        cursor.execute("SELECT 1;")
+                except psycopg2.Error as e:
+                    logging.info("Dropping a pooled connection to %s that failed its health check: %s",
+                                 describe_connection(conn), e)
+                    conn.close()
+                    continue
+            conn.attach(getattr(args, "run_state", None))
+            return conn
+
+    def checkin(self, conn):
+        conn.attach(None)
+        if conn.closed:
+            return
+        try:
+            if not conn.autocommit:
+                conn.rollback()
+                conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute("DISCARD ALL;")
+        except psycopg2.Error:
+            conn.close()
+            return
+        key = (conn.info.host, str(conn.info.port), conn.info.user, conn.info.dbname)
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < DAEMON_POOL_SIZE:
+                idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for conn, _ in idle:
+                    conn.close()
+            self.idle.clear()
+
+
+class JobStream:
+    """ Reply stream of a daemon job: JSON lines of logs and output, then the exit status. """
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        """ Send message to the client, returning False once the client has gone away. """
+        with self.lock:
+            if self.wfile is None:
+                return False
+            try:
+                self.wfile.write((json.dumps(message) + "\n").encode("utf-8"))
+                self.wfile.flush()
+            except OSError:
+                # The client went away; the job still runs to completion
+                self.wfile = None
+                return False
+            return True
+
+
+class JobOutput:
+    """ Text file forwarding what a daemon job prints, e.g. the SQL of --dry_run, to its client's stdout. """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        if text:
+            self.stream.send({"stdout": text})
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+# Reply stream of the daemon job the current thread works for; threads a job starts inherit it
+CURRENT_JOB = contextvars.ContextVar("current_job", default=None)
+
+
+class JobLogHandler(logging.Handler):
+    """
+    Logging handler streaming the records of a daemon job to its client, one JSON line each.
+
+    Only records logged on behalf of the job reach it, not those of jobs running alongside.
+    """
+
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+        self.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+
+    def filter(self, record):
+        return CURRENT_JOB.get() is self.stream and super().filter(record)
+
+    def emit(self, record):
+        self.stream.send({"log": self.format(record)})
+
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Daemon accepting jobs on a Unix socket and running them concurrently with warm connections.
+
+    Every job has its own run state (see RunState), so jobs only take turns where they change
+    cluster-wide objects of the same server, see cluster_lock.
+    """
+    daemon_threads = True
+
+    def __init__(self, path):
+        self.pools = ConnectionPools()
+        super().__init__(path, JobRequestHandler)
+        os.chmod(path, 0o600)
+
+
+class JobRequestHandler(socketserver.StreamRequestHandler):
+    """ Run the job sent as one JSON line of arguments, streaming its logs and then its exit status. """
+
+    def handle(self):
+        try:
+            job = argparse.Namespace(**json.loads(self.rfile.readline()))
+        except (ValueError, TypeError) as e:
+            self.reply({"status": 2, "error": f"Invalid job: {e}"})
+            return
+        stream = JobStream(self.wfile)
+        handler = JobLogHandler(stream)
+        status = 0
+        job_token = CURRENT_JOB.set(stream)
+        logging.getLogger().addHandler(handler)
+        try:
+            logging.info("Running job %s on %s:%s/%s.", job.task, job.host, job.port, job.dbname)
+            main(job, self.server.pools, JobOutput(stream))
+        except Exception:
+            logging.exception("Job %s failed.", job.task)
+            status = 1
+        finally:
+            logging.getLogger().removeHandler(handler)
+            CURRENT_JOB.reset(job_token)
+        stream.send({"status": status})
+
+    def reply(self, message):
+        JobStream(self.wfile).send(message)
+
+
+def serve(path):
+    """ Run the job daemon on the Unix socket at path until interrupted. """
+    if os.path.exists(path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(path)
+            except OSError:
+                os.unlink(path)  # Left behind by a daemon that did not shut down cleanly
+            else:
+                raise RuntimeError(f"A daemon is already listening on {path}")
+    server = JobServer(path)
+    logging.info("Daemon listening on %s.", path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Daemon shutting down.")
+    finally:
+        server.server_close()
+        server.pools.close()
+        os.unlink(path)
+
+
+def submit_job(args):
+    """
+    Send args as a job to the daemon listening on args.submit, print its logs and output as
+    they arrive and return its exit status.
+    """
+    job = {name: value for name, value in vars(args).items() if name not in ("serve", "submit", "run_state")}
+    for name in PATH_ARGUMENTS:
+        if job.get(name):
+            job[name] = os.path.abspath(job[name])
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(args.submit)
+        client.sendall((json.dumps(job) + "\n").encode("utf-8"))
+        with client.makefile("r", encoding="utf-8") as replies:
+            for line in replies:
+                reply = json.loads(line)
+                if "log" in reply:
+                    print(reply["log"], file=sys.stderr, flush=True)
+                elif "stdout" in reply:
+                    sys.stdout.write(reply["stdout"])
+                else:
+                    if reply.get("error"):
+                        print(reply["error"], file=sys.stderr)
+                    return reply["status"]
+    print("The daemon closed the connection before the job finished.", file=sys.stderr)
+    return 1
+
+
+def main(args, pools=None, stdout=None):
+    """
+    Main function that parses command-line arguments, loads parameters from a CSV file,
+    connects to the PostgreSQL database, and executes a series of operations to create users,
+    roles, schemas, alter database ownership, and grant various privileges.
+
+    A daemon passes the warm connection pools and stdout, the client's standard output.
+    """
+    # Connect to the PostgreSQL database using the provided credentials
+    """
+    Main function to handle database setup and operations.
+    """
+    started = time.perf_counter()
+    # Every run, and every job of a daemon, has its own profile, metrics, error policy and throttles
+    args.run_state = RunState.from_args(args)
+
+    if getattr(args, "dry_run", False) or getattr(args, "emit_sql", None):
+        if getattr(args, "emit_sql", None):
+            with open(args.emit_sql, "w", encoding="utf-8") as out:
+                statements = emit_sql(args, out)
+            logging.info("SQL plan written to %s.", args.emit_sql)
+        else:
+            statements = emit_sql(args, stdout or sys.stdout)
+        logging.info("Script execution completed in %.3f seconds.", time.perf_counter() - started)
+        return statements
+
+    if getattr(args, "inventory", None):
+        results = run_inventory(args, load_inventory(args.inventory))
+        report_throttles(args)
+        write_metrics(args)
+        report_failures(args)
+        report_profile(args)
+        logging.info("Script execution completed in %.3f seconds.", time.perf_counter() - started)
+        return results
+
+    targets = database_targets(args)
+    # A --databases list of one still names its database through the list, not --dbname
+    if getattr(args, "manifest", None) or getattr(args, "databases", None) or len(targets) > 1:
+        summary = provision_databases(args, targets)
+        report_throttles(args)
+        write_metrics(args)
+        report_failures(args)
+        report_profile(args)
+        logging.info("Script execution completed in %.3f seconds.", time.perf_counter() - started)
+        return summary
+
+    # Connect to the PostgreSQL Application database using the provided credentials,
+    # or take warm connections from the pools of a daemon
+    conn = pools.checkout(args) if pools is not None else connect(args)
+    conn.autocommit = True
+    cursor = open_cursor(conn, args)
+    if args.run_state.profile is not None:
+        args.run_state.profile.measure_round_trip(conn)
+
+    # Connect to the PostgreSQL database using the provided credentials
+    conn_postgres = pools.checkout(args, 'postgres') if pools is not None else connect(args, 'postgres')
+    conn_postgres.autocommit = True
+    cursor_postgres = open_cursor(conn_postgres, args)
+
+    try:
+        run_task(cursor, cursor_postgres, args)
+    finally:
+        # Close the cursors and connections; closing a batching cursor commits its open batch
+        cursor_postgres.close()
+        cursor.close()
+        if pools is not None:
+            pools.checkin(conn_postgres)
+            pools.checkin(conn)
+        else:
+            conn_postgres.close()
+            conn.close()
+        # Failed runs are the ones alerts need to see
+        report_throttles(args)
+        write_metrics(args)
+        report_failures(args)
 
-    logging.info("Script execution completed.")
+    report_profile(args)
+    logging.info("Script execution completed in %.3f seconds.", time.perf_counter() - started)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--host", type=str, required=True, help="Database host")
-    parser.add_argument("-p", "--port", type=int, required=True, help="Database port")
+    parser.add_argument("--host", type=str, help="Database host")
+    parser.add_argument("-p", "--port", type=int, help="Database port")
     parser.add_argument("-U", "--username", type=str, required=True, help="PostgreSQL user")
-    parser.add_argument("-d", "--dbname", type=str, required=True, help="Database name")
+    parser.add_argument("-d", "--dbname", type=str, help="Database name")
+    parser.add_argument("--databases", type=str, help="Comma separated list of databases to run the task against")
+    parser.add_argument("--manifest", type=str, help="CSV file mapping databases to parameter files")
+    parser.add_argument("--parallel_databases", type=int, default=4,
+                        help="Maximum number of databases provisioned at the same time")
     parser.add_argument("--parameter_file", type=str, help="CSV parameter file")
-    parser.add_argument("--task", type=str, required=True, help="Specify a task to run")
+    parser.add_argument("--task", type=str, help="Specify a task to run")
+    parser.add_argument("--previous_parameter_file", type=str,
+                        help="Previous version of the parameter file; only the rows changed since are applied, "
+                             "and grants and memberships no longer listed are revoked")
     parser.add_argument("--useDatadog", type=str, help="Enable or disable Datadog role creation")
+    parser.add_argument("--batch_grants", action="store_true",
+                        help="Group execute_grants tables by grant kind and role into multi-table GRANT statements")
+    parser.add_argument("--max_statement_size", type=int, default=DEFAULT_MAX_STATEMENT_SIZE,
+                        help="Maximum size in characters of a batched GRANT statement")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of parallel connections used for table and schema grants")
+    parser.add_argument("--backend", choices=["sync", "async", "server", "pipeline"], default="sync",
+                        help="Execution backend; async runs statements over --workers asynchronous connections, "
+                             "server sends the whole plan as PL/pgSQL DO blocks, pipeline streams grants "
+                             "through psycopg 3 pipeline mode")
+    parser.add_argument("--merge_schema_grants", action="store_true",
+                        help="Combine schema grants into one statement per privilege set, covering many schemas and roles")
+    parser.add_argument("--bulk_roles", action="store_true",
+                        help="Find missing users, roles and memberships in one catalog query each, and create "
+                             "and grant them with as few statements as possible")
+    parser.add_argument("--transaction_batch", type=int, default=0,
+                        help="Commit every N statements, each under its own savepoint, instead of autocommitting each one")
+    parser.add_argument("--lock_timeout", type=int, default=0,
+                        help="Run grants under this lock_timeout in milliseconds, deferring the ones blocked by "
+                             "other transactions and retrying them after the rest with growing timeouts")
+    parser.add_argument("--lock_retries", type=int, default=DEFAULT_LOCK_RETRIES,
+                        help="Retry rounds of statements deferred by --lock_timeout, each doubling the timeout")
+    parser.add_argument("--max_replication_lag", type=float, default=0,
+                        help="Pause and slow down while the replay lag of any standby exceeds this many seconds")
+    parser.add_argument("--max_replication_lag_bytes", type=int, default=0,
+                        help="Pause and slow down while any standby is more than this many bytes of WAL behind")
+    parser.add_argument("--max_active_sessions", type=int, default=0,
+                        help="Pause and slow down while the server has more active client sessions than this")
+    parser.add_argument("--throttle_interval", type=float, default=1.0,
+                        help="Seconds between replication lag and load samples of the throttle")
+    parser.add_argument("--plan", action="store_true",
+                        help="Read the catalog once and execute only the statements that are missing")
+    parser.add_argument("--inventory", type=str,
+                        help="CSV file listing host, port, database, task and parameter file for a fleet run")
+    parser.add_argument("--max_concurrency", type=int, default=8,
+                        help="Maximum number of databases worked on at once across the fleet")
+    parser.add_argument("--per_host_concurrency", type=int, default=2,
+                        help="Maximum number of databases worked on at once per host")
+    parser.add_argument("--retries", type=int, default=3, help="Retries for connection errors")
+    parser.add_argument("--retry_backoff", type=float, default=1.0,
+                        help="Base delay in seconds for exponential retry backoff")
+    parser.add_argument("--continue_on_error", action="store_true",
+                        help="Retry statements failing with a transient error on a fresh connection, skip those "
+                             "failing because of a bad parameter row, and report every failure at the end")
+    parser.add_argument("--failure_report", type=str,
+                        help="Write the failures of a --continue_on_error run, with their CSV rows, to this CSV file")
+    parser.add_argument("--results_file", type=str, help="Write the fleet result table to this CSV file")
+    parser.add_argument("--profile", action="store_true",
+                        help="Time every statement and log a latency profile at the end of the run")
+    parser.add_argument("--profile_json", type=str, help="Write the latency profile to this JSON file (implies --profile)")
+    parser.add_argument("--profile_top", type=int, default=10, help="Number of slowest statements in the profile")
+    parser.add_argument("--dry_run", action="store_true",
+                        help="Print the SQL the task would execute instead of connecting to the database")
+    parser.add_argument("--emit_sql", type=str,
+                        help="Write the SQL the task would execute to this file for psql -f (implies --dry_run)")
+    parser.add_argument("--journal_dir", type=str,
+                        help="Directory of progress journals recording the statements each run has applied")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip the statements an interrupted run with the same parameter file and target "
+                             "already applied (requires --journal_dir, not available with --backend server)")
+    parser.add_argument("--metrics_file", type=str,
+                        help="Write run metrics in OpenMetrics format to this file, e.g. a *.prom file "
+                             "in the node_exporter textfile collector directory")
+    parser.add_argument("--plan_cache_dir", type=str,
+                        help="Directory caching compiled plans; unchanged parameter files against an unchanged catalog are skipped")
+    parser.add_argument("--plan_cache_size", type=int, default=DEFAULT_PLAN_CACHE_SIZE,
+                        help="Maximum size in bytes of the plan cache; least recently used plans are evicted")
+    parser.add_argument("--serve", type=str,
+                        help="Run as a daemon accepting jobs on this Unix socket, with warm connection pools")
+    parser.add_argument("--submit", type=str,
+                        help="Run the job on the daemon listening on this Unix socket, streaming back its logs")
     args = parser.parse_args()
+    if args.serve:
+        serve(args.serve)
+        sys.exit(0)
+    if not args.inventory:
+        if args.task is None:
+            parser.error("--task is required unless --inventory is given")
+        if (args.host is None or args.port is None) and not (args.dry_run or args.emit_sql):
+            parser.error("--host and --port are required unless --inventory, --dry_run or --emit_sql is given")
+        if not (args.dbname or args.databases or args.manifest):
+            parser.error("one of --dbname, --databases or --manifest is required")
+    if args.resume and not args.journal_dir:
+        parser.error("--resume requires --journal_dir")
+    if args.continue_on_error and args.transaction_batch > 0:
+        parser.error("--continue_on_error cannot be combined with --transaction_batch")
+    if option_conflict(args):
+        parser.error(option_conflict(args))
+    if args.failure_report and not args.continue_on_error:
+        parser.error("--failure_report requires --continue_on_error")
+    if args.backend == "pipeline" and psycopg is None:
+        parser.error("--backend pipeline requires psycopg 3 (pip install psycopg)")
+    if args.submit:
+        sys.exit(submit_job(args))
     main(args)
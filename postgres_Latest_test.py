@@ -1,9 +1,14 @@
 import csv
 import uuid
+import asyncio
 import time
+import threading
+import socket
 import pytest
+import json
 import logging
 import psycopg2
+import postgres_Latest
 from pathlib import Path
 from argparse import Namespace
 
@@ -13,6 +18,16 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # Import the functions to be tested from the user_creation_basic.py script
 from postgres_Latest import (
     load_parameters,
+    iter_grant_records,
+    compile_task,
+    compile_grants,
+    merge_schema_grant_steps,
+    merge_membership_steps,
+    compile_task_delta,
+    iter_grant_delta,
+    execute_plan,
+    execute_cluster_steps_bulk,
+    split_task_plan,
     create_user,
     create_role,
     create_schema,
@@ -22,6 +37,39 @@ from postgres_Latest import (
     grant_role_ro,
     grant_role_rw,
     grant_role_tr,
+    provision_databases,
+    load_inventory,
+    run_inventory,
+    run_target_with_retries,
+    process_grants,
+    iter_table_grant_work,
+    execute_sharded,
+    execute_sharded_async,
+    load_catalog_snapshot,
+    invalidate_catalog_snapshot,
+    is_role_assigned,
+    load_catalog_state,
+    plan_task,
+    plan_grants,
+    apply_plan,
+    run_task,
+    plan_cache_key,
+    plan_cache_lookup,
+    plan_cache_store,
+    load_cached_plan,
+    open_cursor,
+    execute_server_side,
+    execute_pipelined,
+    describe_statement,
+    PlanStep,
+    ErrorPolicy,
+    RunState,
+    connect,
+    run_state,
+    Journal,
+    option_conflict,
+    JobServer,
+    submit_job,
     main
 )
 
@@ -84,6 +132,35 @@ def cursor(db_conn):
     cur.close()
 
 
+@pytest.fixture
+def connection_args(db_conn):
+    """
+    A fixture that provides the connection arguments of the test database as a Namespace,
+    for functions that open their own connections.
+    """
+    dsn_parts = dict(item.split("=") for item in db_conn.dsn.split())
+    return Namespace(
+        host=dsn_parts.get("host", "localhost"),
+        port=dsn_parts.get("port", "5432"),
+        username=dsn_parts.get("user", "postgres"),
+        dbname=dsn_parts.get("dbname", "test_db"),
+    )
+
+
+@pytest.fixture
+def policy_cursor(connection_args):
+    """
+    A fixture that provides a cursor of a run under --continue_on_error, without retries.
+    Its error policy is run_state(policy_cursor).error_policy.
+    """
+    conn = connect(Namespace(**vars(connection_args), run_state=RunState(error_policy=ErrorPolicy(retries=0))))
+    conn.autocommit = True
+    cur = conn.cursor()
+    yield cur
+    cur.close()
+    conn.close()
+
+
 @pytest.fixture
 def temp_csv_file(tmp_path: Path):
     """
@@ -169,6 +246,208 @@ def test_load_parameters(temp_csv_file):
 
 
 
+def test_iter_grant_records(temp_csv_file):
+    """
+    Test for the iter_grant_records generator.
+    Records are yielded one table at a time, duplicates within a row are dropped,
+    and a key/value file yields nothing.
+    """
+    test_data = [
+        ["permissions", "tables", "role"],
+        ["Tables_To_Receive_Grant_Select", "table1, table2, table1", "role_reader"],
+        ["tables_to_receive_grant_full", "table3", "role_writer"],
+        ["incomplete_row"],
+    ]
+    with temp_csv_file.open("w", encoding="utf-8", newline="") as f:
+        csv.writer(f).writerows(test_data)
+
+    records = iter_grant_records(str(temp_csv_file))
+    assert not isinstance(records, list)
+    assert list(records) == [
+        ("tables_to_receive_grant_select", "table1", "role_reader"),
+        ("tables_to_receive_grant_select", "table2", "role_reader"),
+        ("tables_to_receive_grant_full", "table3", "role_writer"),
+    ]
+
+    with temp_csv_file.open("w", encoding="utf-8", newline="") as f:
+        csv.writer(f).writerows([["key", "value"], ["user_owner", "admin"]])
+    assert list(iter_grant_records(str(temp_csv_file))) == []
+
+
+def test_compile_task():
+    """
+    Test for the compile_task plan compiler.
+    Compilation needs no database, is deterministic, and links every step to the steps
+    creating the objects it needs.
+    """
+    parameters = {
+        "user_owner": ["owner"],
+        "another_users": ["user1"],
+        "role_ro": ["role_ro"],
+        "users_to_receive_role_ro": ["user1"],
+        "schema_list": ["schema1"],
+        "schema_ro_list": ["schema1"],
+    }
+    plan = compile_task(parameters, "app_db")
+    assert plan == compile_task(parameters, "app_db")
+    assert isinstance(plan, tuple)
+
+    steps = {step.statement: step for step in plan}
+    membership = steps["GRANT role_ro TO user1;"]
+    assert membership.guard == ("membership", ("role_ro", "user1"))
+    assert {plan[i].statement for i in membership.depends_on} == {"CREATE ROLE role_ro;", "CREATE USER user1;"}
+
+    default_grant = steps["ALTER DEFAULT PRIVILEGES IN SCHEMA schema1 GRANT SELECT ON TABLES TO role_ro;"]
+    assert {plan[i].category for i in default_grant.depends_on} == {"create_schema", "create_role", "set_role"}
+    assert all(i < step.index for step in plan for i in step.depends_on)
+
+
+def test_compile_grants():
+    """
+    Test for the compile_grants plan compiler.
+    Each table of a record becomes one independent step that remembers the record it came from.
+    """
+    plan = compile_grants([
+        ("tables_to_receive_grant_select", ["table2", "table1"], "role_reader"),
+        ("tables_to_receive_grant_unknown", ["table3"], "role_reader"),
+        ("tables_to_receive_grant_full", ["table3"], "role_writer"),
+    ])
+    assert [(step.statement, step.source) for step in plan] == [
+        ("GRANT SELECT ON table1 TO role_reader;", 1),
+        ("GRANT SELECT ON table2 TO role_reader;", 1),
+        ("GRANT SELECT, INSERT, UPDATE, DELETE ON table3 TO role_writer;", 3),
+    ]
+    assert all(step.depends_on == () for step in plan)
+
+
+def test_process_csv_grants():
+    """
+    Test for process_csv.py on the shared grant compiler.
+    Permission types are matched by the words they contain, as process_csv.py always did.
+    """
+    from process_csv import process_grants
+    assert process_grants([
+        {"permissions": "full_access", "tables": ["t1"], "role": "r1"},
+        {"permissions": "select_and_usage", "tables": ["s1"], "role": "r2"},
+        {"permissions": "tables_to_receive_grant_select", "tables": ["t2"], "role": "r3"},
+        {"permissions": "tables_to_receive_grant_none", "tables": ["t3"], "role": "r4"},
+    ]) == [
+        "GRANT SELECT, INSERT, UPDATE, DELETE ON t1 TO r1;",
+        "GRANT SELECT, USAGE ON s1 TO r2;",
+        "GRANT SELECT ON t2 TO r3;",
+    ]
+
+
+def test_compile_task_delta():
+    """
+    Test for the incremental plan of key/value parameters.
+    Memberships and schema grants dropped from the parameters are revoked before the new ones
+    are granted, and the schema grants run as the owner.
+    """
+    old_parameters = {
+        "user_owner": ["app_owner"],
+        "another_users": ["u1", "u2"],
+        "role_ro": ["app_ro"],
+        "users_to_receive_role_ro": ["u1", "u2"],
+        "schema_ro_list": ["s1"],
+    }
+    new_parameters = dict(old_parameters, another_users=["u1", "u3"], users_to_receive_role_ro=["u1", "u3"],
+                          schema_ro_list=["s2"])
+    statements = [step.statement for step in compile_task_delta(old_parameters, new_parameters, "app_db")]
+    logging.info(f"Delta statements: {statements}")
+
+    assert statements[:4] == ["REVOKE app_ro FROM u2;", "CREATE USER u3;", "GRANT app_ro TO u3;", "SET ROLE app_owner;"]
+    assert "REVOKE USAGE ON SCHEMA s1 FROM app_ro;" in statements
+    assert "ALTER DEFAULT PRIVILEGES IN SCHEMA s1 REVOKE SELECT ON TABLES FROM app_ro;" in statements
+    assert statements.index("REVOKE SELECT ON ALL TABLES IN SCHEMA s1 FROM app_ro;") < statements.index(
+        "GRANT USAGE ON SCHEMA s2 TO app_ro;")
+    assert "DROP" not in " ".join(statements)
+    assert compile_task_delta(old_parameters, old_parameters, "app_db") == ()
+
+    # With a new owner, the old grants are revoked as the old owner and the new ones made as the new owner
+    new_parameters = dict(new_parameters, user_owner=["new_owner"])
+    statements = [step.statement for step in compile_task_delta(old_parameters, new_parameters, "app_db")]
+    logging.info(f"Owner change statements: {statements}")
+    revoke = statements.index("ALTER DEFAULT PRIVILEGES IN SCHEMA s1 REVOKE SELECT ON TABLES FROM app_ro;")
+    grant = statements.index("GRANT USAGE ON SCHEMA s2 TO app_ro;")
+    assert statements.index("SET ROLE app_owner;") < revoke < statements.index("SET ROLE new_owner;") < grant
+
+
+def test_iter_grant_delta(tmp_path, cursor):
+    """
+    Test for the incremental plan of permissions/tables/role files.
+    Both files go through the external sort (with tiny runs here) and only the changed
+    privileges of each table and role are revoked or granted.
+    """
+    test_schema = "test_schema_" + uuid.uuid4().hex[:8]
+    test_role = "test_role_delta_" + uuid.uuid4().hex[:8]
+    old_file, new_file = tmp_path / "old.csv", tmp_path / "new.csv"
+    for path, rows in [
+        (old_file, [("tables_to_receive_grant_full", f"{test_schema}.t1", test_role),
+                    ("tables_to_receive_grant_select", f"{test_schema}.t2,{test_schema}.t3", test_role),
+                    ("tables_to_receive_grant_select", f"{test_schema}.t3", test_role)]),
+        (new_file, [("tables_to_receive_grant_select", f"{test_schema}.t3,{test_schema}.t2", test_role),
+                    ("tables_to_receive_grant_select", f"{test_schema}.t1", test_role),
+                    ("tables_to_receive_grant_select", f"{test_schema}.t4", test_role)]),
+    ]:
+        with path.open("w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["permissions", "tables", "role"])
+            writer.writerows(rows)
+
+    steps = list(iter_grant_delta(str(old_file), str(new_file), run_size=2))
+    assert [step.statement for step in steps] == [
+        f"REVOKE DELETE, INSERT, UPDATE ON {test_schema}.t1 FROM {test_role};",
+        f"GRANT SELECT ON {test_schema}.t4 TO {test_role};",
+    ]
+    assert [step.source for step in steps] == ["2", "4"]
+
+    try:
+        cursor.execute(f"CREATE SCHEMA {test_schema};")
+        for table in ("t1", "t2", "t3", "t4"):
+            cursor.execute(f"CREATE TABLE {test_schema}.{table} (id int);")
+        cursor.execute(f"CREATE ROLE {test_role};")
+        process_grants(cursor, iter_grant_records(str(old_file)))
+        execute_plan(cursor, steps)
+        cursor.execute("SELECT has_table_privilege(%s, %s, 'SELECT'), has_table_privilege(%s, %s, 'INSERT'), "
+                       "has_table_privilege(%s, %s, 'SELECT')",
+                       (test_role, f"{test_schema}.t1", test_role, f"{test_schema}.t1", test_role, f"{test_schema}.t4"))
+        assert cursor.fetchone() == (True, False, True)
+    finally:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {test_schema} CASCADE;")
+        cursor.execute(f"DROP ROLE IF EXISTS {test_role};")
+
+
+def test_merge_schema_grant_steps():
+    """
+    Test for merged schema grants.
+    Privileges of one role on the same object kind are combined, schemas sharing a privilege
+    set are granted in one statement, and roles sharing it on the same schemas share the statement.
+    """
+    parameters = {
+        "user_owner": ["app_owner"],
+        "role_ro": ["app_ro"],
+        "role_rw": ["app_rw"],
+        "schema_ro_list": ["s1", "s2"],
+        "schema_rw_list": ["s1", "s2"],
+    }
+    _, _, grant_steps = split_task_plan(compile_task(parameters, "app_db"))
+    statements = [step.statement for step in merge_schema_grant_steps(grant_steps)]
+    logging.info(f"Merged statements: {statements}")
+
+    assert len(grant_steps) == 36
+    assert statements[0] == "GRANT USAGE ON SCHEMA s1, s2 TO app_ro, app_rw;"
+    assert "GRANT SELECT, INSERT, UPDATE, DELETE ON ALL TABLES IN SCHEMA s1, s2 TO app_rw;" in statements
+    assert "GRANT USAGE, SELECT, UPDATE ON ALL SEQUENCES IN SCHEMA s1, s2 TO app_rw;" in statements
+    assert ("ALTER DEFAULT PRIVILEGES IN SCHEMA s1, s2 GRANT USAGE, SELECT ON SEQUENCES TO app_ro;"
+            in statements)
+    assert len(statements) == 9
+
+    # Statements are split on schema boundaries to respect the size limit
+    split = merge_schema_grant_steps(grant_steps, max_statement_size=40)
+    assert "GRANT USAGE ON SCHEMA s1 TO app_ro, app_rw;" in [step.statement for step in split]
+
+
 def test_create_user(cursor):
     """
     Test for create_user function.
@@ -274,6 +553,119 @@ def test_grant_role_to_user(cursor):
         cursor.execute(f"DROP ROLE IF EXISTS {test_role};")
 
 
+def test_catalog_snapshot(cursor):
+    """
+    Test for the catalog snapshot.
+    Objects created through the helpers are added to the snapshot, objects created behind its back
+    only become visible after the snapshot is invalidated.
+    """
+    test_role = "test_role_" + uuid.uuid4().hex[:8]
+    test_user = "test_user_" + uuid.uuid4().hex[:8]
+    try:
+        snapshot = load_catalog_snapshot(cursor)
+        create_role(cursor, test_role, snapshot)
+        assert test_role in snapshot["roles"]
+        cursor.execute(f"CREATE USER {test_user};")
+        assert test_user not in snapshot["roles"]
+        grant_role_to_user(cursor, test_role, test_user, snapshot)
+        assert is_role_assigned(cursor, test_role, test_user, snapshot)
+
+        invalidate_catalog_snapshot(snapshot)
+        assert is_role_assigned(cursor, test_role, test_user, snapshot)
+        assert test_user in snapshot["roles"]
+    finally:
+        cursor.execute(f"DROP USER IF EXISTS {test_user};")
+        cursor.execute(f"DROP ROLE IF EXISTS {test_role};")
+
+
+def test_bulk_roles_journal_and_errors(tmp_path, policy_cursor):
+    """
+    Test for bulk roles under the journal and the error policy.
+    Bulk-created roles are journaled, and a membership naming a missing member is skipped and
+    reported instead of aborting the run.
+    """
+    suffix = uuid.uuid4().hex[:8]
+    user, role, ghost = f"test_bulk_user_{suffix}", f"test_bulk_ro_{suffix}", f"test_bulk_ghost_{suffix}"
+    cursor = policy_cursor
+    policy = run_state(cursor).error_policy
+    steps = (
+        PlanStep(0, f"CREATE USER {user};", "create_user", user, None, None, (), ("role", user), "another_users"),
+        PlanStep(1, f"CREATE ROLE {role};", "create_role", role, None, None, (), ("role", role), "role_ro"),
+        PlanStep(2, f"GRANT {role} TO {ghost};", "grant_membership", role, ghost, None, (),
+                 ("membership", (role, ghost)), "users_to_receive_role_ro"),
+    )
+    journal_file = tmp_path / "bulk.journal"
+    journal = Journal(str(journal_file))
+    try:
+        assert execute_cluster_steps_bulk(cursor, steps, journal=journal) == 2
+        assert [failure["sqlstate"] for failure in policy.failures] == ["42704"]
+        journal.close(complete=False)
+        resumed = Journal(str(journal_file), resume=True)
+        assert len(resumed.completed) == 2
+        resumed.close(complete=True)
+    finally:
+        cursor.execute(f"DROP ROLE IF EXISTS {user}; DROP ROLE IF EXISTS {role};")
+
+
+def test_snapshot_skips_failed_steps(policy_cursor):
+    """
+    Test for guards of failed steps.
+    A schema creation skipped under the error policy is not recorded in the snapshot, so a later
+    step creating the same schema still runs.
+    """
+    cursor = policy_cursor
+    test_schema = "test_schema_" + uuid.uuid4().hex[:8]
+    failing = PlanStep(0, f"CREATE SCHEMA {test_schema} AUTHORIZATION missing_owner_{uuid.uuid4().hex[:8]};",
+                       "create_schema", test_schema, None, None, (), ("schema", test_schema), "schemas")
+    creating = failing._replace(index=1, statement=f"CREATE SCHEMA {test_schema};")
+    try:
+        snapshot = load_catalog_snapshot(cursor)
+        assert execute_plan(cursor, [failing], snapshot) == 0
+        assert test_schema not in snapshot["schemas"]
+        assert execute_plan(cursor, [creating], snapshot) == 1
+        assert test_schema in snapshot["schemas"]
+    finally:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {test_schema};")
+
+
+def test_execute_cluster_steps_bulk(cursor):
+    """
+    Test for bulk role creation and membership grants.
+    Missing users and roles are created in one round trip, memberships already held are left out,
+    and members receiving the same roles share one multi-target GRANT statement.
+    """
+    suffix = uuid.uuid4().hex[:8]
+    users = [f"test_bulk_user{i}_{suffix}" for i in range(3)]
+    role_ro, role_rw = f"test_bulk_ro_{suffix}", f"test_bulk_rw_{suffix}"
+    parameters = {
+        "user_owner": ["postgres"],
+        "another_users": users,
+        "role_ro": [role_ro],
+        "role_rw": [role_rw],
+        "users_to_receive_role_ro": users,
+        "users_to_receive_role_rw": users[:2],
+    }
+    cluster_steps, _, _ = split_task_plan(compile_task(parameters, "test_db"))
+    memberships = [step for step in cluster_steps if step.category == "grant_membership"]
+    statements = [step.statement for step in merge_membership_steps(memberships)]
+    assert statements == [f"GRANT {role_ro}, {role_rw} TO {users[0]}, {users[1]};", f"GRANT {role_ro} TO {users[2]};"]
+
+    try:
+        cursor.execute(f"CREATE ROLE {role_ro};")
+        cursor.execute(f"CREATE USER {users[0]}; GRANT {role_ro} TO {users[0]};")
+        executed = execute_cluster_steps_bulk(cursor, cluster_steps)
+        # One batch of 3 creations, ALTER DATABASE, then one GRANT per distinct set of missing roles
+        assert executed == 3 + 1 + 3
+        for user in users:
+            assert is_role_assigned(cursor, role_ro, user)
+        assert is_role_assigned(cursor, role_rw, users[1])
+        assert not is_role_assigned(cursor, role_rw, users[2])
+        assert execute_cluster_steps_bulk(cursor, cluster_steps) == 1
+    finally:
+        for role in users + [role_ro, role_rw]:
+            cursor.execute(f"DROP ROLE IF EXISTS {role};")
+
+
 def test_grant_role_cr(cursor):
     """
     Test for grant_role_cr function.
@@ -384,6 +776,319 @@ def test_grant_role_tr(cursor):
         cursor.execute(f"DROP ROLE IF EXISTS {test_role};")
 
 
+def test_process_grants_batched(tmp_path, cursor):
+    """
+    Test for process_grants in batch mode.
+    Temporary tables are granted with a small statement size limit so several chunks are needed,
+    then the privileges and the reported grant count are checked against the unbatched mode.
+    A resumed run counts no grants for the batches its journal already holds.
+    """
+    test_schema = "test_schema_" + uuid.uuid4().hex[:8]
+    test_role = "test_role_batch_" + uuid.uuid4().hex[:8]
+    owner = "postgres"
+    tables = [f"{test_schema}.table_{i}" for i in range(10)]
+    grant_parameters = [
+        ("tables_to_receive_grant_full", tables[:6], test_role),
+        ("tables_to_receive_grant_select", tables[4:], test_role),
+    ]
+    try:
+        create_schema(cursor, test_schema, owner)
+        create_role(cursor, test_role)
+        for table in tables:
+            cursor.execute(f"CREATE TABLE {table} (id INT);")
+        journal_file = tmp_path / "grants.journal"
+        journal = Journal(str(journal_file))
+        executed = process_grants(cursor, grant_parameters, batch=True, max_statement_size=120, journal=journal)
+        journal.close(complete=False)
+        logging.info(f"Batched grants executed: {executed}")
+        assert executed == 12
+        for table in tables:
+            cursor.execute("SELECT has_table_privilege(%s, %s, 'SELECT');", (test_role, table))
+            assert cursor.fetchone()[0]
+        for table in tables[:6]:
+            cursor.execute("SELECT has_table_privilege(%s, %s, 'DELETE');", (test_role, table))
+            assert cursor.fetchone()[0]
+        assert process_grants(cursor, grant_parameters) == executed
+        resumed = Journal(str(journal_file), resume=True)
+        assert process_grants(cursor, grant_parameters, batch=True, max_statement_size=120, journal=resumed) == 0
+        resumed.close(complete=True)
+    finally:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {test_schema} CASCADE;")
+        cursor.execute(f"DROP ROLE IF EXISTS {test_role};")
+
+
+def test_execute_sharded(cursor, connection_args):
+    """
+    Test for parallel grant execution.
+    Table grants are spread over several pooled connections. A grant on a missing table stops
+    the run, or under the error policy is counted as a failure against its record without
+    stopping the other workers.
+    """
+    test_schema = "test_schema_" + uuid.uuid4().hex[:8]
+    test_role = "test_role_workers_" + uuid.uuid4().hex[:8]
+    owner = "postgres"
+    tables = [f"{test_schema}.table_{i}" for i in range(8)]
+    grant_parameters = [
+        ("tables_to_receive_grant_select", tables, test_role),
+        ("tables_to_receive_grant_full", [f"{test_schema}.missing_table"], test_role),
+    ]
+    try:
+        create_schema(cursor, test_schema, owner)
+        create_role(cursor, test_role)
+        for table in tables:
+            cursor.execute(f"CREATE TABLE {table} (id INT);")
+        with pytest.raises(psycopg2.errors.UndefinedTable):
+            execute_sharded(connection_args, iter_table_grant_work(grant_parameters), 3)
+        policy = ErrorPolicy(retries=0)
+        args = Namespace(**vars(connection_args), run_state=RunState(error_policy=policy))
+        succeeded, failed = execute_sharded(args, iter_table_grant_work(grant_parameters), 3)
+        logging.info(f"Sharded grants: {succeeded} succeeded, {failed} failed")
+        assert (succeeded, failed) == (8, 1)
+        assert [(failure["sqlstate"], failure["source"]) for failure in policy.failures] == [("42P01", "2")]
+        assert policy.skipped() == 1
+        for table in tables:
+            cursor.execute("SELECT has_table_privilege(%s, %s, 'SELECT');", (test_role, table))
+            assert cursor.fetchone()[0]
+    finally:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {test_schema} CASCADE;")
+        cursor.execute(f"DROP ROLE IF EXISTS {test_role};")
+
+
+def test_execute_sharded_async(cursor, connection_args):
+    """
+    Test for the asyncio backend.
+    The same work items as the threaded backend are executed over asynchronous connections,
+    and a grant on a missing table is skipped under the same error policy.
+    """
+    test_schema = "test_schema_" + uuid.uuid4().hex[:8]
+    test_role = "test_role_async_" + uuid.uuid4().hex[:8]
+    owner = "postgres"
+    tables = [f"{test_schema}.table_{i}" for i in range(8)]
+    grant_parameters = [
+        ("tables_to_receive_grant_full", tables, test_role),
+        ("tables_to_receive_grant_select", [f"{test_schema}.missing_table"], test_role),
+    ]
+    policy = ErrorPolicy(retries=0)
+    args = Namespace(**vars(connection_args), run_state=RunState(error_policy=policy))
+    try:
+        create_schema(cursor, test_schema, owner)
+        create_role(cursor, test_role)
+        for table in tables:
+            cursor.execute(f"CREATE TABLE {table} (id INT);")
+        succeeded, failed = asyncio.run(
+            execute_sharded_async(args, iter_table_grant_work(grant_parameters), 2)
+        )
+        logging.info(f"Async grants: {succeeded} succeeded, {failed} failed")
+        assert (succeeded, failed) == (8, 1)
+        assert [(failure["sqlstate"], failure["source"]) for failure in policy.failures] == [("42P01", "2")]
+        for table in tables:
+            cursor.execute("SELECT has_table_privilege(%s, %s, 'DELETE');", (test_role, table))
+            assert cursor.fetchone()[0]
+    finally:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {test_schema} CASCADE;")
+        cursor.execute(f"DROP ROLE IF EXISTS {test_role};")
+
+
+def test_transaction_batch_cursor(connection_args, cursor):
+    """
+    Test for --transaction_batch.
+    Statements are committed every N statements, a failing statement is rolled back to its
+    savepoint without losing the batch, and CREATE DATABASE runs outside the transaction.
+    """
+    suffix = uuid.uuid4().hex[:8]
+    roles = [f"test_role_batch_{i}_{suffix}" for i in range(3)]
+    database = "test_db_batch_" + suffix
+    conn = psycopg2.connect(host=connection_args.host, port=connection_args.port,
+                            user=connection_args.username, dbname=connection_args.dbname)
+    conn.autocommit = True
+    batch_cursor = open_cursor(conn, Namespace(transaction_batch=3))
+    try:
+        batch_cursor.execute(f"CREATE ROLE {roles[0]};")
+        with pytest.raises(psycopg2.Error):
+            batch_cursor.execute(f"GRANT missing_role_{suffix} TO {roles[0]};")
+        batch_cursor.execute(f"CREATE ROLE {roles[1]};")
+        batch_cursor.execute("SELECT 1 FROM pg_roles WHERE rolname = %s", (roles[1],))
+        assert batch_cursor.fetchone() == (1,)
+
+        # Two statements are pending, invisible to other connections
+        cursor.execute("SELECT count(*) FROM pg_roles WHERE rolname = ANY(%s)", (roles,))
+        assert cursor.fetchone()[0] == 0
+
+        batch_cursor.execute(f"CREATE ROLE {roles[2]};")
+        cursor.execute("SELECT count(*) FROM pg_roles WHERE rolname = ANY(%s)", (roles,))
+        assert cursor.fetchone()[0] == 3
+
+        batch_cursor.execute(f"CREATE DATABASE {database};")
+        cursor.execute("SELECT 1 FROM pg_database WHERE datname = %s", (database,))
+        assert cursor.fetchone() is not None
+    finally:
+        batch_cursor.close()
+        conn.close()
+        cursor.execute(f"DROP DATABASE IF EXISTS {database};")
+        for role in roles:
+            cursor.execute(f"DROP ROLE IF EXISTS {role};")
+
+
+def test_execute_server_side(cursor):
+    """
+    Test for the server-side backend.
+    A compiled plan runs as a DO block with its existence checks evaluated by the server, and
+    the returned result set reports executed, skipped and failed statements separately.
+    """
+    suffix = uuid.uuid4().hex[:8]
+    test_schema = "test_schema_server_" + suffix
+    test_role = "test_role_ro_server_" + suffix
+    parameters = {
+        "user_owner": ["postgres"],
+        "role_ro": [test_role],
+        "schema_list": [test_schema],
+        "schema_ro_list": [test_schema],
+    }
+    cursor.execute("SELECT current_database();")
+    plan = compile_task(parameters, cursor.fetchone()[0])
+    try:
+        executed, skipped, failed = execute_server_side(cursor, plan)
+        assert (skipped, failed) == (2, 0)  # postgres exists and already is the session user
+        assert executed == len(plan) - 2
+        cursor.execute("SELECT has_schema_privilege(%s, %s, 'USAGE')", (test_role, test_schema))
+        assert cursor.fetchone()[0] is True
+
+        # Existing objects are skipped server-side; a missing table fails on its own
+        grants = compile_grants([("tables_to_receive_grant_select", [f"{test_schema}.missing"], test_role)])
+        executed, skipped, failed = execute_server_side(cursor, plan + grants, max_size=2000)
+        assert (skipped, failed) == (4, 1)
+    finally:
+        cursor.execute("RESET ROLE;")
+        cursor.execute(f"DROP SCHEMA IF EXISTS {test_schema} CASCADE;")
+        cursor.execute(f"DROP OWNED BY {test_role};")
+        cursor.execute(f"DROP ROLE IF EXISTS {test_role};")
+
+
+def test_execute_pipelined(caplog, cursor, connection_args):
+    """
+    Test for the psycopg 3 pipeline backend.
+    Grants are streamed without waiting for each reply. A failing grant stops the run as on the
+    other backends, and under --continue_on_error is skipped and reported with the CSV row it
+    came from while the grants around it still succeed.
+    """
+    pytest.importorskip("psycopg")
+    suffix = uuid.uuid4().hex[:8]
+    test_schema = "test_schema_pipeline_" + suffix
+    test_role = "test_role_pipeline_" + suffix
+    cursor.execute(f"CREATE SCHEMA {test_schema};")
+    cursor.execute(f"CREATE TABLE {test_schema}.t1 (id int);")
+    cursor.execute(f"CREATE TABLE {test_schema}.t2 (id int);")
+    cursor.execute(f"CREATE ROLE {test_role};")
+    try:
+        steps = compile_grants([
+            ("tables_to_receive_grant_select", [f"{test_schema}.t1"], test_role),
+            ("tables_to_receive_grant_full", [f"{test_schema}.missing"], test_role),
+            ("tables_to_receive_grant_full", [f"{test_schema}.t2"], test_role),
+        ])
+        with pytest.raises(Exception, match="missing"):
+            execute_pipelined(connection_args, steps, window=2)
+
+        policy = ErrorPolicy(retries=0)
+        args = Namespace(**vars(connection_args), run_state=RunState(error_policy=policy))
+        with caplog.at_level(logging.ERROR):
+            assert execute_pipelined(args, steps, window=2) == (2, 1)
+        assert "(from 2, SQLSTATE 42P01)" in caplog.text
+        assert [failure["classification"] for failure in policy.failures] == ["skippable"]
+
+        cursor.execute("SELECT has_table_privilege(%s, %s, 'DELETE')", (test_role, f"{test_schema}.t2"))
+        assert cursor.fetchone()[0] is True
+    finally:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {test_schema} CASCADE;")
+        cursor.execute(f"DROP ROLE IF EXISTS {test_role};")
+
+
+def test_plan_task_is_idempotent(cursor):
+    """
+    Test for the plan/apply engine.
+    The plan computed for a fresh set of parameters is applied, after which planning again
+    against the refreshed catalog state must produce no statements at all.
+    """
+    suffix = uuid.uuid4().hex[:8]
+    test_schema = "test_schema_" + suffix
+    parameters = {
+        "user_owner": ["postgres"],
+        "another_users": ["test_user_plan_" + suffix],
+        "role_ro": ["test_role_ro_plan_" + suffix],
+        "role_rw": ["test_role_rw_plan_" + suffix],
+        "users_to_receive_role_ro": ["test_user_plan_" + suffix],
+        "schema_list": [test_schema],
+        "schema_ro_list": [test_schema],
+        "schema_rw_list": [test_schema],
+    }
+    grant_parameters = [("tables_to_receive_grant_select", [f"{test_schema}.test_table"], "test_role_ro_plan_" + suffix)]
+    cursor.execute("SELECT current_database();")
+    args = Namespace(dbname=cursor.fetchone()[0])
+    try:
+        plan = plan_task(load_catalog_state(cursor), parameters, args)
+        logging.info(f"Initial plan: {plan}")
+        assert f"CREATE SCHEMA {test_schema} AUTHORIZATION postgres;" in [step.statement for step in plan]
+        assert apply_plan(cursor, plan) == len(plan)
+        cursor.execute(f"CREATE TABLE {test_schema}.test_table (id SERIAL PRIMARY KEY, name TEXT);")
+
+        state = load_catalog_state(cursor)
+        assert plan_task(state, parameters, args) == []
+        assert plan_grants(state, grant_parameters) == []
+    finally:
+        cursor.execute("RESET ROLE;")
+        cursor.execute(f"DROP SCHEMA IF EXISTS {test_schema} CASCADE;")
+        for role in ["test_user_plan_", "test_role_ro_plan_", "test_role_rw_plan_"]:
+            cursor.execute(f"DROP OWNED BY {role + suffix};")
+            cursor.execute(f"DROP ROLE IF EXISTS {role + suffix};")
+
+
+def test_plan_cache(monkeypatch, tmp_path, temp_csv_file, connection_args, cursor):
+    """
+    Test for the content-hash plan cache.
+    A second run of the same parameter file against an unchanged catalog must be skipped; once the
+    catalog changes, the cached plan is executed again. Eviction keeps the cache within its size cap.
+    """
+    import postgres_Latest
+    dispatched = []
+    dispatch_task = postgres_Latest.dispatch_task
+    monkeypatch.setattr(postgres_Latest, "dispatch_task",
+                        lambda *args: dispatched.append(args[3:]) or dispatch_task(*args))
+
+    cache_dir = str(tmp_path / "plans")
+    extra_role = "test_role_cache_" + uuid.uuid4().hex[:8]
+    args = Namespace(**vars(connection_args), parameter_file=str(temp_csv_file), task="create_users",
+                     useDatadog="Disabled", plan_cache_dir=cache_dir)
+    try:
+        assert run_task(cursor, None, args) == 0
+        key = plan_cache_key(args)
+        assert plan_cache_lookup(cache_dir, key) is not None
+        assert any(step.category == "create_schema" for step in load_cached_plan(cache_dir, key))
+
+        run_task(cursor, None, args)
+        assert len(dispatched) == 1
+
+        cursor.execute("RESET ROLE;")
+        cursor.execute(f"CREATE ROLE {extra_role};")
+        run_task(cursor, None, args)
+        assert len(dispatched) == 2
+        assert dispatched[1][0] is not None  # The cached plan was reused
+    finally:
+        cursor.execute("RESET ROLE;")
+        cursor.execute(f"DROP ROLE IF EXISTS {extra_role};")
+
+    # Plan-changing options key a separate entry
+    assert plan_cache_key(Namespace(**vars(args), merge_schema_grants=True)) != key
+    assert plan_cache_key(Namespace(**vars(args), previous_parameter_file=str(temp_csv_file))) != key
+
+    # The entry just written counts towards the size limit but is never evicted
+    steps = load_cached_plan(cache_dir, key)
+    plan_cache_store(cache_dir, "a" * 64, "fingerprint", steps)
+    size = Path(cache_dir, "a" * 64 + ".jsonl").stat().st_size
+    plan_cache_store(cache_dir, "b" * 64, "fingerprint", steps, max_size=size * 3 // 2)
+    assert plan_cache_lookup(cache_dir, key) is None
+    assert plan_cache_lookup(cache_dir, "a" * 64) is None
+    assert plan_cache_lookup(cache_dir, "b" * 64) is not None
+
+
 #########################################
 # INTEGRATION TEST FOR main()
 #########################################
@@ -452,3 +1157,480 @@ def test_main(monkeypatch, temp_csv_file, db_conn):
 
     finally:
         cursor.close()
+
+
+def test_run_profile(tmp_path, temp_csv_file, connection_args):
+    """
+    Test for the run profile.
+    Statements are classified by category and target, and a profiled run exports per-category
+    histograms, the slowest statements and the client/connect/network/server time split as JSON.
+    """
+    assert describe_statement("CREATE SCHEMA sales AUTHORIZATION owner;") == ("create_schema", "sales")
+    assert describe_statement("GRANT SELECT ON ALL TABLES IN SCHEMA s1, s2 TO ro;") == ("all_objects_privileges", "s1, s2")
+    assert describe_statement("SAVEPOINT batch_statement;\nGRANT ro TO app;\n;") == ("grant_membership", "ro")
+    assert describe_statement("SELECT 1 FROM pg_auth_members WHERE roleid = 1") == ("catalog_probe", "pg_auth_members")
+
+    profile_file = tmp_path / "profile.json"
+    args = Namespace(**vars(connection_args), parameter_file=str(temp_csv_file), task="create_users",
+                     useDatadog="Disabled", profile_json=str(profile_file), profile_top=3)
+    main(args)
+
+    with profile_file.open(encoding="utf-8") as f:
+        report = json.load(f)
+    logging.info(f"Run profile: {report}")
+    assert report["categories"]["connect"]["count"] == 2
+    default_privileges = report["categories"]["default_privileges"]
+    assert sum(default_privileges["histogram"].values()) == default_privileges["count"]
+    assert len(report["slowest"]) == 3
+    assert set(report["split_seconds"]) == {"client", "connect", "network", "server"}
+
+
+def test_resume_from_journal(caplog, tmp_path, connection_args, cursor):
+    """
+    Test for checkpointed runs.
+    A run failing on a missing table leaves a journal of the grants it applied; once the table
+    exists, --resume skips those grants, applies the rest and removes the journal.
+    """
+    test_schema = "test_schema_" + uuid.uuid4().hex[:8]
+    test_role = "test_role_journal_" + uuid.uuid4().hex[:8]
+    grants_file = tmp_path / "grants.csv"
+    with grants_file.open("w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["permissions", "tables", "role"])
+        for table in ("t1", "t2", "t3", "t4"):
+            writer.writerow(["tables_to_receive_grant_select", f"{test_schema}.{table}", test_role])
+    journal_dir = tmp_path / "journal"
+    args = Namespace(**vars(connection_args), parameter_file=str(grants_file), task="execute_grants",
+                     journal_dir=str(journal_dir), resume=False)
+    try:
+        cursor.execute(f"CREATE SCHEMA {test_schema}; CREATE ROLE {test_role};")
+        for table in ("t1", "t2", "t4"):
+            cursor.execute(f"CREATE TABLE {test_schema}.{table} (id int);")
+        with pytest.raises(psycopg2.errors.UndefinedTable):
+            main(args)
+        journals = list(journal_dir.iterdir())
+        assert len(journals) == 1 and journals[0].stat().st_size == 2 * 8
+
+        cursor.execute(f"CREATE TABLE {test_schema}.t3 (id int);")
+        args.resume = True
+        with caplog.at_level(logging.INFO):
+            main(args)
+        assert "Skipped 2 statements applied by an earlier run." in caplog.text
+        assert list(journal_dir.iterdir()) == []
+        cursor.execute("SELECT has_table_privilege(%s, %s, 'SELECT')", (test_role, f"{test_schema}.t4"))
+        assert cursor.fetchone()[0]
+    finally:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {test_schema} CASCADE;")
+        cursor.execute(f"DROP ROLE IF EXISTS {test_role};")
+
+
+def test_continue_on_error(caplog, tmp_path, connection_args, cursor):
+    """
+    Test for continue-on-error runs.
+    A grant on a missing table is skipped instead of aborting the run, the remaining grants are
+    applied, and the failure report names the CSV line of the bad row and its SQLSTATE.
+    """
+    test_schema = "test_schema_" + uuid.uuid4().hex[:8]
+    test_role = "test_role_errors_" + uuid.uuid4().hex[:8]
+    grants_file = tmp_path / "grants.csv"
+    with grants_file.open("w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["permissions", "tables", "role"])
+        for table in ("t1", "missing", "t2"):
+            writer.writerow(["tables_to_receive_grant_select", f"{test_schema}.{table}", test_role])
+    report_file = tmp_path / "failures.csv"
+    args = Namespace(**vars(connection_args), parameter_file=str(grants_file), task="execute_grants",
+                     continue_on_error=True, failure_report=str(report_file), retries=1, retry_backoff=0.01)
+    try:
+        cursor.execute(f"CREATE SCHEMA {test_schema}; CREATE ROLE {test_role};")
+        for table in ("t1", "t2"):
+            cursor.execute(f"CREATE TABLE {test_schema}.{table} (id int);")
+        with caplog.at_level(logging.INFO):
+            main(args)
+        assert "Failure report: 1 failed statements (42P01 x1)." in caplog.text
+        cursor.execute("SELECT has_table_privilege(%s, %s, 'SELECT')", (test_role, f"{test_schema}.t2"))
+        assert cursor.fetchone()[0]
+
+        with report_file.open(encoding="utf-8", newline="") as f:
+            failures = list(csv.DictReader(f))
+        assert len(failures) == 1
+        assert failures[0]["source"] == "3"
+        assert failures[0]["sqlstate"] == "42P01"
+        assert failures[0]["classification"] == "skippable"
+        assert f"{test_schema}.missing" in failures[0]["statement"]
+    finally:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {test_schema} CASCADE;")
+        cursor.execute(f"DROP ROLE IF EXISTS {test_role};")
+
+
+def test_continue_on_error_batched(tmp_path, connection_args, cursor):
+    """
+    Test for continue-on-error runs with batched grants.
+    A multi-table GRANT naming a missing table is retried one table at a time: only the missing
+    table is skipped and reported against its CSV line, and the other tables are still granted.
+    """
+    test_schema = "test_schema_" + uuid.uuid4().hex[:8]
+    roles = ["test_role_batch_" + uuid.uuid4().hex[:8] for _ in range(2)]
+    grants_file = tmp_path / "grants.csv"
+    with grants_file.open("w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["permissions", "tables", "role"])
+        writer.writerow(["tables_to_receive_grant_select", f"{test_schema}.t1,{test_schema}.missing", roles[0]])
+        writer.writerow(["tables_to_receive_grant_select", f"{test_schema}.t1", roles[1]])
+    report_file = tmp_path / "failures.csv"
+    args = Namespace(**vars(connection_args), parameter_file=str(grants_file), task="execute_grants",
+                     batch_grants=True, continue_on_error=True, failure_report=str(report_file), retries=0)
+    try:
+        cursor.execute(f"CREATE SCHEMA {test_schema}; CREATE TABLE {test_schema}.t1 (id int);")
+        cursor.execute(f"CREATE ROLE {roles[0]}; CREATE ROLE {roles[1]};")
+        main(args)
+        for role in roles:
+            cursor.execute("SELECT has_table_privilege(%s, %s, 'SELECT')", (role, f"{test_schema}.t1"))
+            assert cursor.fetchone()[0]
+        with report_file.open(encoding="utf-8", newline="") as f:
+            assert [(failure["sqlstate"], failure["source"]) for failure in csv.DictReader(f)] == [("42P01", "2")]
+    finally:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {test_schema} CASCADE;")
+        cursor.execute(f"DROP ROLE IF EXISTS {roles[0]}; DROP ROLE IF EXISTS {roles[1]};")
+
+
+def test_lock_scheduled_grants(caplog, tmp_path, connection_args, cursor):
+    """
+    Test for the lock-aware scheduler.
+    A grant on a table another transaction is altering is deferred while the other grants
+    proceed, and applied once that transaction commits, within the growing lock_timeouts.
+    """
+    test_schema = "test_schema_" + uuid.uuid4().hex[:8]
+    test_role = "test_role_locks_" + uuid.uuid4().hex[:8]
+    grants_file = tmp_path / "grants.csv"
+    with grants_file.open("w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["permissions", "tables", "role"])
+        writer.writerow(["tables_to_receive_grant_select", f"{test_schema}.t1,{test_schema}.t2", test_role])
+    args = Namespace(**vars(connection_args), parameter_file=str(grants_file), task="execute_grants",
+                     lock_timeout=50, lock_retries=5)
+    holder = psycopg2.connect(host=args.host, port=args.port, user=args.username, dbname=args.dbname)
+    try:
+        cursor.execute(f"CREATE SCHEMA {test_schema}; CREATE ROLE {test_role};")
+        cursor.execute(f"CREATE TABLE {test_schema}.t1 (id int); CREATE TABLE {test_schema}.t2 (id int);")
+        holder.cursor().execute(f"ALTER TABLE {test_schema}.t1 ADD COLUMN note text;")
+        release = threading.Timer(0.3, holder.commit)
+        release.start()
+        with caplog.at_level(logging.INFO):
+            main(args)
+        release.join()
+        assert f"{test_schema}.t1 is locked by another transaction, deferring" in caplog.text
+        assert caplog.text.index(f"ON {test_schema}.t2") < caplog.text.index("Retrying 1 deferred statements")
+        cursor.execute("SELECT has_table_privilege(%s, %s, 'SELECT'), has_table_privilege(%s, %s, 'SELECT')",
+                       (test_role, f"{test_schema}.t1", test_role, f"{test_schema}.t2"))
+        assert cursor.fetchone() == (True, True)
+    finally:
+        holder.close()
+        cursor.execute(f"DROP SCHEMA IF EXISTS {test_schema} CASCADE;")
+        cursor.execute(f"DROP ROLE IF EXISTS {test_role};")
+
+
+def test_throttled_grants(caplog, tmp_path, connection_args, cursor):
+    """
+    Test for the load-aware throttle.
+    While other sessions keep the server over --max_active_sessions, the sharded grant workers
+    pause; they resume once the load is gone, and the paused time is reported in the metrics.
+    """
+    test_schema = "test_schema_" + uuid.uuid4().hex[:8]
+    test_role = "test_role_throttle_" + uuid.uuid4().hex[:8]
+    grants_file = tmp_path / "grants.csv"
+    with grants_file.open("w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["permissions", "tables", "role"])
+        writer.writerow(["tables_to_receive_grant_select", f"{test_schema}.t1,{test_schema}.t2", test_role])
+    metrics_file = tmp_path / "db_permissions.prom"
+    args = Namespace(**vars(connection_args), parameter_file=str(grants_file), task="execute_grants", workers=2,
+                     max_active_sessions=1, throttle_interval=0.1, metrics_file=str(metrics_file))
+    load = [psycopg2.connect(host=args.host, port=args.port, user=args.username, dbname=args.dbname)
+            for _ in range(2)]
+    sessions = [threading.Thread(target=conn.cursor().execute, args=("SELECT pg_sleep(0.5);",)) for conn in load]
+    try:
+        cursor.execute(f"CREATE SCHEMA {test_schema}; CREATE ROLE {test_role};")
+        cursor.execute(f"CREATE TABLE {test_schema}.t1 (id int); CREATE TABLE {test_schema}.t2 (id int);")
+        for session in sessions:
+            session.start()
+        time.sleep(0.1)
+        with caplog.at_level(logging.INFO):
+            main(args)
+        assert "is over the throttle ceiling" in caplog.text
+        cursor.execute("SELECT has_table_privilege(%s, %s, 'SELECT'), has_table_privilege(%s, %s, 'SELECT')",
+                       (test_role, f"{test_schema}.t1", test_role, f"{test_schema}.t2"))
+        assert cursor.fetchone() == (True, True)
+        samples = {line.rsplit(" ", 1)[0]: float(line.rsplit(" ", 1)[1])
+                   for line in metrics_file.read_text(encoding="utf-8").splitlines() if not line.startswith("#")}
+        assert samples[f'db_permissions_throttled_seconds{{host="{args.host}",port="{args.port}",reason="paused"}}'] > 0
+    finally:
+        for session in sessions:
+            session.join()
+        for conn in load:
+            conn.close()
+        cursor.execute(f"DROP SCHEMA IF EXISTS {test_schema} CASCADE;")
+        cursor.execute(f"DROP ROLE IF EXISTS {test_role};")
+
+
+def test_daemon_jobs(monkeypatch, caplog, capsys, tmp_path, temp_csv_file, connection_args):
+    """
+    Test for the daemon mode.
+    Jobs submitted over the Unix socket stream back their logs, output and exit status, and the
+    second job runs on the warm connections the first one returned to the pools. Jobs run side
+    by side, each client receiving only the logs and output of its own job.
+    """
+    socket_path = str(tmp_path / "daemon.sock")
+    server = JobServer(socket_path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def pooled_backends():
+        return {conn.get_backend_pid() for idle in server.pools.idle.values() for conn, _ in idle}
+
+    try:
+        args = Namespace(**vars(connection_args), parameter_file=str(temp_csv_file), task="create_users",
+                         useDatadog="Disabled", submit=socket_path)
+        with caplog.at_level(logging.INFO):
+            assert submit_job(args) == 0
+            backends = pooled_backends()
+            assert len(backends) == 2
+            assert submit_job(args) == 0
+            assert pooled_backends() == backends
+            assert "Script execution completed" in capsys.readouterr().err
+
+            # The SQL of a dry run reaches the client instead of the daemon's stdout
+            assert submit_job(Namespace(**vars(args), dry_run=True)) == 0
+            assert "-- Task create_users on database" in capsys.readouterr().out
+
+            # Both jobs must be inside emit_sql at once for either to get past the barrier
+            barrier = threading.Barrier(2, timeout=10)
+            emit_sql = postgres_Latest.emit_sql
+
+            def emit_sql_together(*emit_args):
+                barrier.wait()
+                return emit_sql(*emit_args)
+
+            monkeypatch.setattr(postgres_Latest, "emit_sql", emit_sql_together)
+            replies = {}
+
+            def run_job(dbname):
+                job = dict(vars(args), dbname=dbname, dry_run=True)
+                del job["submit"]
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                    client.connect(socket_path)
+                    client.sendall((json.dumps(job) + "\n").encode("utf-8"))
+                    with client.makefile("r", encoding="utf-8") as lines:
+                        replies[dbname] = [json.loads(line) for line in lines]
+
+            jobs = [threading.Thread(target=run_job, args=(dbname,)) for dbname in ("daemon_db_a", "daemon_db_b")]
+            for job in jobs:
+                job.start()
+            for job in jobs:
+                job.join()
+            for dbname, other in (("daemon_db_a", "daemon_db_b"), ("daemon_db_b", "daemon_db_a")):
+                assert replies[dbname][-1] == {"status": 0}
+                streamed = "".join(reply.get("log", "") + reply.get("stdout", "") for reply in replies[dbname])
+                assert f"on database {dbname}" in streamed
+                assert other not in streamed
+
+            args.parameter_file = str(tmp_path / "missing.csv")
+            assert submit_job(args) == 1
+            assert "Job create_users failed." in capsys.readouterr().err
+    finally:
+        server.shutdown()
+        server.server_close()
+        server.pools.close()
+
+
+def test_run_metrics(tmp_path, temp_csv_file, connection_args):
+    """
+    Test for the OpenMetrics textfile.
+    A second run of the same parameter file skips everything the first one created, and the
+    textfile reports statements by kind, skips, catalog queries and the task duration.
+    """
+    metrics_file = tmp_path / "db_permissions.prom"
+    args = Namespace(**vars(connection_args), parameter_file=str(temp_csv_file), task="create_users",
+                     useDatadog="Disabled", metrics_file=str(metrics_file))
+    main(args)
+    main(args)
+
+    lines = metrics_file.read_text(encoding="utf-8").splitlines()
+    logging.info("Run metrics: %s", lines)
+    samples = {line.rsplit(" ", 1)[0]: float(line.rsplit(" ", 1)[1]) for line in lines if not line.startswith("#")}
+    assert lines[-1] == "# EOF"
+    assert "# TYPE db_permissions_task_duration_seconds gauge" in lines
+    assert samples['db_permissions_skipped{kind="create_role"}'] >= 1
+    assert 'db_permissions_statements{kind="create_role"}' not in samples
+    assert samples['db_permissions_statements{kind="default_privileges"}'] >= 1
+    assert samples["db_permissions_catalog_queries"] >= 1
+    labels = f'host="{args.host}",port="{args.port}",database="{args.dbname}",task="create_users"'
+    assert samples[f"db_permissions_task_duration_seconds{{{labels}}}"] > 0
+    assert samples[f"db_permissions_task_failures{{{labels}}}"] == 0
+    assert samples[f"db_permissions_task_success{{{labels}}}"] == 1
+
+
+def test_emit_sql(tmp_path, temp_csv_file, cursor):
+    """
+    Test for the dry-run mode.
+    --emit_sql writes the compiled plan of a task to a file without touching the database:
+    guarded steps go through psql's \\gexec, the output is identical between runs, and no
+    object is created.
+    """
+    args = Namespace(host=None, port=None, username="postgres", dbname="test_db_dry_run",
+                     parameter_file=str(temp_csv_file), task="create_users", useDatadog="Disabled")
+    outputs = []
+    for name in ("first.sql", "second.sql"):
+        args.emit_sql = str(tmp_path / name)
+        statements = main(args)
+        outputs.append((tmp_path / name).read_text(encoding="utf-8"))
+    logging.info("Emitted SQL:\n%s", outputs[0])
+
+    assert outputs[0] == outputs[1]
+    lines = outputs[0].splitlines()
+    assert "\\connect test_db_dry_run" in lines
+    assert statements == len(compile_task(load_parameters(str(temp_csv_file)), "test_db_dry_run"))
+    assert ("SELECT 'CREATE ROLE test_role_main;' WHERE NOT EXISTS "
+            "(SELECT 1 FROM pg_roles WHERE rolname = 'test_role_main') \\gexec") in lines
+    assert "ALTER DATABASE test_db_dry_run OWNER TO postgres;" in lines
+
+    cursor.execute("SELECT 1 FROM pg_database WHERE datname = 'test_db_dry_run'")
+    assert cursor.fetchone() is None
+
+
+def test_provision_databases(temp_csv_file, connection_args, cursor):
+    """
+    Integration test for multi-database fan-out.
+    Two databases are created through the shared maintenance connection and then provisioned
+    concurrently from the same parameter file; every target must be reported as successful.
+    """
+    databases = ["test_db_fanout_" + uuid.uuid4().hex[:8] for _ in range(2)]
+    targets = [(database, str(temp_csv_file)) for database in databases]
+    args = Namespace(**vars(connection_args), useDatadog="Disabled", parallel_databases=2)
+    try:
+        args.task = "create_database"
+        summary = provision_databases(args, targets)
+        assert [entry[1] for entry in summary] == ["ok", "ok"]
+
+        args.task = "create_users"
+        summary = provision_databases(args, targets)
+        logging.info(f"Fan-out summary: {summary}")
+        assert [entry[0] for entry in summary] == databases
+        assert [entry[1] for entry in summary] == ["ok", "ok"]
+    finally:
+        for database in databases:
+            cursor.execute(f"DROP DATABASE IF EXISTS {database};")
+
+
+def test_option_conflict():
+    """
+    Test for conflicting execution options.
+    Combinations an executor would silently ignore are refused; compatible ones are accepted.
+    """
+    defaults = dict(backend="sync", workers=1, plan=False, batch_grants=False, merge_schema_grants=False,
+                    bulk_roles=False, transaction_batch=0, lock_timeout=0, previous_parameter_file=None,
+                    journal_dir=None)
+    assert option_conflict(Namespace(**defaults)) is None
+    assert option_conflict(Namespace(**{**defaults, "workers": 8, "backend": "async"})) is None
+    assert option_conflict(Namespace(**{**defaults, "merge_schema_grants": True, "workers": 8})) is not None
+    assert option_conflict(Namespace(**{**defaults, "backend": "pipeline", "lock_timeout": 100})) is not None
+    assert option_conflict(Namespace(**{**defaults, "backend": "server", "workers": 4})) is not None
+    assert option_conflict(Namespace(**{**defaults, "backend": "server", "journal_dir": "journals"})) is not None
+    assert option_conflict(Namespace(**{**defaults, "previous_parameter_file": "old.csv", "plan": True})) is not None
+
+
+def test_single_database_list(temp_csv_file, connection_args):
+    """
+    Test for a --databases list naming one database without --dbname.
+    The task runs against the listed database rather than the one libpq would default to.
+    """
+    args = Namespace(**{**vars(connection_args), "dbname": None}, databases=connection_args.dbname,
+                     parameter_file=str(temp_csv_file), task="create_users", useDatadog="Disabled")
+    summary = main(args)
+    assert [(entry[0], entry[1]) for entry in summary] == [(connection_args.dbname, "ok")]
+
+
+def test_target_retries_only_lost_connections(tmp_path, connection_args, cursor):
+    """
+    Test for fleet retries.
+    A grant that gives up on a lock held by another transaction fails its target at once
+    instead of replaying the whole target as if the connection had been lost.
+    """
+    test_schema = "test_schema_" + uuid.uuid4().hex[:8]
+    test_role = "test_role_retry_" + uuid.uuid4().hex[:8]
+    grants_file = tmp_path / "grants.csv"
+    with grants_file.open("w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["permissions", "tables", "role"])
+        writer.writerow(["tables_to_receive_grant_select", f"{test_schema}.t1", test_role])
+    args = Namespace(**vars(connection_args), parameter_file=str(grants_file), task="execute_grants",
+                     lock_timeout=10, lock_retries=0, retries=2, retry_backoff=0.01)
+    holder = psycopg2.connect(host=args.host, port=args.port, user=args.username, dbname=args.dbname)
+    try:
+        cursor.execute(f"CREATE SCHEMA {test_schema}; CREATE TABLE {test_schema}.t1 (id int); CREATE ROLE {test_role};")
+        holder.cursor().execute(f"ALTER TABLE {test_schema}.t1 ADD COLUMN note text;")
+        status, attempts, _, error = run_target_with_retries(args)
+        assert (status, attempts) == ("failed", 1)
+        assert "lock timeout" in error
+    finally:
+        holder.close()
+        cursor.execute(f"DROP SCHEMA IF EXISTS {test_schema} CASCADE;")
+        cursor.execute(f"DROP ROLE IF EXISTS {test_role};")
+
+
+def test_retrying_cursor(connection_args, cursor):
+    """
+    Test for statement retries under --continue_on_error.
+    A cancelled statement is retried on the caller's connection, which stays open, while a
+    terminated connection is replaced by one the cursor owns and the session's role replayed.
+    """
+    args = Namespace(**vars(connection_args), run_state=RunState(error_policy=ErrorPolicy(retries=1, backoff=0)))
+    conn = connect(args)
+    conn.autocommit = True
+    retrying = open_cursor(conn, args)
+    try:
+        retrying.execute("SET statement_timeout = 10;")
+        with pytest.raises(psycopg2.errors.QueryCanceled) as error:
+            retrying.execute("SELECT pg_sleep(1);")
+        assert error.value.attempts == 2
+        assert not conn.closed and retrying.owned is None
+        retrying.execute("RESET statement_timeout;")
+
+        retrying.execute(f"SET ROLE {connection_args.username};")
+        retrying.execute("SELECT pg_backend_pid();")
+        cursor.execute("SELECT pg_terminate_backend(%s);", (retrying.fetchone()[0],))
+        retrying.execute("SELECT current_user;")
+        assert retrying.fetchone()[0] == connection_args.username
+        assert retrying.owned is not None and retrying.connection is not conn
+    finally:
+        retrying.close()
+        conn.close()
+
+
+def test_run_inventory(tmp_path, temp_csv_file, connection_args, cursor):
+    """
+    Integration test for fleet orchestration.
+    A database is created and provisioned from an inventory file, while an unreachable host
+    is retried, reported as failed, and its remaining tasks are skipped.
+    """
+    database = "test_db_fleet_" + uuid.uuid4().hex[:8]
+    inventory_file = tmp_path / "inventory.csv"
+    with inventory_file.open("w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["host", "port", "database", "task", "parameter_file"])
+        writer.writerow([connection_args.host, connection_args.port, database, "create_database", ""])
+        writer.writerow([connection_args.host, connection_args.port, database, "", str(temp_csv_file)])
+        writer.writerow(["127.0.0.1", "1", "unreachable_db", "create_database", ""])
+        writer.writerow(["127.0.0.1", "1", "unreachable_db", "create_users", str(temp_csv_file)])
+    args = Namespace(username=connection_args.username, task="create_users", useDatadog="Disabled",
+                     retries=1, retry_backoff=0.01, max_concurrency=4, per_host_concurrency=1)
+    try:
+        results = run_inventory(args, load_inventory(str(inventory_file)))
+        logging.info(f"Fleet results: {results}")
+        statuses = {(result[2], result[3]): (result[4], result[5]) for result in results}
+        assert statuses[(database, "create_database")] == ("ok", 1)
+        assert statuses[(database, "create_users")] == ("ok", 1)
+        assert statuses[("unreachable_db", "create_database")] == ("failed", 2)
+        assert statuses[("unreachable_db", "create_users")][0] == "skipped"
+    finally:
+        cursor.execute(f"DROP DATABASE IF EXISTS {database};")
@@ -1,6 +1,8 @@
 import csv
 import logging
 
+from grants import compile_grants, match_grant_privileges
+
 # Define valid action permissions
 ACTIONS = ['select', 'insert', 'update', 'delete']
 
@@ -44,37 +46,21 @@ def load_parameters(csv_file_path):
             return parameters  # Return dictionary-based parameters
 
 
-def grant_full_permissions(role, tables):
-    """ Grants SELECT, INSERT, UPDATE, DELETE permissions on tables. """
-    return [f"GRANT SELECT, INSERT, UPDATE, DELETE ON {table} TO {role};" for table in tables]
-
-def grant_select_usage_permissions(role, tables):
-    """ Grants SELECT and USAGE permissions (for schemas or sequences). """
-    return [f"GRANT SELECT, USAGE ON {table} TO {role};" for table in tables]
-
-def grant_select_permissions(role, tables):
-    """ Grants only SELECT permission on tables. """
-    return [f"GRANT SELECT ON {table} TO {role};" for table in tables]
-
 def process_grants(data):
     """
     Processes either structured data (list) or dictionary-based parameters.
+
+    Permission types are matched by the words they contain, as before; the tables of a row
+    are granted once each, in sorted order.
     """
     grant_statements = []
 
     # If 'data' is a list, process optimized structured format
     if isinstance(data, list):
         for row in data:
-            permission_parts = row["permissions"].split('_')
-            tables = row["tables"]
-            role = row["role"]
-
-            if 'full' in permission_parts:
-                grant_statements.extend(grant_full_permissions(role, tables))
-            elif 'select' in permission_parts and 'usage' in permission_parts:
-                grant_statements.extend(grant_select_usage_permissions(role, tables))
-            elif 'select' in permission_parts:
-                grant_statements.extend(grant_select_permissions(role, tables))
+            # Statements come from the same compiler postgres_Latest.py executes
+            plan = compile_grants([(row["permissions"], row["tables"], row["role"])], match_grant_privileges)
+            grant_statements.extend(step.statement for step in plan)
 
     # # If 'data' is a dictionary (old method)
     # elif isinstance(data, dict):